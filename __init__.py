@@ -20,7 +20,7 @@ from . import addon_updater_ops
 #endregion
 
 #region Addon Imports
-from . import common, setReader
+from . import common, setReader, debugLog
 from .ops.exports import (
 	ExportSA1MDL,
 	ExportSA2MDL,
@@ -191,6 +191,31 @@ class AddonPreferences(bpy.types.AddonPreferences):
 		default=False,
 	)
 
+	logLevel: EnumProperty(
+		name="Log Level",
+		description="Detail of the debug output",
+		items=( ('DEBUG', "Debug", "Everything"),
+				('INFO', "Info", "Only general information"),
+				('WARNING', "Warning", "Only warnings")
+			),
+		default='DEBUG'
+	)
+
+	logSubsystems: EnumProperty(
+		name="Log Subsystems",
+		description="Parts of the addon that print debug output",
+		items=[(k, k.capitalize(), v) for k, v in debugLog.SUBSYSTEMS.items()],
+		options={'ENUM_FLAG'},
+		default=set(debugLog.SUBSYSTEMS.keys())
+	)
+
+	logFile: StringProperty(
+		name="Log File",
+		description="Additionally writes the debug output to this file. Leave empty to only print to the console",
+		default="",
+		subtype='FILE_PATH'
+	)
+
 	useProjectPath: BoolProperty(
 		name="Use Project Folder",
 		description="Overrides the set Default Path if a Project File has been loaded.",
@@ -216,6 +241,11 @@ class AddonPreferences(bpy.types.AddonPreferences):
 		split = layout.split()
 		split.prop(self, "printDebug")
 		split.prop(self, "useProjectPath")
+		box = layout.box()
+		box.label(text="Debug output")
+		box.prop(self, "logLevel")
+		box.row().prop(self, "logSubsystems")
+		box.prop(self, "logFile")
 		split = layout.split()
 		split.prop(self, "toolspath")
 		split.prop(self, "defaultPath")
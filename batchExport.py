@@ -0,0 +1,366 @@
+"""Headless batch exporting of many .blend files
+
+Usage (the manifest is a json file):
+
+	blender -b -P batchExport.py -- manifest.json [--jobs N] [--summary summary.json] [--blender path/to/blender]
+
+Manifest layout:
+
+	{
+		"options": { "apply_modifs": true },
+		"jobs": [
+			{
+				"blend": "chars/sonic.blend",
+				"collection": "Export",
+				"format": "SA2MDL",
+				"output": "out/sonic.sa2mdl",
+				"options": { "write_Specular": true, "stats": true }
+			}
+		]
+	}
+
+Relative paths are relative to the manifest. "collection" is optional;
+without it the entire scene gets exported. "options" on the top level
+are the defaults for every job and can be overridden per job.
+Supported options: apply_modifs, write_Specular, console_debug_output,
+optimize_CHUNK (SA2 only), quantize_GC and sort_GC (SA2B only) and stats
+(writes a .stats.json next to the output file).
+
+The addon gets loaded from the folder this script is in, even if another
+copy is installed for the blender executable that runs the batch. The
+jobs get grouped by .blend file, and each group is exported by a
+separate blender process. Up to N processes run in parallel. The results
+of every job are written to the summary file, and blender exits with
+code 1 if any job failed.
+"""
+
+import bpy
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import importlib
+import tempfile
+import subprocess
+from typing import List, Dict
+
+# format name: (file type, export format, default write_Specular)
+FORMATS = {
+	"SA1MDL": ('MDL', 'SA1', True),
+	"SA2MDL": ('MDL', 'SA2', False),
+	"SA2BMDL": ('MDL', 'SA2B', False),
+	"SA1LVL": ('LVL', 'SA1', True),
+	"SA2LVL": ('LVL', 'SA2', False),
+	"SA2BLVL": ('LVL', 'SA2B', False),
+}
+
+def getArguments() -> List[str]:
+	"""Returns the arguments passed after "--" to blender"""
+	if "--" in sys.argv:
+		return sys.argv[sys.argv.index("--") + 1:]
+	return list()
+
+def readManifest(filepath: str) -> List[dict]:
+	"""Reads the manifest and returns the validated jobs with absolute paths"""
+	with open(filepath, 'r') as f:
+		manifest = json.load(f)
+
+	baseDir = os.path.dirname(os.path.abspath(filepath))
+	defaults = manifest.get("options", dict())
+
+	jobs = list()
+	for i, j in enumerate(manifest.get("jobs", list())):
+		for key in ("blend", "format", "output"):
+			if key not in j:
+				raise ValueError("Job " + str(i) + " has no \"" + key + "\"")
+		fmt = j["format"].upper()
+		if fmt not in FORMATS:
+			raise ValueError("Job " + str(i) + " has an invalid format: " + j["format"])
+
+		options = dict(defaults)
+		options.update(j.get("options", dict()))
+
+		jobs.append({
+			"id": i,
+			"blend": os.path.normpath(os.path.join(baseDir, j["blend"])),
+			"collection": j.get("collection"),
+			"format": fmt,
+			"output": os.path.normpath(os.path.join(baseDir, j["output"])),
+			"options": options
+		})
+	return jobs
+
+# === worker ===
+
+def loadAddon():
+	"""Returns the addon package that this script belongs to, enabling it
+	if it isnt already"""
+	import addon_utils
+	scriptDir = os.path.dirname(os.path.realpath(__file__))
+	name = os.path.basename(scriptDir)
+
+	def checkLocation(module):
+		moduleDir = os.path.dirname(os.path.realpath(module.__file__))
+		if moduleDir != scriptDir:
+			raise RuntimeError("Addon \"" + name + "\" is loaded from "
+							   + moduleDir + " instead of " + scriptDir)
+
+	module = sys.modules.get(name)
+	if module is not None:
+		moduleDir = os.path.dirname(os.path.realpath(module.__file__))
+		if moduleDir == scriptDir and hasattr(bpy.types.Scene, "saSettings"):
+			return module
+		if moduleDir != scriptDir:
+			# another copy of the addon is enabled, which has to be
+			# replaced by the one this script belongs to
+			addon_utils.disable(name, default_set=False)
+			for m in [m for m in sys.modules if m == name or m.startswith(name + ".")]:
+				del sys.modules[m]
+
+	# making sure that the package gets imported from the folder of this
+	# script, and not from another installed copy of the addon
+	parentDir = os.path.dirname(scriptDir)
+	if parentDir in sys.path:
+		sys.path.remove(parentDir)
+	sys.path.insert(0, parentDir)
+
+	module = addon_utils.enable(name, default_set=False)
+	if module is None:
+		raise RuntimeError("Addon \"" + name + "\" could not be enabled")
+	checkLocation(module)
+	return module
+
+def selectCollection(collectionName: str):
+	"""Selects only the objects of the given collection"""
+	collection = bpy.data.collections.get(collectionName)
+	if collection is None:
+		raise ValueError("Collection \"" + collectionName + "\" not found")
+
+	viewLayer = bpy.context.view_layer
+	for o in viewLayer.objects:
+		o.select_set(False)
+
+	selected = 0
+	for o in collection.all_objects:
+		if o.name in viewLayer.objects:
+			o.select_set(True)
+			selected += 1
+
+	if selected == 0:
+		raise ValueError("Collection \"" + collectionName + "\" has no objects in the view layer")
+
+def exportJob(addon, job: dict) -> dict:
+	"""Exports a single job of the currently opened .blend file"""
+	# the package only imports the file modules when they are used
+	common = importlib.import_module(addon.__name__ + ".common")
+	exportStats = importlib.import_module(addon.__name__ + ".exportStats")
+	file_MDL = importlib.import_module(addon.__name__ + ".file_MDL")
+	file_LVL = importlib.import_module(addon.__name__ + ".file_LVL")
+
+	outType, exportFormat, writeSpecular = FORMATS[job["format"]]
+	options = job["options"]
+
+	keywords = {
+		"filepath": job["output"],
+		"export_format": exportFormat,
+		"write_Specular": options.get("write_Specular", writeSpecular),
+		"use_selection": job["collection"] is not None,
+		"apply_modifs": options.get("apply_modifs", True),
+		"console_debug_output": options.get("console_debug_output", False),
+		"quantize_GC": options.get("quantize_GC", False),
+		"sort_GC": options.get("sort_GC", False),
+		"optimize_CHUNK": options.get("optimize_CHUNK", False),
+	}
+
+	if job["collection"] is not None:
+		selectCollection(job["collection"])
+
+	outDir = os.path.dirname(job["output"])
+	if outDir != "" and not os.path.isdir(outDir):
+		os.makedirs(outDir)
+
+	useStats = options.get("stats", False)
+	if useStats:
+		exportStats.begin(job["output"], job["format"])
+
+	common.exportedFile = None
+	try:
+		if outType == 'MDL':
+			file_MDL.write(bpy.context, **keywords)
+		else:
+			file_LVL.write(bpy.context, **keywords)
+	except Exception:
+		fileW = common.exportedFile
+		if fileW is not None:
+			fileW.close()
+			os.remove(fileW.filepath)
+			common.exportedFile = None
+		exportStats.end(False)
+		raise
+
+	# moving the temporary file to the output
+	fileW = common.exportedFile
+	common.exportedFile = None
+	if os.path.isfile(job["output"]):
+		os.remove(job["output"])
+	shutil.move(fileW.filepath, job["output"])
+
+	result = {"size": os.path.getsize(job["output"])}
+
+	if useStats:
+		stats = exportStats.current
+		exportStats.end(True)
+		statsPath = job["output"] + ".stats.json"
+		stats.writeJson(statsPath)
+		result["stats"] = statsPath
+
+	return result
+
+def runWorker(jobFile: str, resultFile: str):
+	"""Exports all jobs of the .blend file that blender was started with"""
+	with open(jobFile, 'r') as f:
+		jobs = json.load(f)
+
+	addon = loadAddon()
+
+	results = list()
+	for i, job in enumerate(jobs):
+		if i > 0:
+			# exporting can alter the scene (e.g. adding color attributes),
+			# so every job should start from the saved file
+			bpy.ops.wm.revert_mainfile()
+
+		result = {
+			"id": job["id"],
+			"blend": job["blend"],
+			"collection": job["collection"],
+			"format": job["format"],
+			"output": job["output"],
+		}
+		start = time.perf_counter()
+		try:
+			result.update(exportJob(addon, job))
+			result["status"] = "ok"
+		except Exception as e:
+			result["status"] = "error"
+			result["message"] = type(e).__name__ + ": " + str(e)
+		result["time"] = time.perf_counter() - start
+		results.append(result)
+
+		print("[batch]", result["status"], job["output"])
+
+	with open(resultFile, 'w') as f:
+		json.dump(results, f)
+
+# === coordinator ===
+
+def runGroup(blender: str, blend: str, jobs: List[dict], tempDir: str, groupID: int) -> List[dict]:
+	"""Runs one blender process exporting all jobs of a .blend file"""
+	jobFile = os.path.join(tempDir, "jobs_" + str(groupID) + ".json")
+	resultFile = os.path.join(tempDir, "result_" + str(groupID) + ".json")
+	logFile = os.path.join(tempDir, "log_" + str(groupID) + ".txt")
+
+	with open(jobFile, 'w') as f:
+		json.dump(jobs, f)
+
+	args = [blender, "-b", blend,
+			"-P", os.path.realpath(__file__),
+			"--", "--worker", jobFile, "--result", resultFile]
+
+	with open(logFile, 'w') as log:
+		returnCode = subprocess.call(args, stdout=log, stderr=subprocess.STDOUT)
+
+	if os.path.isfile(resultFile):
+		with open(resultFile, 'r') as f:
+			return json.load(f)
+
+	# the process crashed before it could write its results
+	with open(logFile, 'r', errors="replace") as log:
+		lastLines = log.readlines()[-20:]
+
+	results = list()
+	for job in jobs:
+		results.append({
+			"id": job["id"],
+			"blend": job["blend"],
+			"collection": job["collection"],
+			"format": job["format"],
+			"output": job["output"],
+			"status": "error",
+			"message": "Blender exited with code " + str(returnCode) + ":\n" + "".join(lastLines),
+			"time": 0.0
+		})
+	return results
+
+def runBatch(manifest: str, jobCount: int, summaryPath: str, blender: str) -> bool:
+	"""Distributes the jobs of a manifest onto parallel blender processes"""
+	from concurrent.futures import ThreadPoolExecutor
+
+	jobs = readManifest(manifest)
+
+	groups: Dict[str, List[dict]] = dict()
+	for j in jobs:
+		groups.setdefault(j["blend"], list()).append(j)
+
+	start = time.perf_counter()
+	results = list()
+	with tempfile.TemporaryDirectory() as tempDir:
+		with ThreadPoolExecutor(max_workers=max(1, jobCount)) as executor:
+			futures = [executor.submit(runGroup, blender, b, g, tempDir, i)
+					   for i, (b, g) in enumerate(groups.items())]
+			for f in futures:
+				results.extend(f.result())
+
+	results.sort(key=lambda r: r["id"])
+	failed = sum(1 for r in results if r["status"] != "ok")
+
+	summary = {
+		"manifest": os.path.abspath(manifest),
+		"time": time.perf_counter() - start,
+		"processes": min(max(1, jobCount), len(groups)),
+		"succeeded": len(results) - failed,
+		"failed": failed,
+		"jobs": results
+	}
+
+	with open(summaryPath, 'w') as f:
+		json.dump(summary, f, indent=4)
+
+	print("[batch]", summary["succeeded"], "succeeded,", failed, "failed")
+	print("[batch] summary written to", summaryPath)
+	return failed == 0
+
+def main():
+	parser = argparse.ArgumentParser(
+		prog="blender -b -P batchExport.py --",
+		description="Exports SA model and level files from multiple .blend files")
+	parser.add_argument("manifest", nargs="?",
+		help="json file describing the export jobs")
+	parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+		help="amount of blender processes to run in parallel")
+	parser.add_argument("--summary", default=None,
+		help="where to write the result summary (default: <manifest>.summary.json)")
+	parser.add_argument("--blender", default=bpy.app.binary_path,
+		help="blender executable to use for the workers")
+	parser.add_argument("--worker", help=argparse.SUPPRESS)
+	parser.add_argument("--result", help=argparse.SUPPRESS)
+	args = parser.parse_args(getArguments())
+
+	if args.worker is not None:
+		runWorker(args.worker, args.result)
+		return
+
+	if args.manifest is None:
+		parser.error("no manifest given")
+
+	summary = args.summary
+	if summary is None:
+		summary = os.path.splitext(args.manifest)[0] + ".summary.json"
+
+	if not runBatch(args.manifest, args.jobs, summary, args.blender):
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
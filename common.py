@@ -5,10 +5,12 @@ import bpy
 import mathutils
 import math
 import queue
+import numpy
+import logging
 from typing import List, Dict, Tuple
-from . import fileHelper, enums
+from . import fileHelper, enums, exportStats, debugLog
 
-DO = False  # Debug Out
+log = debugLog.getLogger('COMMON')
 
 def get_path():
     return os.path.dirname(os.path.realpath(__file__))
@@ -42,25 +44,183 @@ def BAMSToRad(v: int, shortRot=False) -> float:
 		v &= 0xFFFF
 	return float(v / (65536.0 / (2 * math.pi)))
 
-def getDistinctwID(items: list):
-
-	distinct = list()
-	IDs = [0] * len(items)
-
-	for i, o in enumerate(items):
-		found = None
-		for j, d in enumerate(distinct):
-			if o == d:
-				found = j
-				break
-		if found is None:
-			distinct.append(o)
-			IDs[i] = len(distinct) - 1
+def getDistinctwID(items: list, hashable: bool = False):
+	"""Returns the distinct items and the index of every item in them.
+
+	Hashable items are looked up in a dictionary, everything else gets
+	compared to every distinct item"""
+
+	with exportStats.stage("dedup") as stage:
+		distinct = list()
+		IDs = [0] * len(items)
+
+		if hashable:
+			lookup = dict()
+			for i, o in enumerate(items):
+				found = lookup.get(o)
+				if found is None:
+					found = len(distinct)
+					lookup[o] = found
+					distinct.append(o)
+				IDs[i] = found
 		else:
-			IDs[i] = found
+			for i, o in enumerate(items):
+				found = None
+				for j, d in enumerate(distinct):
+					if o == d:
+						found = j
+						break
+				if found is None:
+					distinct.append(o)
+					IDs[i] = len(distinct) - 1
+				else:
+					IDs[i] = found
+
+		stage.add("items", len(items))
+		stage.add("distinct", len(distinct))
 
 	return distinct, IDs
 
+def getDistinctRows(rows: numpy.ndarray):
+	"""Array version of getDistinctwID; returns the distinct rows
+	(in order of first appearance) and the index of every row in them"""
+	rows = numpy.asarray(rows)
+	if len(rows) == 0:
+		return rows, numpy.zeros(0, dtype=numpy.int64)
+
+	distinct, first, inverse = numpy.unique(rows,
+											axis=0,
+											return_index=True,
+											return_inverse=True)
+	order = numpy.argsort(first)
+	rank = numpy.empty_like(order)
+	rank[order] = numpy.arange(len(order))
+	return distinct[order], rank[inverse.reshape(-1)]
+
+def stripsToTriangles(sizes: numpy.ndarray,
+					  reverse: numpy.ndarray) -> numpy.ndarray:
+	"""Converts triangle strips to a triangle list
+
+	sizes holds the corner count of every strip, reverse whether the
+	first triangle of a strip is flipped. Returns the corners of every
+	triangle (shape (triangle count, 3)) as indices into the
+	concatenated strip corners
+	"""
+	sizes = numpy.asarray(sizes, dtype=numpy.int64)
+	reverse = numpy.asarray(reverse, dtype=bool)
+
+	# every corner after the second one adds a triangle
+	triCounts = numpy.maximum(sizes - 2, 0)
+	starts = numpy.cumsum(sizes) - sizes
+	stripIDs = numpy.repeat(numpy.arange(len(sizes)), triCounts)
+	triStarts = numpy.cumsum(triCounts) - triCounts
+	local = numpy.arange(len(stripIDs)) - triStarts[stripIDs]
+
+	first = starts[stripIDs] + local
+	tris = numpy.stack((first, first + 1, first + 2), axis=1)
+
+	# the winding order flips with every triangle
+	flip = reverse[stripIDs] ^ (local & 1).astype(bool)
+	tris[flip] = tris[flip][:, [1, 0, 2]]
+	return tris
+
+def buildMesh(mesh: bpy.types.Mesh,
+			  positions: numpy.ndarray,
+			  triangles: numpy.ndarray,
+			  materialIDs: numpy.ndarray,
+			  uvs: numpy.ndarray = None,
+			  colors: numpy.ndarray = None,
+			  normals: numpy.ndarray = None) -> int:
+	"""Fills an empty mesh with triangles
+
+	positions: vertex positions (blender space), shape (vertices, 3)
+	triangles: vertex indices, shape (triangles, 3)
+	materialIDs: material slot of every triangle
+	uvs: uv of every triangle corner, shape (triangles, 3, 2)
+	colors: color of every triangle corner, shape (triangles, 3, 4)
+	normals: custom normal of every vertex, shape (vertices, 3)
+
+	Degenerate and duplicate triangles are removed. Returns the
+	amount of removed duplicates
+	"""
+	positions = numpy.asarray(positions, dtype=numpy.float32).reshape(-1, 3)
+	triangles = numpy.asarray(triangles, dtype=numpy.int32).reshape(-1, 3)
+	materialIDs = numpy.asarray(materialIDs, dtype=numpy.int32)
+
+	valid = (triangles[:, 0] != triangles[:, 1]) \
+		& (triangles[:, 1] != triangles[:, 2]) \
+		& (triangles[:, 0] != triangles[:, 2])
+
+	outOfRange = ((triangles < 0) | (triangles >= len(positions))).any(axis=1)
+	if outOfRange.any():
+		log.warning("Invalid triangles: %i reference missing vertices",
+					outOfRange.sum())
+		valid &= ~outOfRange
+
+	# triangles using the same vertices are duplicates (regardless
+	# of their winding order); the first one is kept
+	doubleFaces = 0
+	if valid.any():
+		validIDs = numpy.flatnonzero(valid)
+		unique = numpy.unique(numpy.sort(triangles[validIDs], axis=1),
+							  axis=0,
+							  return_index=True)[1]
+		doubleFaces = len(validIDs) - len(unique)
+		keep = numpy.sort(validIDs[unique])
+	else:
+		keep = numpy.zeros(0, dtype=numpy.int64)
+
+	triangles = triangles[keep]
+	triCount = len(triangles)
+	loopCount = triCount * 3
+
+	mesh.vertices.add(len(positions))
+	mesh.vertices.foreach_set("co", positions.ravel())
+
+	mesh.loops.add(loopCount)
+	mesh.loops.foreach_set("vertex_index", triangles.ravel())
+
+	mesh.polygons.add(triCount)
+	mesh.polygons.foreach_set(
+		"loop_start", numpy.arange(0, loopCount, 3, dtype=numpy.int32))
+	# the addon uses the 3.x mesh api (see bl_info); later 3.x versions
+	# derive loop_total from loop_start and made it read only
+	if not mesh.polygons.bl_rna.properties["loop_total"].is_readonly:
+		mesh.polygons.foreach_set(
+			"loop_total", numpy.full(triCount, 3, dtype=numpy.int32))
+	mesh.polygons.foreach_set("material_index", materialIDs[keep])
+	mesh.polygons.foreach_set("use_smooth", numpy.ones(triCount, dtype=bool))
+
+	mesh.update(calc_edges=True)
+
+	if uvs is not None:
+		uvLayer = mesh.uv_layers.new(name="UV0")
+		uvLayer.data.foreach_set(
+			"uv", numpy.asarray(uvs, dtype=numpy.float32)[keep].ravel())
+
+	if colors is not None:
+		colorLayer = mesh.vertex_colors.new(name="COL0")
+		colorLayer.data.foreach_set(
+			"color", numpy.asarray(colors, dtype=numpy.float32)[keep].ravel())
+
+	# dont ask me why, but blender likes to add sharp edges-
+	# we dont need those at all in this case
+	mesh.edges.foreach_set(
+		"use_edge_sharp", numpy.zeros(len(mesh.edges), dtype=bool))
+
+	if normals is not None:
+		# reshaping, so that attaches without vertices work too
+		normals = numpy.asarray(normals, dtype=numpy.float32).reshape(-1, 3)
+		lengths = numpy.linalg.norm(normals, axis=1, keepdims=True)
+		normals = normals / numpy.where(lengths > 0, lengths, 1)
+		mesh.create_normals_split()
+		mesh.normals_split_custom_set_from_vertices(normals)
+
+	mesh.use_auto_smooth = True
+	mesh.auto_smooth_angle = 180
+
+	return doubleFaces
+
 class ExportError(Exception):
 
 	def __init__(self, message):
@@ -232,10 +392,7 @@ class BoundingBox:
 
 		center = Vector3((0,0,0))
 		for v in vertices:
-			print(v.co)
 			vert = Vector3((v.co[0], v.co[1], v.co[2]))
-			print(vert)
-			print(center)
 			center = self.vecAdd((vert), (center))
 			
 		center /= float(len(vertices))
@@ -655,10 +812,96 @@ class ModelData:
 			fileW.wUInt(self.getSA1SurfaceFlags().value
 						| int("0x" + self.saProps["userFlags"], 0))
 
+class VertexWeights:
+	"""The vertex group weights of a mesh as a sparse (CSR) matrix.
+	Vertex i has the weights weights[indptr[i]:indptr[i + 1]] for the
+	vertex groups groups[indptr[i]:indptr[i + 1]]. Only positive weights
+	are stored"""
+
+	indptr: numpy.ndarray
+	groups: numpy.ndarray
+	weights: numpy.ndarray
+
+	def __init__(self,
+				 indptr: numpy.ndarray,
+				 groups: numpy.ndarray,
+				 weights: numpy.ndarray):
+		self.indptr = indptr
+		self.groups = groups
+		self.weights = weights
+
+	@classmethod
+	def fromMesh(cls, mesh: bpy.types.Mesh, groups=None) -> 'VertexWeights':
+		"""Reads the weights of the given vertex group indices (all if None)"""
+		counts = numpy.zeros(len(mesh.vertices) + 1, dtype=numpy.int64)
+		groupList = list()
+		weightList = list()
+		for v in mesh.vertices:
+			count = 0
+			for g in v.groups:
+				if g.weight > 0 and (groups is None or g.group in groups):
+					groupList.append(g.group)
+					weightList.append(g.weight)
+					count += 1
+			counts[v.index + 1] = count
+
+		return VertexWeights(numpy.cumsum(counts),
+							 numpy.array(groupList, dtype=numpy.int64),
+							 numpy.array(weightList, dtype=numpy.float64))
+
+	@property
+	def vertexCount(self) -> int:
+		return len(self.indptr) - 1
+
+	def rows(self) -> numpy.ndarray:
+		"""The vertex index of every stored weight"""
+		return numpy.repeat(numpy.arange(self.vertexCount), numpy.diff(self.indptr))
+
+	def weighted(self) -> numpy.ndarray:
+		"""Mask of the vertices that have at least one weight"""
+		return numpy.diff(self.indptr) > 0
+
+	def usedGroups(self) -> List[int]:
+		"""The vertex groups that at least one vertex has a weight for"""
+		return numpy.unique(self.groups).tolist()
+
+	def normalized(self) -> 'VertexWeights':
+		"""Returns the weights scaled so that they add up to 1 per vertex"""
+		rows = self.rows()
+		sums = numpy.bincount(rows, self.weights, minlength=self.vertexCount)
+		return VertexWeights(self.indptr, self.groups, self.weights / sums[rows])
+
+	def toDense(self, groups: List[int]) -> numpy.ndarray:
+		"""Returns a (vertex, group) matrix with a column for every
+		given group index. Columns of unknown groups stay 0"""
+		dense = numpy.zeros((self.vertexCount, len(groups)))
+		if len(self.groups) == 0:
+			return dense
+
+		columns = numpy.full(max(self.groups.max(), max(groups, default=0)) + 1, -1)
+		for i, g in enumerate(groups):
+			if g >= 0:
+				columns[g] = i
+		columns = columns[self.groups]
+		used = columns >= 0
+		dense[self.rows()[used], columns[used]] = self.weights[used]
+		return dense
+
+	@staticmethod
+	def weightStatuses(count: int) -> List[enums.WeightStatus]:
+		"""The weight status of every vertex chunk in a row of count chunks
+		that blend into the same vertex buffer"""
+		if count == 1:
+			return [enums.WeightStatus.Start]
+		return [enums.WeightStatus.Start] \
+			+ [enums.WeightStatus.Middle] * (count - 2) \
+			+ [enums.WeightStatus.End]
+
 class ArmatureMesh:
 	model: ModelData
 	indexBufferOffset: int
 	weightMap: Dict[str, Tuple[int, enums.WeightStatus]]
+	weights: VertexWeights  # only set for meshes deformed by the armature
 
 	# a weightindex of -1 indicates to write the entire mesh
 	# and an index of -2 means to write only unweighted vertices
@@ -666,10 +909,12 @@ class ArmatureMesh:
 	def __init__(self,
 				 model: ModelData,
 				 indexBufferOffset: int,
-				 weightMap: Dict[str, Tuple[int, enums.WeightStatus]]):
+				 weightMap: Dict[str, Tuple[int, enums.WeightStatus]],
+				 weights: VertexWeights = None):
 		self.model = model
 		self.indexBufferOffset = indexBufferOffset
 		self.weightMap = weightMap
+		self.weights = weights
 
 class Bone:
 
@@ -853,17 +1098,14 @@ class Armature(ModelData):
 		if len(root.children) > 0:
 			root.child = root.children[0]
 
-		if DO:
-			print(" == Bone Hierarchy == \n")
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug(" == Bone Hierarchy == \n")
 			for b in bones:
 				marker = " "
 				for r in range(b.hierarchyDepth):
 					marker += "- "
-				if len(marker) > 1:
-					print(marker, b.name)
-				else:
-					print("", b.name)
-			print(" - - - -\n")
+				log.debug("%s %s", marker, b.name)
+			log.debug(" - - - -\n")
 
 		# now, time to get the mesh data
 		# first we need to get all objects that the armature modifies
@@ -915,6 +1157,7 @@ class Armature(ModelData):
 					break
 
 			weightMap = dict()
+			weights = None
 			obj = o.origObject
 
 			if case1:
@@ -926,51 +1169,24 @@ class Armature(ModelData):
 							usedBoneGroups[b] = g
 							break
 
-				usedGroups = [g.index for g in usedBoneGroups.values()]
-
-				setStart = False
-				last = None
-				# checking valid weight groups
-				validGroups = list()
-				emptyVertsFound = False
-				for v in mesh.vertices:
-					found = False
-					for g in v.groups:
-						if g.group in usedGroups and g.weight > 0:
-							found = True
-							if g.group not in validGroups:
-								validGroups.append(g.group)
-					if not found:
-						emptyVertsFound = True
-				usedGroups = validGroups
-
-				validBoneGroups: Dict[Bone, bpy.types.VertexGroup] = dict()
-				for b, g in usedBoneGroups.items():
-					if g.index in usedGroups:
-						validBoneGroups[b] = g
-				usedBoneGroups = validBoneGroups
-
-				if emptyVertsFound:
-					weightMap[root.name] = [-2, enums.WeightStatus.Start]
-					setStart = True
-					last = root.name
-
-				for b, g in usedBoneGroups.items():
-					weightMap[b.name] = [g.index,
-										 enums.WeightStatus.Middle if setStart
-										 else enums.WeightStatus.Start]
-					setStart = True
-					last = b.name
-
-				if len(weightMap) == 0:
+				weights = VertexWeights.fromMesh(
+					mesh, {g.index for g in usedBoneGroups.values()})
+
+				# only groups that actually have weights are of interest
+				usedGroups = weights.usedGroups()
+				entries = [(b.name, g.index) for b, g in usedBoneGroups.items()
+						   if g.index in usedGroups]
+				if not weights.weighted().all():
+					entries.insert(0, (root.name, -2))
+
+				if len(entries) == 0:
 					weightMap[root.name] = [-1, enums.WeightStatus.Start]
-				elif len(weightMap) == 1:
-					weightMap[list(weightMap.keys())[0]] = \
-						[-1, enums.WeightStatus.Start]
-				elif len(weightMap) > 1:
-					weightMap[last] = \
-						[weightMap[last][0],
-						 enums.WeightStatus.End]
+				elif len(entries) == 1:
+					weightMap[entries[0][0]] = [-1, enums.WeightStatus.Start]
+				else:
+					statuses = VertexWeights.weightStatuses(len(entries))
+					for (name, index), status in zip(entries, statuses):
+						weightMap[name] = [index, status]
 
 			elif len(o.origObject.parent_bone) > 0:
 				weightMap[o.origObject.parent_bone] = \
@@ -981,13 +1197,14 @@ class Armature(ModelData):
 			armatureMeshes.append(
 				ArmatureMesh(o,
 							 meshesWOffset[mesh],
-							 weightMap))
-		if DO:
+							 weightMap,
+							 weights))
+		if log.isEnabledFor(logging.DEBUG):
 			for a in armatureMeshes:
-				print("  " + a.model.name, a.indexBufferOffset)
+				log.debug("  %s %i", a.model.name, a.indexBufferOffset)
 				for k in a.weightMap.keys():
-					print("    " + k, a.weightMap[k])
-			print("")
+					log.debug("    %s %s", k, a.weightMap[k])
+			log.debug("")
 
 		boneMap: Dict[str, mathutils.Matrix] = dict()
 		for b in bones:
@@ -995,25 +1212,31 @@ class Armature(ModelData):
 
 		# converting mesh data
 		from . import format_CHUNK
-		boneAttaches = format_CHUNK.fromWeightData(boneMap,
-												   armatureMeshes,
-												   export_matrix,
-												   materials)
+		with exportStats.stage("chunks") as stage:
+			boneAttaches = format_CHUNK.fromWeightData(boneMap,
+													   armatureMeshes,
+													   export_matrix,
+													   materials)
+			stage.add("meshes", len(armatureMeshes))
 
-		# writing mesh data
-		for b in bones:
-			b.meshPtr = 0
-			if b.name not in boneAttaches:
-				continue
-			mesh = boneAttaches[b.name]
-			b.meshPtr = mesh.write(fileW, labels)
+		with exportStats.stage("writing") as stage:
+			start = fileW.tell()
+
+			# writing mesh data
+			for b in bones:
+				b.meshPtr = 0
+				if b.name not in boneAttaches:
+					continue
+				mesh = boneAttaches[b.name]
+				b.meshPtr = mesh.write(fileW, labels)
+
+			log.debug("\n - - - -")
 
-		if DO:
-			print("\n - - - -")
+			# writing object data
+			for b in reversed(bones):
+				b.write(fileW, labels)
 
-		# writing object data
-		for b in reversed(bones):
-			b.write(fileW, labels)
+			stage.add("bytes", fileW.tell() - start)
 
 		return bones[0].objectPtr
 
@@ -1024,8 +1247,6 @@ def convertObjectData(context: bpy.types.Context,
 					  fmt: str,
 					  lvl: bool):
 
-	global DO
-
 	# gettings the objects to export
 	if use_selection:
 		objects = context.selected_objects
@@ -1035,51 +1256,53 @@ def convertObjectData(context: bpy.types.Context,
 	if len(objects) == 0:
 		raise ExportError("No objects to export")
 
-	# getting the objects without parents
-	noParents = list()
-	for o in objects:
-		if (o.type == 'EMPTY') or (o.type == 'MESH') or (o.type == 'ARMATURE'):
-			if o.parent is None or not (o.parent in objects):
-				noParents.append(o)
-
-	# correct object order
-	# sort top level objects first
-	noParents.sort(key=lambda x: x.name)
-
-	# sort children recursively and convert them to ModelData objects
-	modelData: List[ModelData] = list()
-	parent = None
-	hierarchyDepth = 0
-	if not lvl:
-		if len(noParents) > 1:
-			parent = ModelData(None,
-							   None,
-							   0,
-							   "root",
-							   export_matrix,
-							   False,
-							   False)
-			modelData.append(parent)
-			hierarchyDepth = 1
+	with exportStats.stage("collection") as stage:
+		# getting the objects without parents
+		noParents = list()
+		for o in objects:
+			if (o.type == 'EMPTY') or (o.type == 'MESH') or (o.type == 'ARMATURE'):
+				if o.parent is None or not (o.parent in objects):
+					noParents.append(o)
+
+		# correct object order
+		# sort top level objects first
+		noParents.sort(key=lambda x: x.name)
+
+		# sort children recursively and convert them to ModelData objects
+		modelData: List[ModelData] = list()
+		parent = None
+		hierarchyDepth = 0
+		if not lvl:
+			if len(noParents) > 1:
+				parent = ModelData(None,
+								   None,
+								   0,
+								   "root",
+								   export_matrix,
+								   False,
+								   False)
+				modelData.append(parent)
+				hierarchyDepth = 1
 
-	lastSibling = None
-	for o in noParents:
-		current = sortChildren(o,
-							   objects,
-							   parent,
-							   hierarchyDepth,
-							   export_matrix,
-							   fmt,
-							   lvl,
-							   modelData)
-		if lastSibling is not None:
-			lastSibling.sibling = current
-		lastSibling = current
+		lastSibling = None
+		for o in noParents:
+			current = sortChildren(o,
+								   objects,
+								   parent,
+								   hierarchyDepth,
+								   export_matrix,
+								   fmt,
+								   lvl,
+								   modelData)
+			if lastSibling is not None:
+				lastSibling.sibling = current
+			lastSibling = current
 
-	if parent is not None:
-		parent.child = parent.children[0]
+		if parent is not None:
+			parent.child = parent.children[0]
 
-	objects = modelData
+		objects = modelData
+		stage.add("objects", len(modelData))
 
 	# get meshes
 	if not lvl or lvl and fmt == 'SA1':
@@ -1118,12 +1341,12 @@ def convertObjectData(context: bpy.types.Context,
 				objects = newObjects
 				meshes = list()
 
-		if DO:
-			print(" == Exporting ==")
-			print("  Materials:", len(materials))
-			print("  Meshes:", len(meshes))
-			print("  Objects:", len(objects))
-			print("  - - - - - -\n")
+		log.debug(" == Exporting ==\n"
+				  "  Materials: %i\n"
+				  "  Meshes: %i\n"
+				  "  Objects: %i\n"
+				  "  - - - - - -\n",
+				  len(materials), len(meshes), len(objects))
 
 		return objects, meshes, materials, mObjects
 
@@ -1184,13 +1407,13 @@ def convertObjectData(context: bpy.types.Context,
 
 		ModelData.updateMeshes(objects, meshes)
 
-		if DO:
-			print(" == Exporting ==")
-			print("  Materials:", len(materials))
-			print("  Visual Meshes:", len(vMeshes))
-			print("  Collision Meshes:", len(cMeshes))
-			print("  Objects:", len(objects))
-			print("  - - - - - -\n")
+		log.debug(" == Exporting ==\n"
+				  "  Materials: %i\n"
+				  "  Visual Meshes: %i\n"
+				  "  Collision Meshes: %i\n"
+				  "  Objects: %i\n"
+				  "  - - - - - -\n",
+				  len(materials), len(vMeshes), len(cMeshes), len(objects))
 
 		return objects, cMeshes, vMeshes, materials, cObjects, vObjects
 
@@ -1353,9 +1576,14 @@ def getMeshes(meshesToConvert: List[ModelData],
 		ob_for_convert = obj.evaluated_get(depsgraph) if t_apply_modifs \
 			else obj.original
 
-		me = ob_for_convert.to_mesh(preserve_all_data_layers=True,
-									depsgraph=depsgraph)
-		trianglulateMesh(me)
+		with exportStats.stage("modifiers") as stage:
+			me = ob_for_convert.to_mesh(preserve_all_data_layers=True,
+										depsgraph=depsgraph)
+			stage.add("meshes")
+
+		with exportStats.stage("triangulation") as stage:
+			trianglulateMesh(me)
+			stage.add("loops", len(me.loops))
 
 		if obj in addESplit:
 			obj.modifiers.remove(addESplit[obj])
@@ -1440,32 +1668,41 @@ def trianglulateMesh(mesh: bpy.types.Mesh):
 				polygons.remove(p)
 
 		if len(polygons) > 0:
-			print("\ntriangulating went wrong?", len(polygons))
+			log.warning("Triangulating went wrong? %i polygons left", len(polygons))
 		else:
 			mesh.normals_split_custom_set(splitNormals)
 
 def getNormalData(mesh: bpy.types.Mesh) -> list():
-	normals = list()
-	if mesh.use_auto_smooth:
-		mesh.calc_normals_split()
-		for v in mesh.vertices:
-			normal = mathutils.Vector((0, 0, 0))
-			normalCount = 0
-			for l in mesh.loops:
-				if l.vertex_index == v.index:
-					normal += l.normal
-					normalCount += 1
-			if normalCount == 0:
-				normals.append(v.normal)
-			else:
-				normals.append(normal / normalCount)
+	with exportStats.stage("normals") as stage:
+		normals = list()
+		if mesh.use_auto_smooth:
+			mesh.calc_normals_split()
+			for v in mesh.vertices:
+				normal = mathutils.Vector((0, 0, 0))
+				normalCount = 0
+				for l in mesh.loops:
+					if l.vertex_index == v.index:
+						normal += l.normal
+						normalCount += 1
+				if normalCount == 0:
+					normals.append(v.normal)
+				else:
+					normals.append(normal / normalCount)
 
-		mesh.free_normals_split()
-	else:
-		for v in mesh.vertices:
-			normals.append(v.normal)
+			mesh.free_normals_split()
+		else:
+			for v in mesh.vertices:
+				normals.append(v.normal)
+		stage.add("vertices", len(normals))
 	return normals
 
+def writeAttach(mesh, fileW: fileHelper.FileWriter, labels: dict, meshDict: dict):
+	"""Writes an attach of any format and records the written bytes"""
+	with exportStats.stage("writing") as stage:
+		start = fileW.tell()
+		mesh.write(fileW, labels, meshDict)
+		stage.add("bytes", fileW.tell() - start)
+
 def writeMethaData(fileW: fileHelper.FileWriter,
 				   labels: dict,
 				   scene: bpy.types.Scene,
@@ -1478,12 +1715,11 @@ def writeMethaData(fileW: fileHelper.FileWriter,
 	sizeLoc = fileW.tell()
 	fileW.wUInt(0)
 
-	global DO
-	if DO:
-		print(" == Labels ==")
+	if log.isEnabledFor(logging.DEBUG):
+		log.debug(" == Labels ==")
 		for v, k in labels.items():
-			print("  ", k + ":", hex4(v))
-		print("")
+			log.debug("   %s: %s", k, hex4(v))
+		log.debug("")
 
 	# placeholders
 	for l in labels:
@@ -1529,8 +1765,7 @@ def writeMethaData(fileW: fileHelper.FileWriter,
 		fileW.wUInt(size)
 		fileW.seek(0, 2)
 
-		if DO:
-			print(" Author:", settings.author)
+		log.debug(" Author: %s", settings.author)
 
 	# === DESCRIPTION ===
 	if not (settings.description == ""):
@@ -1544,8 +1779,7 @@ def writeMethaData(fileW: fileHelper.FileWriter,
 		fileW.wUInt(size)
 		fileW.seek(0, 2)
 
-		if DO:
-			print(" Description:", settings.description)
+		log.debug(" Description: %s", settings.description)
 
 	fileW.wUInt(enums.Chunktypes.End.value)
 	fileW.wUInt(0)
@@ -1566,10 +1800,8 @@ def polyToTris(p: list) -> list:
 
 	for i in range(triCount):
 		if not rev:
-			print(cP, cP + 1, cN)
 			out.append((p[cP], p[cP + 1], p[cN]))
 		else:
-			print(cP, cN - 1, cN)
 			out.append((p[cP], p[cN - 1], p[cN]))
 
 		rev = not rev
@@ -1616,21 +1848,27 @@ class Model:
 		self.meshes = list()
 
 	def debug(self):
-		print(f"  Model: {self.name}")
-		print(f"    objectFlags: {self.objFlags}")
-		print(f"    meshPtr: {hex4(self.meshPtr)}")
-		print(f"    position: {Vector3(self.matrix_local.to_translation())}")
+		if not log.isEnabledFor(logging.DEBUG):
+			return
 		rot = self.matrix_local.to_euler()
-		print(f"    rotation: ({rot.x},{rot.y},{rot.z})")
-		print(f"    scale: {Vector3(self.matrix_local.to_scale())}")
-
-def readObjects(fileR:
-				fileHelper.FileReader,
-				address: int,
-				hierarchyDepth: int,
-				parent,
-				labels: dict,
-				result: list) -> Model:
+		log.debug("  Model: %s\n"
+				  "    objectFlags: %s\n"
+				  "    meshPtr: %s\n"
+				  "    position: %s\n"
+				  "    rotation: (%f,%f,%f)\n"
+				  "    scale: %s",
+				  self.name,
+				  self.objFlags,
+				  hex4(self.meshPtr),
+				  Vector3(self.matrix_local.to_translation()),
+				  rot.x, rot.y, rot.z,
+				  Vector3(self.matrix_local.to_scale()))
+
+def readObject(fileR: fileHelper.FileReader,
+			   address: int,
+			   parent: Model,
+			   labels: dict) -> Model:
+	"""Reads a single object, without its child and sibling"""
 
 	if address in labels:
 		label: str = labels[address]
@@ -1672,7 +1910,9 @@ def readObjects(fileR:
 		fileR.rFloat(address + 12))
 
 	posMtx = mathutils.Matrix.Translation(pos)
-	print(name + ' rot: ' + str(math.degrees(xRot)) + ', ' + str(math.degrees(-zRot)) + ', ' + str(math.degrees(yRot)))
+	if log.isEnabledFor(logging.DEBUG):
+		log.debug("%s rot: %f, %f, %f", name,
+				  math.degrees(xRot), math.degrees(-zRot), math.degrees(yRot))
 	rotMtx = mathutils.Euler((xRot, -zRot, yRot), 'XZY').to_matrix().to_4x4()
 	scaleMtx = matrixFromScale(
 		(fileR.rFloat(address + 32),
@@ -1686,36 +1926,88 @@ def readObjects(fileR:
 	else:
 		matrix_world = matrix_local.copy()
 
-	model = Model(name,
-				objFlags,
-				meshPtr,
-				matrix_world,
-				matrix_local,
-				parent)
-	if result is not None:
-		result.append(model)
+	return Model(name,
+				 objFlags,
+				 meshPtr,
+				 matrix_world,
+				 matrix_local,
+				 parent)
 
-	childPtr = fileR.rUInt(address + 44)
-	if childPtr > 0:
-		child = readObjects(fileR,
-							childPtr,
-							hierarchyDepth + 1,
-							model,
-							labels,
-							result)
-		model.child = child
-
-	siblingPtr = fileR.rUInt(address + 48)
-	if siblingPtr > 0:
-		sibling = readObjects(fileR,
-							siblingPtr,
-							hierarchyDepth,
-							parent,
-							labels,
-							result)
-		model.sibling = sibling
+def readObjects(fileR:
+				fileHelper.FileReader,
+				address: int,
+				parent,
+				labels: dict,
+				result: list) -> Model:
+	"""Reads an object with its children and siblings, which get added to
+	result in depth first order (object, children, siblings).
 
-	return model
+	Uses an explicit stack, so long sibling chains dont hit the recursion
+	limit. Pointers outside of the file and pointers to objects that were
+	already read (cycles) are skipped with a warning"""
+
+	fileSize = len(fileR.fileC)
+	visited = set()
+	root = None
+
+	# address, parent, object that points to it and the pointer field
+	stack = [(address, parent, None, None)]
+	while len(stack) > 0:
+		address, parent, referrer, field = stack.pop()
+
+		if address + 52 > fileSize:
+			log.warning("Object address %s is outside of the file", hex4(address))
+			continue
+		if address in visited:
+			log.warning("Object %s is referenced more than once, skipping it",
+						labels.get(address, hex4(address)))
+			continue
+		visited.add(address)
+
+		model = readObject(fileR, address, parent, labels)
+		if referrer is None:
+			root = model
+		else:
+			setattr(referrer, field, model)
+		if result is not None:
+			result.append(model)
+
+		# the sibling goes first, so that the children get read before it
+		siblingPtr = fileR.rUInt(address + 48)
+		if siblingPtr > 0:
+			stack.append((siblingPtr, parent, model, "sibling"))
+
+		childPtr = fileR.rUInt(address + 44)
+		if childPtr > 0:
+			stack.append((childPtr, model, model, "child"))
+
+	return root
+
+def readObjectList(fileR: fileHelper.FileReader,
+				   nodes: List[Tuple[int, int, int, str]],
+				   labels: dict) -> List[Model]:
+	"""Reads the objects found by FileIndex.addObjects, in the same order
+	and with the same links as readObjects, without walking the hierarchy
+	a second time"""
+	models: Dict[int, Model] = dict()
+	result = list()
+	for address, parentAddress, referrer, field in nodes:
+		model = readObject(fileR, address, models.get(parentAddress), labels)
+		if field is not None:
+			setattr(models[referrer], field, model)
+		models[address] = model
+		result.append(model)
+	return result
+
+def getHierarchyArrays(models: List[Model]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""Returns the hierarchy of the models (as read by readObjects) as
+	flat arrays: the parent index of every model (-1 for none) and the
+	(n, 4, 4) local matrices. Parents always come before their children"""
+	indices = {id(m): i for i, m in enumerate(models)}
+	parents = numpy.array([-1 if m.parent is None else indices.get(id(m.parent), -1)
+						   for m in models], dtype=numpy.int32)
+	matrices = numpy.array([m.matrix_local for m in models], dtype=numpy.float64)
+	return parents, matrices.reshape(-1, 4, 4)
 
 class Col:
 	saProps: dict
@@ -1837,8 +2129,8 @@ class Col:
 			try:
 				flagTest = SA2SurfaceFlags(f)
 			except Exception:
-				print("Unknown surface flags found:")
-				print(saProps["userFlags"])
+				log.warning("Unknown surface flags found: %s",
+							saProps["userFlags"])
 
 		else:
 			objectPtr = fileR.rUInt(address + 8)
@@ -1928,10 +2220,10 @@ class Col:
 			try:
 				flagTest = SA1SurfaceFlags(f)
 			except Exception:
-				print("Unknown surface flags found:")
-				print(saProps["userFlags"])
+				log.warning("Unknown surface flags found: %s",
+							saProps["userFlags"])
 
-		model = readObjects(fileR, objectPtr, 0, None, labels, None)
+		model = readObjects(fileR, objectPtr, None, labels, None)
 
 		return Col(unknown1, unknown2, saProps, model)
 
@@ -1945,6 +2237,57 @@ class Col:
 
 		return obj
 
+class MaterialCache:
+	"""Maps material dictionaries (see SAMaterialSettings.getDefaultMatDict)
+	to the blender materials created for them.
+
+	One cache is shared by all attaches of an import session, so that
+	identical materials are only created once"""
+
+	materials: Dict[tuple, bpy.types.Material]
+	counts: Dict[str, int]
+
+	def __init__(self):
+		self.materials = dict()
+		self.counts = dict()
+
+	@classmethod
+	def getKey(cls, matDict: dict) -> tuple:
+		"""Returns a canonical, hashable version of a material dictionary.
+		Floats get rounded, so that values stored in blender properties
+		(single precision) still match the imported ones"""
+		items = list()
+		for k, v in sorted(matDict.items()):
+			if isinstance(v, float):
+				v = round(v, 4)
+			elif not isinstance(v, (str, int)):
+				v = tuple(round(c, 4) for c in v)
+			items.append((k, v))
+		return tuple(items)
+
+	def addExisting(self):
+		"""Adds the materials that already exist in the blend file,
+		so that they get reused by the import"""
+		for m in bpy.data.materials:
+			prefix = "collision_" if m.name.startswith("collision_") \
+				else "material_"
+			key = (prefix, MaterialCache.getKey(m.saSettings.toDictionary()))
+			if key not in self.materials:
+				self.materials[key] = m
+
+	def get(self, matDict: dict, prefix: str = "material_") -> bpy.types.Material:
+		"""Returns the material for the dictionary, creating it if necessary"""
+		key = (prefix, MaterialCache.getKey(matDict))
+		material = self.materials.get(key)
+		if material is None:
+			count = self.counts.get(prefix, 0)
+			self.counts[prefix] = count + 1
+
+			material = bpy.data.materials.new(name=prefix + str(count))
+			material.saSettings.readMatDict(matDict)
+			self.materials[key] = material
+		return material
+
 def fixMaterialNames(objects: List[bpy.types.Object]):
 
 	materials: List[bpy.types.Material] = list()
@@ -2005,8 +2348,7 @@ def PGetAngleXZFromNormal(px: float, py: float, pz: float):
 
 	retx = float((angx/65535.0)*360.0)
 	retz = float((angz/65535.0)*360.0)
-	print(str(retx))
-	print(str(retz))
+	log.debug("%f %f", retx, retz)
 	return [retx, retz]
 
 def GetColor(saShader, type, oldColor):
@@ -0,0 +1,102 @@
+import logging
+import os
+import sys
+from typing import Dict, Iterable
+
+# name of the root logger, all subsystem loggers are children of it
+ROOT = "SAIO"
+
+# the subsystems that can be toggled independently (id: description)
+SUBSYSTEMS = {
+	'FILE': "Reading and writing of model and level files",
+	'COMMON': "Object, armature and mesh conversion",
+	'BASIC': "BASIC (SA1) model format",
+	'CHUNK': "CHUNK (SA2) model format",
+	'GC': "GC (SA2B) model format",
+	'STRIP': "Triangle strippification",
+}
+
+LEVELS = {
+	'DEBUG': logging.DEBUG,
+	'INFO': logging.INFO,
+	'WARNING': logging.WARNING,
+}
+
+root = logging.getLogger(ROOT)
+root.setLevel(logging.WARNING)
+# dont pass our messages to the loggers of blender or other addons
+root.propagate = False
+
+loggers: Dict[str, logging.Logger] = dict()
+
+consoleHandler = logging.StreamHandler(sys.stdout)
+consoleHandler.setFormatter(logging.Formatter("%(message)s"))
+root.addHandler(consoleHandler)
+
+fileHandler: logging.FileHandler = None
+
+def getLogger(subsystem: str) -> logging.Logger:
+	"""Returns the logger of a subsystem (see SUBSYSTEMS).
+
+	Messages should be passed with %-style arguments
+	(log.debug("Labels: %i", count)), so that they only get formatted
+	when the message is actually logged. In loops, check
+	log.isEnabledFor(logging.DEBUG) once beforehand instead of
+	calling log.debug() for every element"""
+	logger = loggers.get(subsystem)
+	if logger is None:
+		logger = logging.getLogger(ROOT + "." + subsystem.lower())
+		loggers[subsystem] = logger
+	return logger
+
+def configure(enabled: bool,
+			  level: str = 'DEBUG',
+			  subsystems: Iterable[str] = None,
+			  filepath: str = None):
+	"""Sets up the logging for an import or export.
+
+	When disabled, only warnings get logged. subsystems limits the debug
+	output to the given subsystems (all if None), and filepath
+	additionally writes the log to a file"""
+	global fileHandler
+
+	if fileHandler is not None:
+		root.removeHandler(fileHandler)
+		fileHandler.close()
+		fileHandler = None
+
+	if subsystems is not None:
+		subsystems = set(subsystems)
+
+	for s in SUBSYSTEMS.keys():
+		logger = getLogger(s)
+		if enabled and (subsystems is None or s in subsystems):
+			logger.setLevel(LEVELS[level])
+		else:
+			logger.setLevel(logging.WARNING)
+
+	if enabled and filepath:
+		fileHandler = logging.FileHandler(filepath, mode='w', encoding="utf-8")
+		fileHandler.setFormatter(logging.Formatter(
+			"%(asctime)s %(name)s %(levelname)s: %(message)s"))
+		root.addHandler(fileHandler)
+
+def configureFromPreferences(enabled: bool):
+	"""Sets up the logging using the settings in the addon preferences"""
+	from . import common
+	try:
+		prefs = common.get_prefs()
+	except KeyError:
+		# addon not enabled (e.g. when running headless)
+		configure(enabled)
+		return
+
+	filepath = None
+	if prefs.logFile != "":
+		import bpy
+		filepath = os.path.abspath(bpy.path.abspath(prefs.logFile))
+
+	configure(enabled or prefs.printDebug,
+			  prefs.logLevel,
+			  prefs.logSubsystems,
+			  filepath)
@@ -0,0 +1,185 @@
+import json
+import os
+import time
+import tracemalloc
+from typing import Dict, List
+
+# the statistics of the export that is currently running.
+# None if no statistics are being recorded
+current = None
+# the statistics of the last successful export (displayed in the tools panel)
+lastStats = None
+
+class StageStats:
+	"""Accumulated measurements of a single export stage
+
+	Stages can be nested (e.g. strippification happens while building chunks),
+	so the time and memory of a stage include those of its nested stages
+	"""
+
+	name: str
+	calls: int
+	time: float
+	peakMemory: int
+	counters: Dict[str, int]
+	details: Dict[str, object]  # json compatible information, e.g. per mesh
+
+	def __init__(self, name: str):
+		self.name = name
+		self.calls = 0
+		self.time = 0.0
+		self.peakMemory = 0
+		self.counters = dict()
+		self.details = dict()
+
+	def toDictionary(self) -> dict:
+		return {
+			"calls": self.calls,
+			"time": self.time,
+			"peakMemory": self.peakMemory,
+			"counters": dict(self.counters),
+			"details": dict(self.details)
+		}
+
+class Stage:
+	"""Measures one pass through an export stage (use as context manager)"""
+
+	stats: 'ExportStats'
+	stage: StageStats
+	start: float
+	childPeak: int
+
+	def __init__(self, stats: 'ExportStats', stage: StageStats):
+		self.stats = stats
+		self.stage = stage
+		self.start = 0.0
+		self.childPeak = 0
+
+	def add(self, counter: str, value: int = 1):
+		"""Adds a value to one of the stages counters"""
+		counters = self.stage.counters
+		counters[counter] = counters.get(counter, 0) + value
+
+	def detail(self, key: str, value):
+		"""Stores json compatible information under a key of the stage"""
+		self.stage.details[key] = value
+
+	def __enter__(self):
+		stack = self.stats.stack
+		if self.stats.trackMemory:
+			# resetting the peak would lose the parents peak, so we store it
+			peak = tracemalloc.get_traced_memory()[1]
+			if len(stack) > 0 and peak > stack[-1].childPeak:
+				stack[-1].childPeak = peak
+			tracemalloc.reset_peak()
+		stack.append(self)
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.stage.time += time.perf_counter() - self.start
+		self.stage.calls += 1
+
+		stack = self.stats.stack
+		stack.pop()
+		if self.stats.trackMemory:
+			peak = max(tracemalloc.get_traced_memory()[1], self.childPeak)
+			if peak > self.stage.peakMemory:
+				self.stage.peakMemory = peak
+			if len(stack) > 0 and peak > stack[-1].childPeak:
+				stack[-1].childPeak = peak
+		return False
+
+class NullStage:
+	"""Stand-in used when no statistics are recorded"""
+
+	def add(self, counter: str, value: int = 1):
+		pass
+
+	def detail(self, key: str, value):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		return False
+
+nullStage = NullStage()
+
+class ExportStats:
+	"""Timings, counters and peak memory of every stage of one export"""
+
+	filepath: str
+	format: str
+	trackMemory: bool
+	stages: Dict[str, StageStats]
+	stack: List[Stage]
+	time: float
+
+	def __init__(self, filepath: str, format: str, trackMemory: bool = True):
+		self.filepath = filepath
+		self.format = format
+		self.trackMemory = trackMemory
+		self.stages = dict()
+		self.stack = list()
+		self.time = 0.0
+		self.startedTracing = False
+		self.startTime = 0.0
+
+	def begin(self):
+		if self.trackMemory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self.startedTracing = True
+		self.startTime = time.perf_counter()
+
+	def end(self):
+		self.time = time.perf_counter() - self.startTime
+		if self.startedTracing:
+			tracemalloc.stop()
+			self.startedTracing = False
+
+	def stage(self, name: str) -> Stage:
+		stage = self.stages.get(name)
+		if stage is None:
+			stage = StageStats(name)
+			self.stages[name] = stage
+		return Stage(self, stage)
+
+	def toDictionary(self) -> dict:
+		return {
+			"file": self.filepath,
+			"format": self.format,
+			"time": self.time,
+			"stages": {k: v.toDictionary() for k, v in self.stages.items()}
+		}
+
+	def writeJson(self, filepath: str):
+		if os.path.isfile(filepath):
+			os.remove(filepath)
+		with open(filepath, 'w') as f:
+			json.dump(self.toDictionary(), f, indent=4)
+
+def begin(filepath: str, format: str) -> ExportStats:
+	"""Starts recording statistics for an export"""
+	global current
+	current = ExportStats(filepath, format)
+	current.begin()
+	return current
+
+def end(success: bool):
+	"""Stops recording; the stats are kept for the ui if the export succeeded"""
+	global current, lastStats
+	if current is None:
+		return
+	current.end()
+	if success:
+		lastStats = current
+	current = None
+
+def stage(name: str):
+	"""Returns a context manager which measures the given stage.
+	Does nothing if no statistics are recorded"""
+	if current is None:
+		return nullStage
+	return current.stage(name)
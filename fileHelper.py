@@ -1,6 +1,8 @@
 import bpy
+import io
 import os
 import mathutils
+import numpy
 import struct
 import tempfile
 
@@ -115,6 +117,21 @@ class FileWriter:
         self.w(string.encode('utf-8'))
         self.wByte(0x00)
 
+class ByteWriter(FileWriter):
+    """Handles binary writing into memory
+
+    Used to precompute data that gets written several times
+    """
+
+    def __init__(self):
+        self.oFile = io.BytesIO()
+        self.filepath = None
+        self.endian = "<"
+
+    def getBytes(self) -> bytes:
+        """Returns everything that has been written so far"""
+        return self.oFile.getvalue()
+
 class FileReader:
 
     def __init__(self, filepath: str):
@@ -181,6 +198,14 @@ class FileReader:
         """Returns a Double"""
         return struct.unpack_from(self.endian + "d", self.fileC, address)[0]
 
+    def rArray(self, dataType: str, address: int, count: int) -> numpy.ndarray:
+        """Returns count values of a struct type (e.g. "H" or "f")
+        starting at the address, as a numpy array"""
+        return numpy.frombuffer(self.fileC,
+                                numpy.dtype(self.endian + dataType),
+                                count,
+                                address)
+
     def rString(self, address: int):
         string = []
         i = self.fileC[address]
@@ -0,0 +1,328 @@
+"""Structural index of ninja model and level files
+
+The index is built in a first pass over the file, following every
+pointer once. It maps the address of every structure to its type, size
+and the addresses of the structures referencing it, so that shared data
+and corrupted pointers are known before anything gets decoded.
+
+The model reader builds its object list from the objects found by the
+index pass. Attaches are only decoded if they are valid in the index,
+and together with the data inside of them that is commonly shared
+(BASIC material lists, GC vertex data and parameter lists, CHUNK vertex
+and poly chunk lists) they go through FileIndex.decode, which decodes
+every structure only once no matter how often it is referenced.
+"""
+
+import logging
+from typing import Callable, Dict, List, Tuple
+from . import fileHelper, debugLog
+
+log = debugLog.getLogger('FILE')
+
+# structure sizes in bytes
+OBJECT_SIZE = 52
+ATTACH_SIZES = {
+	'SA1': 40,
+	'SA2': 24,
+	'SA2B': 36,
+}
+
+def decode(index: 'FileIndex', address: int, sType: str, reader: Callable[[], object]):
+	"""FileIndex.decode for readers that can also be used without an
+	index, in which case the reader is simply called. Null pointers
+	dont get cached either"""
+	if index is None or address == 0:
+		return reader()
+	return index.decode(address, sType, reader)
+
+class Structure:
+	"""A single structure in the file"""
+
+	address: int
+	sType: str
+	size: int
+	referrers: List[int]
+	valid: bool  # false if the structure points to data outside of the file
+
+	def __init__(self, address: int, sType: str, size: int):
+		self.address = address
+		self.sType = sType
+		self.size = size
+		self.referrers = list()
+		self.valid = True
+
+class FileIndex:
+	"""Address -> structure index of a file"""
+
+	fileR: fileHelper.FileReader
+	labels: dict
+	structures: Dict[int, Structure]
+	decoded: Dict[tuple, object]
+
+	def __init__(self, fileR: fileHelper.FileReader, labels: dict = None):
+		self.fileR = fileR
+		self.labels = dict() if labels is None else labels
+		self.structures = dict()
+		self.decoded = dict()
+
+	def add(self, address: int, sType: str, size: int, referrer: int = None) -> bool:
+		"""Registers a structure. Returns whether it is new and lies
+		inside the file, which means that its content should be indexed"""
+		if address == 0:
+			return False
+
+		if address + size > len(self.fileR.fileC):
+			log.warning("%s at %s (referenced by %s) is outside of the file",
+						sType, hex(address),
+						"none" if referrer is None else hex(referrer))
+			return False
+
+		s = self.structures.get(address)
+		if s is not None:
+			if referrer is not None:
+				s.referrers.append(referrer)
+			if s.sType != sType:
+				log.warning("%s is used as both %s and %s",
+							hex(address), s.sType, sType)
+			return False
+
+		s = Structure(address, sType, size)
+		if referrer is not None:
+			s.referrers.append(referrer)
+		self.structures[address] = s
+		return True
+
+	def addPart(self,
+				parent: Structure,
+				address: int,
+				sType: str,
+				size: int,
+				referrer: int = None) -> bool:
+		"""Registers a structure that the parent structure points to (see
+		add). The parent becomes invalid if the part lies outside of the
+		file or is invalid itself. Null pointers are allowed"""
+		if address == 0:
+			return False
+		if referrer is None:
+			referrer = parent.address
+
+		isNew = self.add(address, sType, size, referrer)
+		part = self.structures.get(address)
+		if part is None or not part.valid:
+			parent.valid = False
+		return isNew
+
+	def get(self, address: int) -> Structure:
+		"""Returns the structure at an address (None if it wasnt indexed)"""
+		return self.structures.get(address)
+
+	def isValid(self, address: int) -> bool:
+		"""Whether the structure at an address was indexed and everything
+		it points to lies inside the file"""
+		s = self.structures.get(address)
+		return s is not None and s.valid
+
+	def decode(self, address: int, sType: str, reader: Callable[[], object]):
+		"""Returns the decoded structure at an address. reader is only
+		called the first time a structure gets requested"""
+		key = (address, sType)
+		if key not in self.decoded:
+			self.decoded[key] = reader()
+		return self.decoded[key]
+
+	# === indexing ===
+
+	def addObjects(self,
+				   address: int,
+				   attachFormat: str,
+				   referrer: int = None) -> List[Tuple[int, int, int, str]]:
+		"""Indexes an object hierarchy and the attaches of its objects.
+		Returns the newly indexed objects in depth first order (object,
+		children, siblings) as (address, parent address, address of the
+		object pointing to it, pointer field), see common.readObjectList"""
+		objects = list()
+		# address, parent, referrer and the pointer field
+		stack = [(address, 0, referrer, None)]
+		while len(stack) > 0:
+			address, parent, referrer, field = stack.pop()
+			if address in self.structures:
+				log.warning("Object %s is referenced more than once, skipping it",
+							self.labels.get(address, hex(address)))
+			if not self.add(address, "object", OBJECT_SIZE, referrer):
+				continue
+			objects.append((address, parent, referrer, field))
+
+			self.addAttach(self.fileR.rUInt(address + 4), attachFormat, address)
+			stack.append((self.fileR.rUInt(address + 48), parent, address, "sibling"))
+			stack.append((self.fileR.rUInt(address + 44), address, address, "child"))
+		return objects
+
+	def addAttach(self, address: int, attachFormat: str, referrer: int = None):
+		"""Indexes an attach of the given format ('SA1', 'SA2' or 'SA2B')"""
+		sType = "attach_" + attachFormat
+		if not self.add(address, sType, ATTACH_SIZES[attachFormat], referrer):
+			return
+
+		attach = self.structures[address]
+		if attachFormat == 'SA1':
+			self.addBASICAttach(attach)
+		elif attachFormat == 'SA2':
+			self.addCHUNKAttach(attach)
+		else:
+			self.addGCAttach(attach)
+
+		if not attach.valid:
+			log.warning("%s at %s points outside of the file",
+						sType, hex(address))
+
+	def addBASICAttach(self, attach: Structure):
+		fileR = self.fileR
+		address = attach.address
+		vertexCount = fileR.rUInt(address + 8)
+		self.addPart(attach, fileR.rUInt(address), "positions", vertexCount * 12)
+		self.addPart(attach, fileR.rUInt(address + 4), "normals", vertexCount * 12)
+		self.addPart(attach, fileR.rUInt(address + 16), "materials",
+					 fileR.rUShort(address + 22) * 20)
+
+		setPtr = fileR.rUInt(address + 12)
+		setCount = fileR.rUShort(address + 20)
+		if not self.addPart(attach, setPtr, "meshsets", setCount * 24):
+			return
+
+		meshSets = self.structures[setPtr]
+		for i in range(setCount):
+			entry = setPtr + i * 24
+			polyType = fileR.rUShort(entry) >> 14
+			polyCount = fileR.rUShort(entry + 2)
+			polyPtr = fileR.rUInt(entry + 4)
+
+			if polyType < 2:  # triangles and quads
+				corners = polyCount * (3 + polyType)
+				size = corners * 2
+			else:  # strips and npolys store the size in front of every poly
+				corners = 0
+				end = polyPtr
+				for p in range(polyCount):
+					if end + 2 > len(fileR.fileC):
+						break
+					count = fileR.rUShort(end) & 0x7FFF
+					corners += count
+					end += 2 + count * 2
+				size = end - polyPtr
+
+			self.addPart(meshSets, polyPtr, "polygons", size, entry)
+			self.addPart(meshSets, fileR.rUInt(entry + 12), "poly_normals", corners * 12, entry)
+			self.addPart(meshSets, fileR.rUInt(entry + 16), "colors", corners * 4, entry)
+			self.addPart(meshSets, fileR.rUInt(entry + 20), "uvs", corners * 4, entry)
+
+		if not meshSets.valid:
+			attach.valid = False
+
+	def addCHUNKAttach(self, attach: Structure):
+		fileR = self.fileR
+		address = attach.address
+		fileSize = len(fileR.fileC)
+
+		# the chunk lists have no count, so the chunks have to be walked.
+		# lists without a terminator end up reaching outside of the file
+		vtxPtr = fileR.rUInt(address)
+		end = vtxPtr
+		while 0 < end and end + 4 <= fileSize and fileR.rByte(end) != 0xFF:
+			# size in 4 byte units, after the chunk header
+			end += 4 + fileR.rUShort(end + 2) * 4
+		self.addPart(attach, vtxPtr, "vertex_chunks", end + 8 - vtxPtr)
+
+		polyPtr = fileR.rUInt(address + 4)
+		end = polyPtr
+		while 0 < end and end + 2 <= fileSize:
+			chunkType = fileR.rByte(end)
+			if chunkType == 0xFF:
+				break
+			if chunkType < 8:  # null and bits chunks
+				end += 2
+			elif chunkType < 16:  # tiny chunks
+				end += 4
+			else:  # size in 2 byte units, after the chunk header
+				end += 4 + fileR.rUShort(end + 2) * 2
+		self.addPart(attach, polyPtr, "poly_chunks", end + 2 - polyPtr)
+
+	def addGCAttach(self, attach: Structure):
+		fileR = self.fileR
+		address = attach.address
+		fileSize = len(fileR.fileC)
+
+		vtxPtr = fileR.rUInt(address)
+		count = 0
+		while 0 < vtxPtr and vtxPtr + count * 16 + 16 <= fileSize \
+				and fileR.rByte(vtxPtr + count * 16) != 0xFF:
+			count += 1
+		if self.addPart(attach, vtxPtr, "vertex_attributes", count * 16 + 16):
+			attributes = self.structures[vtxPtr]
+			for i in range(count):
+				entry = vtxPtr + i * 16
+				self.addPart(attributes, fileR.rUInt(entry + 8), "vertex_data",
+							 fileR.rUInt(entry + 12), entry)
+			if not attributes.valid:
+				attach.valid = False
+
+		for ptrOffset, countOffset in ((8, 16), (12, 18)):
+			geomPtr = fileR.rUInt(address + ptrOffset)
+			count = fileR.rUShort(address + countOffset)
+			if not self.addPart(attach, geomPtr, "geometry", count * 16):
+				continue
+			geometry = self.structures[geomPtr]
+			for i in range(count):
+				entry = geomPtr + i * 16
+				self.addPart(geometry, fileR.rUInt(entry), "parameters",
+							 fileR.rUInt(entry + 4) * 8, entry)
+				self.addPart(geometry, fileR.rUInt(entry + 8), "primitives",
+							 fileR.rUInt(entry + 12), entry)
+			if not geometry.valid:
+				attach.valid = False
+
+	def addLandtable(self, address: int, fileFormat: str):
+		"""Indexes a landtable with its land entries"""
+		fileR = self.fileR
+		SA1 = fileFormat == 'SA1'
+		if not self.add(address, "landtable", 36 if SA1 else 32):
+			return
+
+		colCount = fileR.rUShort(address)
+		colPtr = fileR.rUInt(address + (12 if SA1 else 16))
+		colSize = 36 if SA1 else 32
+		if not self.add(colPtr, "land_entries", colCount * colSize, address):
+			return
+
+		vColCount = colCount if SA1 else fileR.rUShort(address + 2)
+		for i in range(colCount):
+			entry = colPtr + i * colSize
+			objectPtr = fileR.rUInt(entry + (24 if SA1 else 16))
+			# sa2 collisions use BASIC attaches
+			self.addObjects(objectPtr, fileFormat if i < vColCount else 'SA1', entry)
+
+	# === output ===
+
+	def dump(self) -> str:
+		"""Returns a summary of all structures, sorted by address"""
+		lines = list()
+		counts: Dict[str, int] = dict()
+		for address in sorted(self.structures.keys()):
+			s = self.structures[address]
+			counts[s.sType] = counts.get(s.sType, 0) + 1
+			label = self.labels.get(address)
+			lines.append("%08x %-18s %8i  refs: %s%s" % (
+				address, s.sType, s.size,
+				" ".join("%08x" % r for r in s.referrers),
+				"" if label is None else "  (" + label + ")"))
+
+		lines.append("")
+		for sType in sorted(counts.keys()):
+			lines.append("%s: %i" % (sType, counts[sType]))
+
+		shared = sum(1 for s in self.structures.values() if len(s.referrers) > 1)
+		lines.append("shared structures: %i" % shared)
+		return "\n".join(lines)
+
+	def debug(self):
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug(" == File Structure ==\n%s\n", self.dump())
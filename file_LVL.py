@@ -3,10 +3,11 @@ import os
 import mathutils
 
 from typing import List, Dict
-from . import fileHelper, enums, common, format_BASIC, format_GC, format_CHUNK
+import logging
+from . import fileHelper, enums, common, format_BASIC, format_GC, format_CHUNK, exportStats, debugLog, fileIndex
 from .enums import ObjectFlags
-DO = False  # Debug out
 
+log = debugLog.getLogger('FILE')
 
 def hex8(number: int):
 	return '{:08x}'.format(number)
@@ -17,22 +18,20 @@ def hex16(number: int):
 def read(context: bpy.types.Context,
 		 filepath: str,
 		 noDoubleVerts: bool,
-		 console_debug_output: bool):
+		 console_debug_output: bool,
+		 materialCache: common.MaterialCache = None):
 
-	global DO
-	DO = console_debug_output
-	common.DO = DO
-	format_BASIC.DO = DO
-	format_CHUNK.DO = DO
-	format_GC.DO = DO
+	if materialCache is None:
+		materialCache = common.MaterialCache()
 
-	if DO:
-		os.system("cls")
+	debugLog.configureFromPreferences(console_debug_output)
+	debug = log.isEnabledFor(logging.DEBUG)
 
+	format_GC.readParameters.clear()
 	fileR = fileHelper.FileReader(filepath)
 
 	if fileR.filepath is None:
-		print("no valid filepath")
+		log.warning("no valid filepath")
 		return {'CANCELLED'}
 
 	indicator = enums.LVLFormatIndicator(fileR.rULong(0) & ~0xFF00000000000000)
@@ -45,14 +44,14 @@ def read(context: bpy.types.Context,
 	elif indicator == enums.LVLFormatIndicator.SA2BLVL:
 		file_format = 'SA2B'
 	else:
-		print("no Valid file")
+		log.warning("no Valid file")
 		return {'CANCELLED'}
 
-	if DO:
-		print(" == Starting LVL file reading ==")
-		print("  File:", filepath)
-		print("  Format:", file_format, "version", fileVersion)
-		print("  - - - - - -\n")
+	if debug:
+		log.debug(" == Starting LVL file reading ==")
+		log.debug("  File: %s", filepath)
+		log.debug("  Format: %s version %s", file_format, fileVersion)
+		log.debug("  - - - - - -\n")
 
 	labels: Dict[int, str] = dict()
 
@@ -91,33 +90,33 @@ def read(context: bpy.types.Context,
 				elif cnkType == enums.Chunktypes.Description:
 					context.scene.saSettings.description \
 						= fileR.rString(tmpAddr)
-				elif cnkType == enums.Chunktypes.Animation and DO:
-					print("Animation metadata found")
-				elif cnkType == enums.Chunktypes.Morph and DO:
-					print("Morph metadata found")
-				elif cnkType == enums.Chunktypes.Tool and DO:
-					print("Tool metadata found")
-				elif cnkType == enums.Chunktypes.Texture and DO:
-					print("Texture metadata found")
+				elif cnkType == enums.Chunktypes.Animation and debug:
+					log.debug("Animation metadata found")
+				elif cnkType == enums.Chunktypes.Morph and debug:
+					log.debug("Morph metadata found")
+				elif cnkType == enums.Chunktypes.Tool and debug:
+					log.debug("Tool metadata found")
+				elif cnkType == enums.Chunktypes.Texture and debug:
+					log.debug("Texture metadata found")
 				elif cnkType == enums.Chunktypes.End:
 					finished = True
-				elif DO:
-					print("invalid Chunk type:", cnkType.value)
+				elif debug:
+					log.debug("invalid Chunk type: %s", cnkType.value)
 
 				tmpAddr = cnkNext
 
-	if DO:
+	if debug:
 		if len(labels) > 0:
-			print("Labels:", len(labels))
+			log.debug("Labels: %s", len(labels))
 			for l in labels.keys():
-				print(hex8(l), labels[l])
+				log.debug("%s %s", hex8(l), labels[l])
 		if context.scene.saSettings.author != "":
-			print("Author:", context.scene.saSettings.author)
+			log.debug("Author: %s", context.scene.saSettings.author)
 		if context.scene.saSettings.description != "":
-			print("Description:", context.scene.saSettings.description)
-		print("\n")
+			log.debug("Description: %s", context.scene.saSettings.description)
+		log.debug("\n")
 
-		print(" == Reading Models ==")
+		log.debug(" == Reading Models ==")
 
 	# get landtable data
 	tmpAddr = fileR.rUInt(8)
@@ -141,18 +140,18 @@ def read(context: bpy.types.Context,
 		unknown2 = fileR.rUInt(tmpAddr + 28)
 		unknown3 = fileR.rUInt(tmpAddr + 32)
 
-		if DO:
-			print(" == Landtable info ==")
-			print("  Col Count:", colCount)
-			print("  Anim Count:", animCount)
-			print("  Flags:", flags)
-			print("  Draw Dist.:", context.scene.saSettings.drawDistance)
-			print("  Col Ptr:", common.hex4(colPtr))
-			print("  Anim Ptr:", common.hex4(animPtr))
-			print("  Tex File Name:", context.scene.saSettings.texFileName)
-			print("  Tex List Ptr:", context.scene.saSettings.texListPointer)
-			print("  Unknown2:", unknown2)
-			print("  Unknown3:", unknown3)
+		if debug:
+			log.debug(" == Landtable info ==")
+			log.debug("  Col Count: %s", colCount)
+			log.debug("  Anim Count: %s", animCount)
+			log.debug("  Flags: %s", flags)
+			log.debug("  Draw Dist.: %s", context.scene.saSettings.drawDistance)
+			log.debug("  Col Ptr: %s", common.hex4(colPtr))
+			log.debug("  Anim Ptr: %s", common.hex4(animPtr))
+			log.debug("  Tex File Name: %s", context.scene.saSettings.texFileName)
+			log.debug("  Tex List Ptr: %s", context.scene.saSettings.texListPointer)
+			log.debug("  Unknown2: %s", unknown2)
+			log.debug("  Unknown3: %s", unknown3)
 	else:
 		colCount = fileR.rUShort(tmpAddr)
 		vColCount = fileR.rUShort(tmpAddr + 2)
@@ -167,15 +166,15 @@ def read(context: bpy.types.Context,
 		context.scene.saSettings.texListPointer \
 			= hex8(fileR.rUInt(tmpAddr + 28))
 
-		if DO:
-			print(" == Landtable info ==")
-			print("  Col Count:", colCount)
-			print("  visual Col Count:", vColCount)
-			print("  Draw Dist.:", context.scene.saSettings.drawDistance)
-			print("  Col Ptr:", common.hex4(colPtr))
-			print("  Anim Ptr:", common.hex4(animPtr))
-			print("  Tex File Name:", context.scene.saSettings.texFileName)
-			print("  Tex List Ptr:", context.scene.saSettings.texListPointer)
+		if debug:
+			log.debug(" == Landtable info ==")
+			log.debug("  Col Count: %s", colCount)
+			log.debug("  visual Col Count: %s", vColCount)
+			log.debug("  Draw Dist.: %s", context.scene.saSettings.drawDistance)
+			log.debug("  Col Ptr: %s", common.hex4(colPtr))
+			log.debug("  Anim Ptr: %s", common.hex4(animPtr))
+			log.debug("  Tex File Name: %s", context.scene.saSettings.texFileName)
+			log.debug("  Tex List Ptr: %s", context.scene.saSettings.texListPointer)
 
 	# create collections
 	cName = os.path.splitext(os.path.basename(filepath))[0]
@@ -188,6 +187,12 @@ def read(context: bpy.types.Context,
 	cCollection = bpy.data.collections.new(cName + "_Collision")
 	collection.children.link(cCollection)
 
+	# indexing the file structure first, so that invalid pointers
+	# are known before decoding anything
+	index = fileIndex.FileIndex(fileR, labels)
+	index.addLandtable(fileR.rUInt(8), file_format)
+	index.debug()
+
 	# read cols
 	COLs: List[common.Col] = list()
 
@@ -202,15 +207,15 @@ def read(context: bpy.types.Context,
 		meshes = dict()
 
 		for i in range(colCount):
-			if COLs[i].model.meshPtr > 0 \
-					and COLs[i].model.meshPtr not in meshes:
-				meshes[COLs[i].model.meshPtr] \
-					= format_BASIC.Attach.read(fileR,
-											   COLs[i].model.meshPtr,
-											   i,
-											   labels)
+			ptr = COLs[i].model.meshPtr
+			if ptr > 0 and index.isValid(ptr):
+				meshes[ptr] = index.decode(
+					ptr, "attach_SA1",
+					lambda: format_BASIC.Attach.read(fileR, ptr, i, labels, index))
 
-		format_BASIC.process_BASIC([c.model for c in COLs], meshes)
+		format_BASIC.process_BASIC([c.model for c in COLs],
+								   meshes,
+								   materialCache=materialCache)
 
 		for c in COLs:
 			obj = c.toBlenderObject()
@@ -226,22 +231,19 @@ def read(context: bpy.types.Context,
 		vmeshes = dict()
 		cmeshes = dict()
 
+		attachFormat = format_CHUNK if file_format == 'SA2' else format_GC
 		for i in range(vColCount):
 			ptr = COLs[i].model.meshPtr
-			if ptr > 0 and ptr not in vmeshes:
-				if file_format == 'SA2':
-					vmeshes[ptr] \
-						= format_CHUNK.Attach.read(fileR, ptr, i, labels)
-				else:
-					vmeshes[ptr] = format_GC.Attach.read(fileR, ptr, i, labels)
+			if ptr > 0 and index.isValid(ptr):
+				vmeshes[ptr] = index.decode(
+					ptr, "attach_" + file_format,
+					lambda: attachFormat.Attach.read(fileR, ptr, i, labels, index))
 		for i in range(colCount - vColCount):
-			col = COLs[i + vColCount]
-			if col.model.meshPtr > 0 and col.model.meshPtr not in cmeshes:
-				cmeshes[col.model.meshPtr] \
-					= format_BASIC.Attach.read(fileR,
-											   col.model.meshPtr,
-											   vColCount + i,
-											   labels)
+			ptr = COLs[i + vColCount].model.meshPtr
+			if ptr > 0 and index.isValid(ptr):
+				cmeshes[ptr] = index.decode(
+					ptr, "attach_SA1",
+					lambda: format_BASIC.Attach.read(fileR, ptr, vColCount + i, labels, index))
 
 		if file_format == 'SA2':
 			processedAttaches \
@@ -249,12 +251,16 @@ def read(context: bpy.types.Context,
 			format_CHUNK.ProcessChunkData([c.model for c in COLs],
 										  processedAttaches,
 										  noDoubleVerts,
-										  None)
+										  None,
+										  materialCache)
 		else:  # sa2b
-			format_GC.process_GC([c.model for c in COLs], vmeshes)
+			format_GC.process_GC([c.model for c in COLs],
+								 vmeshes,
+								 materialCache)
 		format_BASIC.process_BASIC([c.model for c in COLs],
 								   cmeshes,
-								   collision=True)
+								   collision=True,
+								   materialCache=materialCache)
 
 		for i, c in enumerate(COLs):
 			obj = c.toBlenderObject()
@@ -279,22 +285,23 @@ def write(context,
 		  write_Specular,
 		  use_selection,
 		  apply_modifs,
-		  console_debug_output):
+		  console_debug_output,
+		  quantize_GC=False,
+		  sort_GC=False,
+		  optimize_CHUNK=False):
 
 	from .common import ModelData
 
-	global DO
-	DO = console_debug_output
-	common.DO = DO
-	format_BASIC.DO = DO
-	format_CHUNK.DO = DO
-	format_GC.DO = DO
+	debugLog.configureFromPreferences(console_debug_output)
+	debug = log.isEnabledFor(logging.DEBUG)
 
 	format_CHUNK.writeSpecular = write_Specular
-
-	if DO:
-		# clear console and enable debug outputs
-		os.system("cls")
+	format_GC.quantize = quantize_GC
+	format_GC.sortByUse = sort_GC
+	format_CHUNK.sortByFirstUse = optimize_CHUNK
+	format_CHUNK.materialTemplates.clear()
+	format_CHUNK.polyChunkLists.clear()
+	format_BASIC.materialLists.clear()
 
 	# create the file
 	fileW = fileHelper.FileWriter()
@@ -312,11 +319,11 @@ def write(context,
 
 	fileW.wULong(indicator.value | (fileVersion << 56))
 
-	if DO:
-		print(" == Starting LVL file exporting ==")
-		print("  File:", filepath)
-		print("  Format:", export_format, "version", fileVersion)
-		print("  - - - - - -\n")
+	if debug:
+		log.debug(" == Starting LVL file exporting ==")
+		log.debug("  File: %s", filepath)
+		log.debug("  Format: %s version %s", export_format, fileVersion)
+		log.debug("  - - - - - -\n")
 
 	# settings placeholders for the
 	fileW.wUInt(0)  # landtable address
@@ -348,22 +355,27 @@ def write(context,
 		#                                                     labels)
 
 		# then writing mesh data
-		if DO:
-			print(" == Writing BASIC attaches == \n")
+		if debug:
+			log.debug(" == Writing BASIC attaches == \n")
 		for m in meshes:
-			matPtr, bscMaterials \
-				= format_BASIC.Material.writeMaterials(fileW,
-													   m.materials,
-													   m.name,
-													   labels)
-			mesh = format_BASIC.Attach.fromMesh(m,
-												global_matrix,
-												matPtr,
-												bscMaterials)
+			with exportStats.stage("writing") as stage:
+				start = fileW.tell()
+				matPtr, bscMaterials \
+					= format_BASIC.Material.writeMaterials(fileW,
+														   m.materials,
+														   m.name,
+														   labels)
+				stage.add("bytes", fileW.tell() - start)
+			with exportStats.stage("chunks") as stage:
+				mesh = format_BASIC.Attach.fromMesh(m,
+													global_matrix,
+													matPtr,
+													bscMaterials)
+				stage.add("meshes")
 			if mesh is not None:
-				mesh.write(fileW, labels, vMeshDict)
-		if DO:
-			print(" - - - - \n")
+				common.writeAttach(mesh, fileW, labels, vMeshDict)
+		if debug:
+			log.debug(" - - - - \n")
 	else:
 		# writing the collision material, just to be sure
 		# This is always the same address btw
@@ -387,88 +399,103 @@ def write(context,
 
 		# writing the collision meshes
 		cMeshDict = dict()
-		if DO:
-			print(" == Writing BASIC attaches == \n")
+		if debug:
+			log.debug(" == Writing BASIC attaches == \n")
 		for m in cMeshes:
-			matPtr, bscMaterials \
-				= format_BASIC.Material.writeMaterials(
-					fileW,
-					m.materials,
-					m.name,
-					labels)
-
-			mesh = format_BASIC.Attach.fromMesh(
-				m,
-				global_matrix,
-				matPtr,
-				bscMaterials,
-				isCollision=True)
+			with exportStats.stage("writing") as stage:
+				start = fileW.tell()
+				matPtr, bscMaterials \
+					= format_BASIC.Material.writeMaterials(
+						fileW,
+						m.materials,
+						m.name,
+						labels)
+				stage.add("bytes", fileW.tell() - start)
+
+			with exportStats.stage("chunks") as stage:
+				mesh = format_BASIC.Attach.fromMesh(
+					m,
+					global_matrix,
+					matPtr,
+					bscMaterials,
+					isCollision=True)
+				stage.add("meshes")
 
 			if mesh is not None:
-				mesh.write(fileW, labels, cMeshDict)
-				if DO:
-					print("Mesh written:", mesh.name)
-		if DO:
-			print("")
+				common.writeAttach(mesh, fileW, labels, cMeshDict)
+				if debug:
+					log.debug("Mesh written: %s", mesh.name)
+		if debug:
+			log.debug("")
 
 		# writing visual meshes
 		if export_format == 'SA2':
-			if DO:
-				print(" == Writing CHUNK attaches == \n")
+			if debug:
+				log.debug(" == Writing CHUNK attaches == \n")
 			for m in vMeshes:
-				mesh = format_CHUNK.Attach.fromMesh(m,
-													global_matrix,
-													materials)
+				with exportStats.stage("chunks") as stage:
+					mesh = format_CHUNK.Attach.fromMesh(m,
+														global_matrix,
+														materials)
+					stage.add("meshes")
 				if mesh is not None:
-					mesh.write(fileW, labels, vMeshDict)
-					if DO:
-						print("Mesh written:", mesh.name)
+					common.writeAttach(mesh, fileW, labels, vMeshDict)
+					if debug:
+						log.debug("Mesh written: %s", mesh.name)
 		else:
-			if DO:
-				print(" == Writing GC attaches == \n")
+			if debug:
+				log.debug(" == Writing GC attaches == \n")
 			for m in vMeshes:
-				mesh = format_GC.Attach.fromMesh(m, global_matrix, materials)
+				with exportStats.stage("chunks") as stage:
+					mesh = format_GC.Attach.fromMesh(m,
+													 global_matrix,
+													 materials)
+					stage.add("meshes")
 				if mesh is not None:
-					mesh.write(fileW, labels, vMeshDict)
-					if DO:
-						print("Mesh written:", mesh.name)
-		if DO:
-			print("")
+					common.writeAttach(mesh, fileW, labels, vMeshDict)
+					if debug:
+						log.debug("Mesh written: %s", mesh.name)
+		if debug:
+			log.debug("")
 
 	# writing model data
 	ModelData.updateMeshPointer(objects, vMeshDict, cMeshDict)
-	ModelData.writeObjectList(objects, fileW, labels, True)
+	with exportStats.stage("writing") as stage:
+		start = fileW.tell()
+		ModelData.writeObjectList(objects, fileW, labels, True)
 
-	# write COLs
-	COLPtr = fileW.tell()
+		# write COLs
+		COLPtr = fileW.tell()
 
-	if export_format == 'SA1':
-		COLcount = 0
-		tmpPtr = COLPtr
-		for o in mObjects:
-			o.writeCOL(fileW, labels, False)
-			if fileW.tell() != tmpPtr:
-				COLcount += 1
-				tmpPtr = fileW.tell()
-	else:
-		COLcount = 0  # len(vObjects) + len(cObjects)
-		vColCount = 0
-		tmpPtr = fileW.tell()
+		if export_format == 'SA1':
+			COLcount = 0
+			tmpPtr = COLPtr
+			for o in mObjects:
+				o.writeCOL(fileW, labels, False)
+				if fileW.tell() != tmpPtr:
+					COLcount += 1
+					tmpPtr = fileW.tell()
+		else:
+			COLcount = 0  # len(vObjects) + len(cObjects)
+			vColCount = 0
+			tmpPtr = fileW.tell()
+
+			for o in vObjects:
+				o.writeCOL(fileW, labels, True)
+				if fileW.tell() != tmpPtr:
+					COLcount += 1
+					vColCount += 1
+					tmpPtr = fileW.tell()
 
-		for o in vObjects:
-			o.writeCOL(fileW, labels, True)
-			if fileW.tell() != tmpPtr:
-				COLcount += 1
-				vColCount += 1
-				tmpPtr = fileW.tell()
+			tmpPtr = fileW.tell()
 
-		tmpPtr = fileW.tell()
+			for o in cObjects:
+				o.writeCOL(fileW, labels, True)
+				if fileW.tell() != tmpPtr:
+					COLcount += 1
+					tmpPtr = fileW.tell()
 
-		for o in cObjects:
-			o.writeCOL(fileW, labels, True)
-			if fileW.tell() != tmpPtr:
-				COLcount += 1
-				tmpPtr = fileW.tell()
+		stage.add("bytes", fileW.tell() - start)
 
 	# write texture filename
 	if context.scene.saSettings.texFileName == "":
@@ -533,38 +560,42 @@ def write(context,
 	fileW.wUInt(labelsAddress)  # labels address
 	fileW.seek(0, 2)  # then return back to the end
 
-	if DO:
-		print(" == Landtable info ==")
+	if debug:
+		log.debug(" == Landtable info ==")
 		if export_format == 'SA1':
-			print("  COL count:        ",  len(objects))
-			print("  Animation count:  ",  animCount)
-			print("  Landtable Flags:  ",  hex8(ltFlags))
-			print("  Draw distance:    ",  drawDist)
-			print("  COL address:      ",  hex8(COLPtr))
-			print("  Animation address:",  hex8(animPtr))
-			print("  Texture file name:",  texFileName)
-			print("  Tex list pointer: ",  hex8(texListPointer))
+			log.debug("  COL count:         %s", len(objects))
+			log.debug("  Animation count:   %s", animCount)
+			log.debug("  Landtable Flags:   %s", hex8(ltFlags))
+			log.debug("  Draw distance:     %s", drawDist)
+			log.debug("  COL address:       %s", hex8(COLPtr))
+			log.debug("  Animation address: %s", hex8(animPtr))
+			log.debug("  Texture file name: %s", texFileName)
+			log.debug("  Tex list pointer:  %s", hex8(texListPointer))
 		else:
-			print("  COL count:        ",  len(objects))
-			print("  Visual COL count: ",  len(vObjects))
-			print("  Unknown:          ",  hex16(ltFlags))
-			print("  Draw distance:    ",  drawDist)
-			print("  COL address:      ",  hex8(COLPtr))
-			print("  Anim address:     ",  hex8(animPtr))
-			print("  Texture file name:",  texFileName)
-			print("  Tex list pointer: ",  hex8(texListPointer))
-		print(" - - - -\n")
-		print(" == Model hierarchy == \n")
+			log.debug("  COL count:         %s", len(objects))
+			log.debug("  Visual COL count:  %s", len(vObjects))
+			log.debug("  Unknown:           %s", hex16(ltFlags))
+			log.debug("  Draw distance:     %s", drawDist)
+			log.debug("  COL address:       %s", hex8(COLPtr))
+			log.debug("  Anim address:      %s", hex8(animPtr))
+			log.debug("  Texture file name: %s", texFileName)
+			log.debug("  Tex list pointer:  %s", hex8(texListPointer))
+		log.debug(" - - - -\n")
+		log.debug(" == Model hierarchy == \n")
 		for o in objects:
 			marker = " "
 			for r in range(o.hierarchyDepth):
 				marker += "--"
 			if len(marker) > 1:
-				print(marker, o.name)
+				log.debug("%s %s", marker, o.name)
 			else:
-				print("", o.name)
-		print(" - - - -\n")
-
-	common.writeMethaData(fileW, labels, context.scene)
+				log.debug(" %s", o.name)
+		log.debug(" - - - -\n")
+
+	with exportStats.stage("metadata") as stage:
+		start = fileW.tell()
+		common.writeMethaData(fileW, labels, context.scene)
+		stage.add("bytes", fileW.tell() - start)
+		stage.add("labels", len(labels))
 
 	fileW.close()
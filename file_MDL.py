@@ -1,32 +1,33 @@
 import bpy
 import os
 import mathutils
-from . import fileHelper, enums, common, format_BASIC, format_CHUNK, format_GC
+import numpy
+from . import fileHelper, enums, common, format_BASIC, format_CHUNK, format_GC, exportStats, debugLog, fileIndex
 from .common import ModelData
-from typing import Dict, List
+from typing import Dict
 from .prop.properties import SAObjectSettings
-DO = False  # Debug out
+import logging
 
+log = debugLog.getLogger('FILE')
 
 def hex8(number: int):
 	return '{:08x}'.format(number)
 
 def read(context: bpy.types.Context,
-		 filepath: str, noDoubleVerts: bool, console_debug_output: bool):
+		 filepath: str, noDoubleVerts: bool, console_debug_output: bool,
+		 materialCache: common.MaterialCache = None):
 
-	global DO
-	DO = console_debug_output
-	common.DO = DO
-	format_BASIC.DO = DO
-	format_CHUNK.DO = DO
-	format_GC.DO = DO
-	if DO:
-		os.system("cls")
+	if materialCache is None:
+		materialCache = common.MaterialCache()
 
+	debugLog.configureFromPreferences(console_debug_output)
+	debug = log.isEnabledFor(logging.DEBUG)
+
+	format_GC.readParameters.clear()
 	fileR = fileHelper.FileReader(filepath)
 
 	if fileR.filepath is None:
-		print("no valid filepath")
+		log.warning("no valid filepath")
 		return {'CANCELLED'}
 
 	indicator = enums.MDLFormatIndicator(fileR.rULong(0) & ~0xFF00000000000000)
@@ -39,14 +40,14 @@ def read(context: bpy.types.Context,
 	elif indicator == enums.MDLFormatIndicator.SA2BMDL:
 		file_format = 'SA2B'
 	else:
-		print("no Valid file")
+		log.warning("no Valid file")
 		return {'CANCELLED'}
 
-	if DO:
-		print(" == Starting MDL file reading ==")
-		print("  File:", filepath)
-		print("  Format:", file_format, "version", fileVersion)
-		print("  - - - - - -\n")
+	if debug:
+		log.debug(" == Starting MDL file reading ==")
+		log.debug("  File: %s", filepath)
+		log.debug("  Format: %s version %s", file_format, fileVersion)
+		log.debug("  - - - - - -\n")
 
 	# reading meta data
 
@@ -120,45 +121,50 @@ def read(context: bpy.types.Context,
 				elif cnkType == enums.Chunktypes.Description:
 					context.scene.saSettings.description \
 						= fileR.rString(tmpAddr)
-				elif cnkType == enums.Chunktypes.Tool and DO:
-					print("Tool metadata found")
-				elif cnkType == enums.Chunktypes.Texture and DO:
-					print("Texture metadata found")
+				elif cnkType == enums.Chunktypes.Tool and debug:
+					log.debug("Tool metadata found")
+				elif cnkType == enums.Chunktypes.Texture and debug:
+					log.debug("Texture metadata found")
 				elif cnkType == enums.Chunktypes.End:
 					finished = True
 				else:
-					if DO:
-						print("invalid Chunk type:", cnkType.value)
+					if debug:
+						log.debug("invalid Chunk type: %s", cnkType.value)
 
 				tmpAddr = cnkNext
 
-	if DO:
+	if debug:
 		if len(labels) > 0:
-			print("Labels:", len(labels))
+			log.debug("Labels: %s", len(labels))
 			for l in labels.keys():
-				print(hex8(l), labels[l])
+				log.debug("%s %s", hex8(l), labels[l])
 		if context.scene.saSettings.author != "":
-			print("Author:", context.scene.saSettings.author)
+			log.debug("Author: %s", context.scene.saSettings.author)
 		if context.scene.saSettings.description != "":
-			print("Description:", context.scene.saSettings.description)
-		print("\n")
+			log.debug("Description: %s", context.scene.saSettings.description)
+		log.debug("\n")
 
 		if len(animFiles) > 0:
-			print(" == Animation Files ==")
+			log.debug(" == Animation Files ==")
 			for s in animFiles:
-				print(" -", s)
-			print(" - - - - \n")
+				log.debug(" - %s", s)
+			log.debug(" - - - - \n")
 
 		if len(morphFiles) > 0:
-			print(" == Morph Files ==")
+			log.debug(" == Morph Files ==")
 			for s in morphFiles:
-				print(" -", s)
-			print(" - - - - \n")
+				log.debug(" - %s", s)
+			log.debug(" - - - - \n")
+
+		log.debug(" == Reading Models ==")
 
-		print(" == Reading Models ==")
+	# indexing the file structure first, so that invalid pointers
+	# are known before decoding anything
+	index = fileIndex.FileIndex(fileR, labels)
+	nodes = index.addObjects(fileR.rUInt(8), file_format)
+	index.debug()
 
-	objects: List[common.Model] = list()
-	common.readObjects(fileR, fileR.rUInt(8), 0, None, labels, objects)
+	objects = common.readObjectList(fileR, nodes, labels)
 
 	attaches = dict()
 	objID = 0
@@ -167,22 +173,16 @@ def read(context: bpy.types.Context,
 	for o in objects:
 		o.name = str(objID).zfill(numberCount) + "_" + o.name
 		objID += 1
-		if o.meshPtr > 0 and o.meshPtr not in attaches:
+		if o.meshPtr > 0 and index.isValid(o.meshPtr):
 			if file_format == 'SA2':
-				attaches[o.meshPtr] = format_CHUNK.Attach.read(fileR,
-															   o.meshPtr,
-															   len(attaches),
-															   labels)
+				reader = format_CHUNK.Attach.read
 			elif file_format == 'SA1':
-				attaches[o.meshPtr] = format_BASIC.Attach.read(fileR,
-															   o.meshPtr,
-															   len(attaches),
-															   labels)
-			elif file_format == 'SA2B':
-				attaches[o.meshPtr] = format_GC.Attach.read(fileR,
-															o.meshPtr,
-															len(attaches),
-															labels)
+				reader = format_BASIC.Attach.read
+			else:
+				reader = format_GC.Attach.read
+			attaches[o.meshPtr] = index.decode(
+				o.meshPtr, "attach_" + file_format,
+				lambda: reader(fileR, o.meshPtr, len(attaches), labels, index))
 
 	isArmature = False
 	if file_format == 'SA2':
@@ -200,11 +200,13 @@ def read(context: bpy.types.Context,
 		format_CHUNK.ProcessChunkData(objects,
 									  processedAttaches,
 									  noDoubleVerts,
-									  root)
+									  root,
+									  materialCache)
 	elif file_format == 'SA1':
-		format_BASIC.process_BASIC(objects, attaches)
+		format_BASIC.process_BASIC(objects, attaches,
+								   materialCache=materialCache)
 	elif file_format == 'SA2B':
-		format_GC.process_GC(objects, attaches)
+		format_GC.process_GC(objects, attaches, materialCache)
 
 	collection = bpy.data.collections.new(
 		"Import_" + os.path.splitext(os.path.basename(filepath))[0])
@@ -227,27 +229,36 @@ def read(context: bpy.types.Context,
 			modif = c.modifiers.new("deform", 'ARMATURE')
 			modif.object = armatureObj
 
-		armatureMatrix = root.matrix_world
-		root.bone = None
+		# world matrices of all nodes, composed from the local matrices
+		# (parents come first), and then relative to the armature
+		parents, localMatrices = common.getHierarchyArrays(objects)
+		worldMatrices = localMatrices.copy()
+		for i, p in enumerate(parents.tolist()):
+			if p >= 0:
+				worldMatrices[i] = worldMatrices[p] @ localMatrices[i]
+		boneMatrices = numpy.linalg.inv(worldMatrices[0]) @ worldMatrices
 
 		# gotta be in edit mode to add bones
 		context.view_layer.objects.active = armatureObj
 		bpy.ops.object.mode_set(mode='EDIT', toggle=False)
 
-		bones = objects[1:]
 		edit_bones = armatureObj.data.edit_bones
-		for b in bones:
+		editBones = [None] * len(objects)
+		for i in range(1, len(objects)):
+			b = objects[i]
 			bone = edit_bones.new(b.name)
 			bone.layers[0] = True
 			bone.head = (0, 0, 0)
 			bone.tail = (1, 0, 0)
 			bone.saObjflags.fromDictionary(b.objFlags)
 
-			bone.matrix = armatureMatrix.inverted() @ (b.matrix_world)
+			bone.matrix = mathutils.Matrix(boneMatrices[i].tolist())
 			# @ corrective)
 
-			if b.parent.bone is not None:
-				bone.parent = b.parent.bone
+			# the root is the armature itself, not a bone
+			if parents[i] > 0:
+				bone.parent = editBones[parents[i]]
+			editBones[i] = bone
 			b.bone = bone
 
 			bone.use_deform = False
@@ -289,7 +300,7 @@ def read(context: bpy.types.Context,
 
 	context.view_layer.update()
 
-	if DO:
+	if debug:
 		for o in objects:
 			o.debug()
 
@@ -301,21 +312,22 @@ def write(context,
 		  write_Specular,
 		  use_selection,
 		  apply_modifs,
-		  console_debug_output):
+		  console_debug_output,
+		  quantize_GC=False,
+		  sort_GC=False,
+		  optimize_CHUNK=False):
 	from .common import ModelData
 
-	global DO
-	DO = console_debug_output
-	common.DO = DO
-	format_BASIC.DO = DO
-	format_CHUNK.DO = DO
-	format_GC.DO = DO
+	debugLog.configureFromPreferences(console_debug_output)
+	debug = log.isEnabledFor(logging.DEBUG)
 
 	format_CHUNK.writeSpecular = write_Specular
-
-	if DO:
-		# clear console and enable debug outputs
-		os.system("cls")
+	format_GC.quantize = quantize_GC
+	format_GC.sortByUse = sort_GC
+	format_CHUNK.sortByFirstUse = optimize_CHUNK
+	format_CHUNK.materialTemplates.clear()
+	format_CHUNK.polyChunkLists.clear()
+	format_BASIC.materialLists.clear()
 
 	# create the file
 	fileW = fileHelper.FileWriter()  # filepath=filepath)
@@ -333,11 +345,11 @@ def write(context,
 
 	fileW.wULong(indicator.value | (fileVersion << 56))
 
-	if DO:
-		print(" == Starting MDL file exporting ==")
-		print("  File:", filepath)
-		print("  Format:", export_format, "version", fileVersion)
-		print("  - - - - - -\n")
+	if debug:
+		log.debug(" == Starting MDL file exporting ==")
+		log.debug("  File: %s", filepath)
+		log.debug("  Format: %s version %s", export_format, fileVersion)
+		log.debug("  - - - - - -\n")
 
 	fileW.wUInt(0)  # placeholder for the model properties address
 	fileW.wUInt(0)  # placeholder for the labels address
@@ -366,17 +378,22 @@ def write(context,
 		# = format_BASIC.Material.writeMaterials(fileW, materials, labels)
 		# then writing mesh data
 		for m in meshes:
-			matPtr, bscMaterials \
-				= format_BASIC.Material.writeMaterials(fileW,
-													   m.materials,
-													   m.name,
-													   labels)
-			mesh = format_BASIC.Attach.fromMesh(m,
-												global_matrix,
-												matPtr,
-												bscMaterials)
+			with exportStats.stage("writing") as stage:
+				start = fileW.tell()
+				matPtr, bscMaterials \
+					= format_BASIC.Material.writeMaterials(fileW,
+														   m.materials,
+														   m.name,
+														   labels)
+				stage.add("bytes", fileW.tell() - start)
+			with exportStats.stage("chunks") as stage:
+				mesh = format_BASIC.Attach.fromMesh(m,
+													global_matrix,
+													matPtr,
+													bscMaterials)
+				stage.add("meshes")
 			if mesh is not None:
-				mesh.write(fileW, labels, meshDict)
+				common.writeAttach(mesh, fileW, labels, meshDict)
 
 	elif export_format == 'SA2':
 		# armature meshes get written differently
@@ -384,17 +401,21 @@ def write(context,
 					  and isinstance(objects[0], common.Armature))
 		if not isArmature:
 			for m in meshes:
-				mesh = format_CHUNK.Attach.fromMesh(m,
-													global_matrix,
-													materials)
+				with exportStats.stage("chunks") as stage:
+					mesh = format_CHUNK.Attach.fromMesh(m,
+														global_matrix,
+														materials)
+					stage.add("meshes")
 				if mesh is not None:
-					mesh.write(fileW, labels, meshDict)
+					common.writeAttach(mesh, fileW, labels, meshDict)
 
 	else:
 		for m in meshes:
-			mesh = format_GC.Attach.fromMesh(m, global_matrix, materials)
+			with exportStats.stage("chunks") as stage:
+				mesh = format_GC.Attach.fromMesh(m, global_matrix, materials)
+				stage.add("meshes")
 			if mesh is not None:
-				mesh.write(fileW, labels, meshDict)
+				common.writeAttach(mesh, fileW, labels, meshDict)
 
 	# writing model data
 	if export_format == 'SA2' and isArmature:  # writing an armature
@@ -404,7 +425,10 @@ def write(context,
 											labels)
 	else:
 		ModelData.updateMeshPointer(objects, meshDict)
-		modelPtr = ModelData.writeObjectList(objects, fileW, labels)
+		with exportStats.stage("writing") as stage:
+			start = fileW.tell()
+			modelPtr = ModelData.writeObjectList(objects, fileW, labels)
+			stage.add("bytes", fileW.tell() - start)
 
 	labelsAddress = fileW.tell()
 	fileW.seek(8, 0)  # go to the location of the model properties addrees
@@ -412,23 +436,27 @@ def write(context,
 	fileW.wUInt(labelsAddress)
 	fileW.seek(0, 2)  # then return back to the end
 
-	if DO:
-		print(" == Model file info ==")
-		print("  model pointer: ", hex8(modelPtr))
-		print("  labels pointer:", hex8(labelsAddress))
-		print(" - - - -\n")
-		print(" == Model hierarchy == \n")
+	if debug:
+		log.debug(" == Model file info ==")
+		log.debug("  model pointer:  %s", hex8(modelPtr))
+		log.debug("  labels pointer: %s", hex8(labelsAddress))
+		log.debug(" - - - -\n")
+		log.debug(" == Model hierarchy == \n")
 		for o in objects:
 			marker = " "
 			for r in range(o.hierarchyDepth):
 				marker += "--"
 			if len(marker) > 1:
-				print(marker, o.name)
+				log.debug("%s %s", marker, o.name)
 			else:
-				print("", o.name)
-		print(" - - - -\n")
+				log.debug(" %s", o.name)
+		log.debug(" - - - -\n")
 
 	# writing chunk data
-	common.writeMethaData(fileW, labels, context.scene)
+	with exportStats.stage("metadata") as stage:
+		start = fileW.tell()
+		common.writeMethaData(fileW, labels, context.scene)
+		stage.add("bytes", fileW.tell() - start)
+		stage.add("labels", len(labels))
 
 	fileW.close()
@@ -3,14 +3,18 @@ import mathutils
 
 import math
 import os
+import logging
+import numpy
 from typing import List, Dict, Tuple
 
-from . import enums, fileHelper, strippifier, common
+from . import enums, fileHelper, strippifier, common, debugLog, fileIndex
 from .common import Vector3, ColorARGB, UV, BoundingBox
 
 # note: In sa2's case, the BASIC model format is only used for collisions.
 
-DO = False  # debug out
+log = debugLog.getLogger('BASIC')
+# written material arrays of the current export, by content
+materialLists: Dict[bytes, int] = dict()
 
 class Material:
 	"""Material of a mesh"""
@@ -141,13 +145,19 @@ class Material:
 						mFlags)
 
 	def debug(self):
-		"""prints material info to the console"""
-		print("  Material:", self.name)
-		print("    Diffuse:", str(self.diffuse))
-		print("    Specular:", str(self.specular))
-		print("    Specularity:", self.exponent)
-		print("    Texture ID:", self.textureID)
-		print("    Flags:", self.mFlags, "\n")
+		"""logs the material info"""
+		log.debug("  Material: %s\n"
+				  "    Diffuse: %s\n"
+				  "    Specular: %s\n"
+				  "    Specularity: %f\n"
+				  "    Texture ID: %i\n"
+				  "    Flags: %s\n",
+				  self.name,
+				  self.diffuse,
+				  self.specular,
+				  self.exponent,
+				  self.textureID,
+				  self.mFlags)
 
 	@classmethod
 	def writeMaterials(cls,
@@ -155,24 +165,37 @@ class Material:
 					   materials: List[bpy.types.Material],
 					   meshname: str,
 					   labels: dict) -> Tuple[int, list]:
-		"""writes materials as BASIC materal data"""
-		mats = list()
-		addr = fileW.tell()
-		labels[addr] = "matlist_" + meshname
+		"""writes materials as BASIC materal data
 
+		Material arrays that were already written in this export (same
+		materials in the same order) are not written again; the address
+		of the existing array is returned instead"""
+		mats = list()
 		if len(materials) == 0:
-			bMat = Material()
-			bMat.write(fileW)
-			mats.append(bMat)
+			mats.append(Material())
 		else:
 			for m in materials.values():
-				bMat = Material.fromBlenderMat(m)
-				bMat.write(fileW)
-				mats.append(bMat)
+				mats.append(Material.fromBlenderMat(m))
+
+		data = fileHelper.ByteWriter()
+		data.setBigEndian(fileW.isBigEndian())
+		for m in mats:
+			m.write(data)
+		data = data.getBytes()
+
+		addr = materialLists.get(data)
+		if addr is not None:
+			log.debug(" Reusing materials of %s for %s",
+					  labels.get(addr, hex(addr)), meshname)
+			return [addr, mats]
+
+		addr = fileW.tell()
+		labels[addr] = "matlist_" + meshname
+		fileW.w(data)
+		materialLists[data] = addr
 
-		global DO
-		if DO:
-			print(" == BASIC Materials ==")
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug(" == BASIC Materials ==")
 			for m in mats:
 				m.debug()
 
@@ -229,6 +252,112 @@ class PolyVert:
 
 		return eID and ePNRM and eVC and eUV
 
+class PolyData:
+	"""The polygon corners of a mesh set read from a file, stored as arrays
+
+	Each array holds one entry per corner, in file order. The
+	corner attributes that the mesh set doesnt have are None
+	"""
+
+	polyType: enums.PolyType
+	indices: numpy.ndarray
+	sizes: numpy.ndarray
+	reverse: numpy.ndarray
+	normals: numpy.ndarray
+	colors: numpy.ndarray
+	uvs: numpy.ndarray
+
+	def __init__(self,
+				 polyType: enums.PolyType,
+				 indices: numpy.ndarray,
+				 sizes: numpy.ndarray,
+				 reverse: numpy.ndarray,
+				 normals: numpy.ndarray,
+				 colors: numpy.ndarray,
+				 uvs: numpy.ndarray):
+		self.polyType = polyType
+		self.indices = indices
+		self.sizes = sizes
+		self.reverse = reverse
+		self.normals = normals
+		self.colors = colors
+		self.uvs = uvs
+
+	@property
+	def cornerCount(self) -> int:
+		return len(self.indices)
+
+	def getTriangles(self) -> numpy.ndarray:
+		"""Returns the corners of every triangle
+		as an array of shape (triangle count, 3)"""
+		if self.polyType == enums.PolyType.Triangles:
+			return numpy.arange(self.cornerCount).reshape(-1, 3)
+		elif self.polyType == enums.PolyType.Quads:
+			quads = numpy.arange(self.cornerCount).reshape(-1, 4)
+			return quads[:, [0, 1, 2, 2, 1, 3]].reshape(-1, 3)
+		else:
+			# npolys get treated like strips
+			return common.stripsToTriangles(self.sizes, self.reverse)
+
+	@classmethod
+	def read(cls,
+			 fileR: fileHelper.FileReader,
+			 polyType: enums.PolyType,
+			 polyCount: int,
+			 polyPtr: int,
+			 polyNrmPtr: int,
+			 colPtr: int,
+			 uvPtr: int):
+
+		if polyType in (enums.PolyType.Strips, enums.PolyType.NPoly):
+			# the polygon sizes are stored in front of each polygon,
+			# so we first have to find them before we can read the indices
+			headers = numpy.empty(polyCount, dtype=numpy.int64)
+			sizes = numpy.empty(polyCount, dtype=numpy.int64)
+			ptr = polyPtr
+			for p in range(polyCount):
+				size = fileR.rUShort(ptr)
+				headers[p] = size
+				if polyType == enums.PolyType.Strips:
+					size &= 0x7FFF
+				sizes[p] = size
+				ptr += 2 + size * 2
+
+			# reading everything at once and removing the sizes again
+			data = fileR.rArray("H", polyPtr, (ptr - polyPtr) // 2)
+			indices = numpy.delete(
+				data, numpy.cumsum(sizes + 1) - (sizes + 1))
+			if polyType == enums.PolyType.Strips:
+				reverse = (headers & 0x8000) > 0
+			else:
+				reverse = numpy.zeros(polyCount, dtype=bool)
+		else:
+			size = 3 if polyType == enums.PolyType.Triangles else 4
+			indices = fileR.rArray("H", polyPtr, polyCount * size)
+			sizes = numpy.full(polyCount, size, dtype=numpy.int64)
+			reverse = numpy.zeros(polyCount, dtype=bool)
+
+		count = len(indices)
+		normals = None
+		if polyNrmPtr:
+			normals = fileR.rArray("f", polyNrmPtr, count * 3).reshape(-1, 3)
+
+		colors = None
+		if colPtr:
+			colors = fileR.rArray("I", colPtr, count)
+
+		uvs = None
+		if uvPtr:
+			uvs = fileR.rArray("h", uvPtr, count * 2).reshape(-1, 2)
+
+		return PolyData(polyType,
+						indices,
+						sizes,
+						reverse,
+						normals,
+						colors,
+						uvs)
+
 class MeshSet:
 	"""A single mesh set in the model"""
 
@@ -243,6 +372,9 @@ class MeshSet:
 	polys: List[List[PolyVert]]
 	reverse: List[bool]
 
+	# the polygon corners of a mesh set that was read from a file
+	polyData: PolyData
+
 	polyPtr: int
 	polyAttribs: int
 	polyNormalPtr: int
@@ -259,7 +391,8 @@ class MeshSet:
 				 useColor: bool,
 				 useUV: bool,
 				 polyAttribs: int = 0,
-				 reverse: List[bool] = None
+				 reverse: List[bool] = None,
+				 polyData: PolyData = None
 				 ):
 		self.name = name
 		self.materialID = materialID
@@ -267,14 +400,20 @@ class MeshSet:
 		self.polytype = polyType
 		self.polys = polys
 		self.polyAttribs = polyAttribs
-		self.polycount = len(polys) \
-			if polyType == enums.PolyType.Strips \
-			or polyType == enums.PolyType.NPoly \
-			else round(len(polys[0]) / 3)
-		if reverse is None:
-			self.reverse = [False for s in self.polys]
+		self.polyData = polyData
+
+		if polyData is not None:
+			self.polycount = len(polyData.sizes)
+			self.reverse = list(polyData.reverse)
 		else:
-			self.reverse = reverse
+			self.polycount = len(polys) \
+				if polyType == enums.PolyType.Strips \
+				or polyType == enums.PolyType.NPoly \
+				else round(len(polys[0]) / 3)
+			if reverse is None:
+				self.reverse = [False for s in self.polys]
+			else:
+				self.reverse = reverse
 
 		self.polyNormalPtr = -1 if usePolyNormals else 0
 		self.ColorPtr = -1 if useColor else 0
@@ -359,63 +498,24 @@ class MeshSet:
 		colPtr = fileR.rUInt(address + 16)
 		uvPtr = fileR.rUInt(address + 20)
 
-		polys = list()
-		reverse = list() if polyType == enums.PolyType.Strips else None
-		for p in range(polyCount):
-			vCount = 3
-			if polyType == enums.PolyType.Strips:
-				vCount = fileR.rUShort(polyPtr)
-				rev = bool(vCount & 0x8000)
-				reverse.append(rev)
-				vCount = vCount & 0x7FFF
-				if rev:
-					vCount = abs(vCount)
-				polyPtr += 2
-			elif polyType == enums.PolyType.NPoly:
-				vCount = fileR.rUShort(polyPtr)
-				polyPtr += 2
-			elif polyType == enums.PolyType.Quads:
-				vCount = 4
-
-			polyVerts = list()
-			for v in range(vCount):
-
-				vIndex = fileR.rUShort(polyPtr)
-				polyPtr += 2
-
-				polyNormal = Vector3()
-				if polyNrmPtr:
-					polyNormal = Vector3(
-						(fileR.rFloat(polyNrmPtr),
-						 fileR.rFloat(polyNrmPtr + 4),
-						 fileR.rFloat(polyNrmPtr + 8)))
-					polyNrmPtr += 12
-
-				color = ColorARGB()
-				if colPtr:
-					color = ColorARGB.fromARGB(fileR.rUInt(colPtr))
-					colPtr += 4
-
-				uv = UV()
-				if uvPtr:
-					uv.x = fileR.rShort(uvPtr)
-					uv.y = fileR.rShort(uvPtr + 2)
-					uvPtr += 4
-
-				polyVerts.append(PolyVert(vIndex, polyNormal, color, uv))
-
-			polys.append(polyVerts)
+		polyData = PolyData.read(fileR,
+								 polyType,
+								 polyCount,
+								 polyPtr,
+								 polyNrmPtr,
+								 colPtr,
+								 uvPtr)
 
 		return MeshSet(meshName,
 					   materialID,
 					   setID,
 					   polyType,
-					   polys,
+					   None,
 					   polyNrmPtr > 0,
 					   colPtr > 0,
 					   uvPtr > 0,
 					   polyAttribs,
-					   reverse)
+					   polyData=polyData)
 
 class Attach:
 	"""Attach for the BASIC format"""
@@ -453,7 +553,6 @@ class Attach:
 				 materials: List[Material],
 				 isCollision: bool = False):
 		"""Creates a BASIC mesh from a Blender mesh"""
-		global DO
 
 		# gettings the positions and normals
 		positions = [None] * len(mesh.vertices)
@@ -572,7 +671,8 @@ class Attach:
 									setUseUV = False
 								break
 					except ValueError:
-						print(" material", mesh.materials[i].name, "not found")
+						log.warning(" material %s not found",
+									mesh.materials[i].name)
 
 				meshsets.append(
 					MeshSet(mesh.name,
@@ -586,7 +686,8 @@ class Attach:
 							reverse=stripReverse[i]))
 
 		if len(meshsets) == 0:
-			print(" Mesh not valid (?); no meshsets could be created")
+			log.warning(" Mesh %s not valid (?); no meshsets could be created",
+						mesh.name)
 			return None
 		return Attach(mesh.name,
 					  positions,
@@ -600,7 +701,6 @@ class Attach:
 			  fileW: fileHelper.FileWriter,
 			  labels: dict,
 			  meshDict: dict = None):
-		global DO
 
 		posPtr = fileW.tell()
 		labels[posPtr] = self.name + "_pos"
@@ -625,7 +725,6 @@ class Attach:
 
 		# writing attach info
 		attachPtr = fileW.tell()
-		print(self.name)
 		if self.name in bpy.data.objects:
 			labels[attachPtr] = "mdl_" + self.name
 		else:
@@ -641,20 +740,27 @@ class Attach:
 		fileW.wUShort(max(1, len(self.materials)))
 		self.bounds.write(fileW)
 
-		if DO:
-			print("  BASIC:", self.name)
-			print("    Position Ptr:", common.hex4(posPtr))
-			print("    Normal Ptr:", common.hex4(nrmPtr))
-			print("    Vertices:", len(self.positions))
-			print("    Mesh set Ptr:", common.hex4(setPtr))
-			print("    Mesh sets:", len(self.meshSets), "\n")
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug("  BASIC: %s\n"
+					  "    Position Ptr: %s\n"
+					  "    Normal Ptr: %s\n"
+					  "    Vertices: %i\n"
+					  "    Mesh set Ptr: %s\n"
+					  "    Mesh sets: %i\n",
+					  self.name,
+					  common.hex4(posPtr),
+					  common.hex4(nrmPtr),
+					  len(self.positions),
+					  common.hex4(setPtr),
+					  len(self.meshSets))
 
 	@classmethod
 	def read(cls,
 			 fileR: fileHelper.FileReader,
 			 address: int,
 			 meshID: int,
-			 labels: dict):
+			 labels: dict,
+			 index: fileIndex.FileIndex = None):
 
 		if address in labels:
 			name: str = labels[address]
@@ -694,13 +800,13 @@ class Attach:
 			meshSets.append(MeshSet.read(fileR, tempAddr, name, m))
 			tempAddr += 24
 
-		tempAddr = fileR.rUInt(address + 16)
+		matPtr = fileR.rUInt(address + 16)
 		materialCount = fileR.rUShort(address + 22)
-		materials: List[Material] = list()
-
-		for m in range(materialCount):
-			materials.append(Material.read(fileR, tempAddr, m))
-			tempAddr += 20
+		# material lists are often shared between attaches
+		materials: List[Material] = fileIndex.decode(
+			index, matPtr, "materials",
+			lambda: [Material.read(fileR, matPtr + m * 20, m)
+					 for m in range(materialCount)])
 
 		return Attach(name,
 					  positions,
@@ -712,13 +818,14 @@ class Attach:
 
 def process_BASIC(models: List[common.Model],
 				  attaches: Dict[int, Attach],
-				  collision=False):
+				  collision=False,
+				  materialCache: common.MaterialCache = None):
 
-	import bmesh
 	meshes: Dict[int, bpy.types.Mesh] = dict()
 
-	materials: List[bpy.types.Material] = list()
-	matDicts: List[dict] = list()
+	if materialCache is None:
+		materialCache = common.MaterialCache()
+	matPrefix = "collision_" if collision else "material_"
 
 	for o in models:
 		if o.meshPtr == 0 or o.meshPtr not in attaches:
@@ -806,131 +913,95 @@ def process_BASIC(models: List[common.Model],
 			else:
 				d["b_destAlpha"] = 'ZERO'
 
-			material = None
-
-			for md, mt in zip(matDicts, materials):
-				if md == d:
-					material = mt
-					break
-
-			if material is None:
-
-				material = bpy.data.materials.new(
-					name=("collision_" if collision else "material_")
-					+ str(len(materials)))
-				material.saSettings.readMatDict(d)
-
-				materials.append(material)
-				matDicts.append(d)
+			material = materialCache.get(d, matPrefix)
 
 			if material not in meshMaterials:
 				meshMaterials.append(material)
 
 			matIDs.append(meshMaterials.index(material))
 
-		polySets: List[List[List[PolyVert]]] = [[] for m in meshMaterials]
-
 		hasColor = False
 		hasUV = False
-
 		for m in attach.meshSets:
-			if m.ColorPtr == -1:
+			if m.polyData.colors is not None:
 				hasColor = True
-			if m.UVPtr == -1:
+			if m.polyData.uvs is not None:
 				hasUV = True
 
-			polySet: List[List[PolyVert]] = list()
-
-			if m.polytype in [enums.PolyType.Strips, enums.PolyType.NPoly]:
-				for s, r in zip(m.polys, m.reverse):
-					for p in range(len(s) - 2):
-						if r:
-							poly = (s[p+1], s[p], s[p+2])
-						else:
-							poly = (s[p], s[p+1], s[p+2])
-						indices = [s[p + sp].polyIndex for sp in range(3)]
-						if len(set(indices)) == 3:
-							polySet.append(poly)
-
-						r = not r
-			elif m.polytype == enums.PolyType.Quads:
-				for p in m.polys:
-					polySet.append((p[0], p[1], p[2]))
-					polySet.append((p[2], p[1], p[3]))
-			else:
-				polySet = m.polys
-
-			polySets[matIDs[m.materialID]].extend(polySet)
+		# the triangles of each material; vertex indices, uvs and colors
+		# with one row per triangle
+		polySets = [([], [], []) for m in meshMaterials]
+		matIDs = [matIDs[m.materialID] for m in attach.meshSets]
+
+		for m, matID in zip(attach.meshSets, matIDs):
+			data = m.polyData
+			tris = data.getTriangles()
+			polySet = polySets[matID]
+
+			polySet[0].append(data.indices[tris])
+
+			if hasUV:
+				if data.uvs is None:
+					uvs = numpy.zeros((len(tris), 3, 2), dtype=numpy.float32)
+				else:
+					uvs = data.uvs[tris] / 255.0
+					uvs[..., 1] = 1 - uvs[..., 1]
+				polySet[1].append(uvs)
+
+			if hasColor:
+				if data.colors is None:
+					colors = numpy.ones((len(tris), 3, 4), dtype=numpy.float32)
+				else:
+					argb = data.colors[tris]
+					colors = numpy.stack(((argb >> 16) & 0xFF,
+										  (argb >> 8) & 0xFF,
+										  argb & 0xFF,
+										  (argb >> 24) & 0xFF),
+										 axis=-1) / 255.0
+				polySet[2].append(colors)
 
 		# creating mesh
 		mesh = bpy.data.meshes.new(attach.name)
-		matIDs = dict()
-
-		for i, s in enumerate(polySets):
-			if len(s) > 0:
-				matIDs[i] = len(mesh.materials)
-				mesh.materials.append(meshMaterials[i])
-
-		bm = bmesh.new()
-		bm.from_mesh(mesh)
 
-		for v in attach.positions:
-			bm.verts.new((v.x, -v.z, v.y))
-		bm.verts.ensure_lookup_table()
-		bm.verts.index_update()
-
-		if hasUV:
-			uvLayer = bm.loops.layers.uv.new("UV0")
-		if hasColor:
-			colorLayer = bm.loops.layers.color.new("COL0")
-
-		doubleFaces = 0
-
-		for i, polySet in enumerate(polySets):
-			if len(polySet) == 0:
+		# the triangles get added sorted by material,
+		# and only materials that are used get a slot
+		triangles = list()
+		triMaterials = list()
+		uvs = list()
+		colors = list()
+		for i, (polyVerts, polyUVs, polyColors) in enumerate(polySets):
+			if len(polyVerts) == 0:
 				continue
-			matID = matIDs[i]
-			for p in polySet:
-				verts = []
-				for l in p:
-					verts.append(bm.verts[l.polyIndex])
-				try:
-					face = bm.faces.new(verts)
-				except Exception as e:
-					if not str(e).endswith("exists"):
-						print("Invalid triangle:", str(e))
-					else:
-						doubleFaces += 1
-					continue
-
-				for l, pc in zip(face.loops, p):
-					if hasUV:
-						l[uvLayer].uv = pc.uv.getBlenderUV()
-					if hasColor:
-						l[colorLayer] = pc.color.toBlenderTuple()
-
-				face.smooth = True
-				face.material_index = matID
-
-		if doubleFaces > 0 and DO:
-			print("Double faces:", doubleFaces)
-
-		bm.to_mesh(mesh)
-		bm.clear()
-
-		normals = [mathutils.Vector((n.x, -n.z, n.y)).normalized()
-				   for n in attach.normals]
-
-		mesh.create_normals_split()
-		split_normal = [normals[l.vertex_index] for l in mesh.loops]
-		mesh.normals_split_custom_set(split_normal)
-		mesh.use_auto_smooth = True
-		mesh.auto_smooth_angle = 180
-
-		# dont ask me why, but blender likes to add sharp edges-
-		# we dont need those at all in this case
-		for e in mesh.edges:
-			e.use_edge_sharp = False
+			polyVerts = numpy.concatenate(polyVerts)
+			if len(polyVerts) == 0:
+				continue
+			triangles.append(polyVerts)
+			triMaterials.append(
+				numpy.full(len(polyVerts), len(mesh.materials)))
+			mesh.materials.append(meshMaterials[i])
+			if hasUV:
+				uvs.append(numpy.concatenate(polyUVs))
+			if hasColor:
+				colors.append(numpy.concatenate(polyColors))
+
+		if len(triangles) == 0:
+			triangles.append(numpy.zeros((0, 3), dtype=numpy.int32))
+			triMaterials.append(numpy.zeros(0, dtype=numpy.int32))
+
+		positions = numpy.array([(v.x, -v.z, v.y) for v in attach.positions])
+		normals = numpy.array([(n.x, -n.z, n.y) for n in attach.normals])
+
+		doubleFaces = common.buildMesh(
+			mesh,
+			positions,
+			numpy.concatenate(triangles),
+			numpy.concatenate(triMaterials),
+			numpy.concatenate(uvs) if hasUV else None,
+			numpy.concatenate(colors) if hasColor else None,
+			normals)
+
+		if doubleFaces > 0:
+			log.debug("Double faces: %i", doubleFaces)
 
 		o.meshes.append(mesh)
 		meshes[o.meshPtr] = mesh
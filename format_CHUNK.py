@@ -2,17 +2,26 @@ import bpy
 import mathutils
 
 import array
-import copy
-import math
 from typing import List, Dict, Tuple
 import collections
+import logging
+import numpy
 
-from . import enums, fileHelper, strippifier, common
+from . import enums, fileHelper, strippifier, common, debugLog, fileIndex
 from .common import Vector3, ColorARGB, UV, BoundingBox
 from .prop.properties import SAMaterialSettings
 
-DO = False
+log = debugLog.getLogger('CHUNK')
 writeSpecular = True
+# whether unused vertices should be removed and the rest ordered by first use
+sortByFirstUse = False
+# material templates of the current export, by material name
+materialTemplates: Dict[str, 'MaterialTemplate'] = dict()
+# poly chunk lists written in the current export (data: address). only
+# complete, byte-identical lists get shared; lists that merely start the
+# same or contain one another are written separately. has to be cleared
+# by every writer before it writes anything (see file_MDL and file_LVL)
+polyChunkLists: Dict[bytes, int] = dict()
 
 class Vertex:
 	"""A single vertex in the model, stored in vertex chunksd"""
@@ -73,6 +82,65 @@ class Vertex:
 		self.nrm.write(fileW)
 		fileW.wUInt(self.ninjaFlags)
 
+# value type and count of each vertex chunk field
+VERTEX_FIELDS = {
+	"pos": ("f", 3),
+	"posSH": ("f", 4),
+	"nrm": ("f", 3),
+	"nrmSH": ("f", 4),
+	"nrmX": ("I", 1),  # 10 bits per axis
+	"diffuse8": ("I", 1),  # ARGB8888
+	"diffuse5": ("H", 1),  # RGB565
+	"diffuse4": ("H", 1),  # ARGB4444
+	"intensity": ("H", 1),
+	"specular": ("H", 1),
+	"userFlags": ("I", 1),
+	"ninjaFlags": ("I", 1),
+}
+
+# the fields of each vertex chunk type, in order
+VERTEX_LAYOUTS = {
+	enums.ChunkType.Vertex_VertexSH: ("posSH",),
+	enums.ChunkType.Vertex_VertexNormalSH: ("posSH", "nrmSH"),
+	enums.ChunkType.Vertex_Vertex: ("pos",),
+	enums.ChunkType.Vertex_VertexDiffuse8: ("pos", "diffuse8"),
+	enums.ChunkType.Vertex_VertexUserFlags: ("pos", "userFlags"),
+	enums.ChunkType.Vertex_VertexNinjaFlags: ("pos", "ninjaFlags"),
+	enums.ChunkType.Vertex_VertexDiffuseSpecular5: ("pos", "diffuse5", "specular"),
+	enums.ChunkType.Vertex_VertexDiffuseSpecular4: ("pos", "diffuse4", "specular"),
+	enums.ChunkType.Vertex_VertexDiffuseSpecular16: ("pos", "intensity", "specular"),
+	enums.ChunkType.Vertex_VertexNormal: ("pos", "nrm"),
+	enums.ChunkType.Vertex_VertexNormalDiffuse8: ("pos", "nrm", "diffuse8"),
+	enums.ChunkType.Vertex_VertexNormalUserFlags: ("pos", "nrm", "userFlags"),
+	enums.ChunkType.Vertex_VertexNormalNinjaFlags: ("pos", "nrm", "ninjaFlags"),
+	enums.ChunkType.Vertex_VertexNormalDiffuseSpecular5: ("pos", "nrm", "diffuse5", "specular"),
+	enums.ChunkType.Vertex_VertexNormalDiffuseSpecular4: ("pos", "nrm", "diffuse4", "specular"),
+	enums.ChunkType.Vertex_VertexNormalDiffuseSpecular16: ("pos", "nrm", "intensity", "specular"),
+	enums.ChunkType.Vertex_VertexNormalX: ("pos", "nrmX"),
+	enums.ChunkType.Vertex_VertexNormalXDiffuse8: ("pos", "nrmX", "diffuse8"),
+	enums.ChunkType.Vertex_VertexNormalXUserFlags: ("pos", "nrmX", "userFlags"),
+}
+
+def getVertexDtype(chunkType: enums.ChunkType, endian: str) -> numpy.dtype:
+	"""Returns the record type of a single vertex of a vertex chunk type"""
+	fields = list()
+	for f in VERTEX_LAYOUTS[chunkType]:
+		valueType, count = VERTEX_FIELDS[f]
+		if count == 1:
+			fields.append((f, endian + valueType))
+		else:
+			fields.append((f, endian + valueType, (count,)))
+	return numpy.dtype(fields)
+
+def expandBits(values: numpy.ndarray, shift: int, bits: int) -> numpy.ndarray:
+	"""Extracts a color channel and scales it to 0 - 255"""
+	mask = (1 << bits) - 1
+	return (((values >> shift) & mask) * 255 + (mask >> 1)) // mask
+
+def toBlenderAxes(values: numpy.ndarray) -> numpy.ndarray:
+	"""Converts (x, y, z) rows to blenders (x, -z, y)"""
+	return values[:, (0, 2, 1)] * (1, -1, 1)
+
 class VertexChunk:
 	"""One vertex data set"""
 
@@ -95,15 +163,11 @@ class VertexChunk:
 		self.vertices = vertices
 
 	def vertexSize(self) -> int:
-		if self.chunkType == enums.ChunkType.Vertex_VertexDiffuse8:
-			return 4
-		elif self.chunkType == enums.ChunkType.Vertex_VertexNormal:
-			return 6
-		elif self.chunkType == enums.ChunkType.Vertex_VertexNormalNinjaFlags:
-			return 7
-		else:
-			print("unsupported chunk format:", self.chunkType)
+		"""Size of a single vertex in 4 byte units"""
+		if self.chunkType not in VERTEX_LAYOUTS:
+			log.warning("unsupported chunk format: %s", self.chunkType)
 			return 0
+		return getVertexDtype(self.chunkType, "<").itemsize // 4
 
 	def write(self, fileW: fileHelper.FileWriter):
 		fileW.wByte(self.chunkType.value)
@@ -125,6 +189,117 @@ class VertexChunk:
 			for v in self.vertices:
 				v.writeNRMW(fileW)
 
+	def split(self) -> List['VertexChunk']:
+		"""Splits the chunk into as few chunks as possible that stay within
+		the size (in 4 byte units) and vertex count limits"""
+		vertexSize = self.vertexSize()
+		maxCount = min(0xFFFF, (0xFFFF - 1) // max(1, vertexSize))
+		if len(self.vertices) <= maxCount:
+			return [self]
+
+		result = list()
+		offset = self.indexBufferOffset
+		for start in range(0, len(self.vertices), maxCount):
+			chunkV = self.vertices[start:start + maxCount]
+			if offset + len(chunkV) > 0xFFFF:
+				raise common.ExportError(
+					"Too many vertices; the index buffer offset exceeds 0xFFFF")
+			result.append(VertexChunk(self.chunkType,
+									  self.weightType,
+									  self.weightContinue,
+									  offset,
+									  chunkV))
+			offset += len(chunkV)
+		return result
+
+	@classmethod
+	def read(cls,
+			 fileR: fileHelper.FileReader,
+			 address: int) -> Tuple['VertexChunk', int]:
+		"""Reads a vertex chunk; returns the chunk and the address after it"""
+		chunkType = enums.ChunkType(fileR.rByte(address))
+		flags = fileR.rByte(address + 1)
+		weightStatus = enums.WeightStatus(flags & 0x3)
+		otherFlags = flags & ~0x3
+		indexBufferOffset = fileR.rUShort(address + 4)
+		vertexCount = fileR.rUShort(address + 6)
+		address += 8
+
+		if chunkType not in VERTEX_LAYOUTS:
+			log.warning("unsupported chunk format: %s", chunkType)
+			# the size is counted in 4 byte units, and includes the
+			# index offset and vertex count
+			address += (fileR.rUShort(address - 6) - 1) * 4
+			return VertexChunk(chunkType, weightStatus, (otherFlags & 0x80) > 0,
+							   indexBufferOffset, list()), address
+
+		dtype = getVertexDtype(chunkType, fileR.endian)
+		data = numpy.frombuffer(fileR.fileC, dtype, vertexCount, address)
+		address += dtype.itemsize * vertexCount
+		fields = dtype.names
+
+		# positions and normals
+		if "pos" in fields:
+			positions = toBlenderAxes(data["pos"])
+		else:
+			positions = toBlenderAxes(data["posSH"][:, :3])
+
+		normals = None
+		if "nrm" in fields:
+			normals = toBlenderAxes(data["nrm"])
+		elif "nrmSH" in fields:
+			normals = toBlenderAxes(data["nrmSH"][:, :3])
+		elif "nrmX" in fields:
+			packed = data["nrmX"].astype(numpy.int64)
+			axes = numpy.stack(((packed >> 20) & 0x3FF,
+								(packed >> 10) & 0x3FF,
+								packed & 0x3FF), axis=1)
+			# signed 10 bit values
+			axes = numpy.where(axes > 0x1FF, axes - 0x400, axes) / 511.0
+			normals = toBlenderAxes(axes)
+
+		# colors, as packed ARGB values
+		colors = None
+		if "diffuse8" in fields:
+			colors = data["diffuse8"].astype(numpy.int64)
+		elif "diffuse5" in fields:
+			c = data["diffuse5"].astype(numpy.int64)
+			colors = 0xFF000000 | (expandBits(c, 11, 5) << 16) \
+				| (expandBits(c, 5, 6) << 8) | expandBits(c, 0, 5)
+		elif "diffuse4" in fields:
+			c = data["diffuse4"].astype(numpy.int64)
+			colors = (expandBits(c, 12, 4) << 24) | (expandBits(c, 8, 4) << 16) \
+				| (expandBits(c, 4, 4) << 8) | expandBits(c, 0, 4)
+		elif "intensity" in fields:
+			c = (data["intensity"].astype(numpy.int64) >> 8) & 0xFF
+			colors = 0xFF000000 | (c << 16) | (c << 8) | c
+
+		# weights
+		if "ninjaFlags" in fields:
+			ninjaFlags = data["ninjaFlags"].astype(numpy.int64)
+			indices = ninjaFlags & 0xFFFF
+			weights = ((ninjaFlags >> 16) & 0xFF) / 255.0
+		else:
+			indices = numpy.arange(vertexCount)
+			weights = numpy.zeros(vertexCount)
+
+		indices = indices.tolist()
+		weights = weights.tolist()
+		positions = positions.tolist()
+		normals = [None] * vertexCount if normals is None else normals.tolist()
+		colors = [None] * vertexCount if colors is None \
+			else [ColorARGB.fromARGB(c) for c in colors.tolist()]
+
+		vertices = [Vertex(i, i, Vector3(p), None if n is None else Vector3(n), c, w)
+					for i, p, n, c, w
+					in zip(indices, positions, normals, colors, weights)]
+
+		return VertexChunk(chunkType,
+						   weightStatus,
+						   (otherFlags & 0x80) > 0,
+						   indexBufferOffset,
+						   vertices), address
+
 class PolyVert:
 	"""A single polygon corner of a mesh"""
 
@@ -151,10 +326,18 @@ class PolyChunk:
 	"""Base polychunk"""
 
 	chunkType: enums.ChunkType
+	packed: bytes = None  # precomputed chunk data
 
 	def __init__(self, chunkType: enums.ChunkType):
 		self.chunkType = chunkType
 
+	def pack(self):
+		"""Precomputes the chunk data, which will be written instead.
+		The chunk should not be modified afterwards"""
+		writer = fileHelper.ByteWriter()
+		self.write(writer)
+		self.packed = writer.getBytes()
+
 	def write(self, fileW: fileHelper.FileWriter):
 		fileW.wByte(self.chunkType.value)
 
@@ -403,42 +586,52 @@ class PolyChunk_Strip(PolyChunk):
 
 		c = chunkType.value
 		hasUV = c == 65 or c == 66 or c == 68 or c == 69 or c == 71 or c == 72
-		hasNRM = 1 if c >= 67 and c <= 69 else 0
-		hasCOL = 1 if c >= 70 and c <= 72 else 0
+		# UVH coordinates range from 0 to 1023 instead of 0 to 255
+		uvScale = 255 / 1023 if c == 66 or c == 69 or c == 72 else 1
+
+		# every corner holds an index and optionally uv, normal and
+		# color; from the third corner on, each corner also has the
+		# user flags of the triangle that it completes
+		fields = [("index", fileR.endian + "H")]
+		if hasUV:
+			fields.append(("uv", fileR.endian + "h", (2,)))
+		if c >= 67 and c <= 69:
+			fields.append(("nrm", fileR.endian + "f", (3,)))
+		if c >= 70 and c <= 72:
+			fields.append(("col", fileR.endian + "I"))
+		cornerType = numpy.dtype(fields)
+		if userFlagCount > 0:
+			fields.append(("userFlags", fileR.endian + "H", (userFlagCount,)))
+		triangleType = numpy.dtype(fields)
+
+		noUV = UV()
 
 		for i in range(stripCount):
-			strip = list()
 			pCount = fileR.rShort(address)
 			reverse = pCount < 0
-
 			if reverse:
 				pCount = abs(pCount)
-
 			address += 2
-			for p in range(pCount):
-				vIndex = fileR.rUShort(address)
-				address += 2
-
-				# check uv
-				uv = UV()
-				if hasUV:
-					u = fileR.rShort(address)
-					v = fileR.rShort(address + 2)
+
+			first = min(2, pCount)
+			corners = numpy.frombuffer(fileR.fileC, cornerType, first, address)
+			address += cornerType.itemsize * first
+			rest = numpy.frombuffer(fileR.fileC, triangleType, pCount - first, address)
+			address += triangleType.itemsize * (pCount - first)
+
+			indices = corners["index"].tolist() + rest["index"].tolist()
+			if hasUV:
+				uvs = numpy.concatenate((corners["uv"], rest["uv"]))
+				if uvScale != 1:
+					uvs = uvs * uvScale
+				strip = list()
+				for index, (u, v) in zip(indices, uvs.tolist()):
 					uv = UV()
 					uv.x = u
 					uv.y = v
-					address += 4
-
-				# check normals
-				address += 12 * hasNRM
-				# check colors
-				address += 4 * hasCOL
-
-				address += userFlagCount * 2
-				strip.append(PolyVert(vIndex, uv))
-
-			# if len(strip) == 3:
-			#    continue
+					strip.append(PolyVert(index, uv))
+			else:
+				strip = [PolyVert(index, noUV) for index in indices]
 
 			reversedStrips.append(reverse)
 			polyVerts.append(strip)
@@ -449,14 +642,63 @@ class PolyChunk_Strip(PolyChunk):
 
 		return polyChunk, address
 
+	def getCornerSize(self) -> int:
+		"""Size of a single strip corner in 2 byte units"""
+		return 3 if self.chunkType == enums.ChunkType.Strip_StripUVN else 1
+
 	def getSize(self):
 		size = 1
-		stripSize = 3 if self.chunkType == enums.ChunkType.Strip_StripUVN \
-			else 1
+		stripSize = self.getCornerSize()
 		for s in self.strips:
 			size += (len(s) * stripSize) + 1
 		return size
 
+	def split(self) -> List['PolyChunk_Strip']:
+		"""Splits the chunk into as few strip chunks as possible that stay
+		within the size (0xFFFF) and strip count (0x3FFF) limits.
+		Strips that are too long by themselves get split into overlapping
+		strips. The material state carries over between strip chunks, so
+		the split chunks dont need their own material and texture chunks"""
+		if self.getSize() <= 0xFFFF and len(self.strips) <= 0x3FFF \
+				and all(len(s) <= 0x7FFF for s in self.strips):
+			return [self]
+
+		cornerSize = self.getCornerSize()
+		hasUV = self.chunkType == enums.ChunkType.Strip_StripUVN
+		# the most corners that fit into a strip: the chunk needs space for
+		# the strip count and the strip for its length
+		maxCorners = min(0x7FFF, (0xFFFF - 2) // cornerSize)
+
+		result = list()
+		strips = list()
+		revStrips = list()
+		size = 1
+		for strip, rev in zip(self.strips, self.reversedStrips):
+			# splitting strips that are too long. every piece overlaps the
+			# previous by 2 corners, and pieces starting at an odd corner
+			# have the opposite facing
+			pieces = list()
+			start = 0
+			while len(strip) - start > maxCorners:
+				pieces.append((strip[start:start + maxCorners], rev != bool(start & 1)))
+				start += maxCorners - 2
+			pieces.append((strip[start:], rev != bool(start & 1)))
+
+			for piece, pieceRev in pieces:
+				stripSize = len(piece) * cornerSize + 1
+				if size + stripSize > 0xFFFF or len(strips) >= 0x3FFF:
+					result.append(PolyChunk_Strip(hasUV, self.flags, strips, revStrips))
+					strips = list()
+					revStrips = list()
+					size = 1
+				strips.append(piece)
+				revStrips.append(pieceRev)
+				size += stripSize
+
+		if len(strips) > 0:
+			result.append(PolyChunk_Strip(hasUV, self.flags, strips, revStrips))
+		return result
+
 	def write(self, fileW: fileHelper.FileWriter):
 		super(PolyChunk_Strip, self).write(fileW)
 		fileW.wByte(self.flags.value)
@@ -474,9 +716,226 @@ class PolyChunk_Strip(PolyChunk):
 				for p in s:
 					p.write(fileW)
 
+class MaterialTemplate:
+	"""The chunk data of a material, resolved once per export
+	and shared by every mesh using the material.
+	Should not be modified after creation"""
+
+	material: PolyChunk_Material
+	texture: PolyChunk_Texture
+	stripFlags: enums.StripFlags
+	stripUVs: bool  # false when environment mapping is used
+	packed: bytes  # material and texture chunk
+
+	def __init__(self,
+				 material: PolyChunk_Material,
+				 texture: PolyChunk_Texture,
+				 stripFlags: enums.StripFlags,
+				 stripUVs: bool):
+		self.material = material
+		self.texture = texture
+		self.stripFlags = stripFlags
+		self.stripUVs = stripUVs
+
+		material.pack()
+		texture.pack()
+		self.packed = material.packed + texture.packed
+
+	@classmethod
+	def get(cls, material: bpy.types.Material) -> 'MaterialTemplate':
+		"""Returns the template of a material (None for the default
+		material), creating it if it wasnt used in this export yet"""
+		key = None if material is None else material.name
+		template = materialTemplates.get(key)
+		if template is None:
+			template = MaterialTemplate.fromMaterial(material)
+			materialTemplates[key] = template
+		return template
+
+	@classmethod
+	def fromMaterial(cls, material: bpy.types.Material) -> 'MaterialTemplate':
+		if material is None:
+			return MaterialTemplate(
+				PolyChunk_Material(enums.SA2AlphaInstructions.SA_SRC
+								   | enums.SA2AlphaInstructions.DA_INV_SRC,
+								   ColorARGB(),
+								   ColorARGB(),
+								   ColorARGB(),
+								   255),
+				PolyChunk_Texture(0,
+								  enums.TextureIDFlags.null,
+								  True,
+								  enums.TextureFiltering.Bilinear),
+				enums.StripFlags.null,
+				True)
+
+		matProps: SAMaterialSettings = material.saSettings
+
+		# getting texture info
+		textureFlags = enums.TextureIDFlags.null
+
+		if matProps.b_d_025:
+			textureFlags |= enums.TextureIDFlags.D_025
+		if matProps.b_d_050:
+			textureFlags |= enums.TextureIDFlags.D_050
+		if matProps.b_d_100:
+			textureFlags |= enums.TextureIDFlags.D_100
+		if matProps.b_d_200:
+			textureFlags |= enums.TextureIDFlags.D_200
+		if matProps.b_clampV:
+			textureFlags |= enums.TextureIDFlags.CLAMP_V
+		if matProps.b_clampU:
+			textureFlags |= enums.TextureIDFlags.CLAMP_U
+		if matProps.b_mirrorV:
+			textureFlags |= enums.TextureIDFlags.FLIP_V
+		if matProps.b_mirrorU:
+			textureFlags |= enums.TextureIDFlags.FLIP_U
+
+		filtering = enums.TextureFiltering.Point
+
+		if matProps.b_texFilter == 'BILINEAR':
+			filtering = enums.TextureFiltering.Bilinear
+		elif matProps.b_texFilter == 'TRILINEAR':
+			filtering = enums.TextureFiltering.Trilinear
+		elif matProps.b_texFilter == 'BLEND':
+			filtering = enums.TextureFiltering.Blend
+
+		# getting alpha
+		alphaflags = enums.SA2AlphaInstructions.null
+		if matProps.b_useAlpha:
+			from .enums import SA2AlphaInstructions
+
+			src = matProps.b_srcAlpha
+			if src == 'ONE':
+				alphaflags |= SA2AlphaInstructions.SA_ONE
+			elif src == 'OTHER':
+				alphaflags |= SA2AlphaInstructions.SA_OTHER
+			elif src == 'INV_OTHER':
+				alphaflags |= SA2AlphaInstructions.SA_INV_OTHER
+			elif src == 'SRC':
+				alphaflags |= SA2AlphaInstructions.SA_SRC
+			elif src == 'INV_SRC':
+				alphaflags |= SA2AlphaInstructions.SA_INV_SRC
+			elif src == 'DST':
+				alphaflags |= SA2AlphaInstructions.SA_DST
+			elif src == 'INV_DST':
+				alphaflags |= SA2AlphaInstructions.SA_INV_DST
+
+			dst = matProps.b_destAlpha
+			if dst == 'ONE':
+				alphaflags |= SA2AlphaInstructions.DA_ONE
+			elif dst == 'OTHER':
+				alphaflags |= SA2AlphaInstructions.DA_OTHER
+			elif dst == 'INV_OTHER':
+				alphaflags |= SA2AlphaInstructions.DA_INV_OTHER
+			elif dst == 'SRC':
+				alphaflags |= SA2AlphaInstructions.DA_SRC
+			elif dst == 'INV_SRC':
+				alphaflags |= SA2AlphaInstructions.DA_INV_SRC
+			elif dst == 'DST':
+				alphaflags |= SA2AlphaInstructions.DA_DST
+			elif dst == 'INV_DST':
+				alphaflags |= SA2AlphaInstructions.DA_INV_DST
+		else:
+			alphaflags = enums.SA2AlphaInstructions.SA_SRC \
+				| enums.SA2AlphaInstructions.DA_INV_SRC
+
+		saShader = None
+		saImage = None
+		if (material.node_tree != None):
+			saShader = material.node_tree.nodes.get('Group')
+			saImage = material.node_tree.nodes.get('Image Texture')
+
+		materialChunk = PolyChunk_Material(
+			alphaflags,
+			common.GetColor(saShader, 0, matProps.b_Diffuse),
+			common.GetColor(saShader, 1, matProps.b_Specular),
+			common.GetColor(saShader, 2, matProps.b_Ambient),
+			round(matProps.b_Exponent * 255))
+
+		textureChunk = PolyChunk_Texture(
+			common.FindTexture(saImage, matProps.b_TextureID),
+			textureFlags,
+			matProps.b_use_Anisotropy,
+			filtering)
+
+		# getting strip flags
+		stripFlags = enums.StripFlags.null
+		stripUVs = True
+		if matProps.b_ignoreLighting:
+			stripFlags |= enums.StripFlags.IGNORE_LIGHT
+		if matProps.b_ignoreSpecular:
+			stripFlags |= enums.StripFlags.INGORE_SPECULAR
+		if matProps.b_ignoreAmbient:
+			stripFlags |= enums.StripFlags.IGNORE_AMBIENT
+		if matProps.b_useAlpha:
+			stripFlags |= enums.StripFlags.USE_ALPHA
+		if matProps.b_doubleSided:
+			stripFlags |= enums.StripFlags.DOUBLE_SIDE
+		if matProps.b_flatShading:
+			stripFlags |= enums.StripFlags.FLAT_SHADING
+		if matProps.b_useEnv:
+			stripFlags |= enums.StripFlags.ENV_MAPPING
+			stripUVs = False
+		if matProps.b_unknown:
+			stripFlags |= enums.StripFlags.Unknown
+
+		return MaterialTemplate(materialChunk, textureChunk, stripFlags, stripUVs)
+
 class Container(object):
 	pass
 
+def sortVerticesByFirstUse(vertexChunks: List[VertexChunk], polyChunks: List[PolyChunk]):
+	"""Removes the vertices that no strip uses and orders the rest by
+	their first use in the strips, so that the game fetches them mostly
+	in sequence. All vertex chunks have to fill the same part of the index
+	buffer (e.g. the chunks of every bone of a weighted mesh). The polygon
+	corners get updated to the new indices, which stay relative to the
+	index buffer offset of the chunks"""
+	offset = vertexChunks[0].indexBufferOffset
+	if any(vc.indexBufferOffset != offset for vc in vertexChunks):
+		log.warning(" Vertex chunks with different index buffer offsets, not sorting")
+		return
+
+	available = {offset + v.index for vc in vertexChunks for v in vc.vertices}
+	remap: Dict[int, int] = dict()
+	corners: Dict[int, PolyVert] = dict()
+	for p in polyChunks:
+		if not isinstance(p, PolyChunk_Strip):
+			continue
+		for s in p.strips:
+			for c in s:
+				if c.index not in available:
+					log.warning(" Corner index %i is outside of the vertex chunks "
+								"(offset %i), not sorting", c.index, offset)
+					return
+				# corners can be shared between strips
+				corners[id(c)] = c
+				if c.index not in remap:
+					remap[c.index] = offset + len(remap)
+
+	if len(remap) == 0:
+		# no polygons; the vertices may be meant for other meshes
+		return
+
+	# looking up every new index before changing any, in case a vertex
+	# is in more than one chunk
+	newIndices = {id(v): remap[offset + v.index] - offset
+				  for vc in vertexChunks for v in vc.vertices
+				  if offset + v.index in remap}
+	for vc in vertexChunks:
+		vertices = [v for v in vc.vertices if id(v) in newIndices]
+		for v in vertices:
+			v.index = newIndices[id(v)]
+		vertices.sort(key=lambda v: v.index)
+
+		log.debug(" Removed %i unused vertices",
+				  len(vc.vertices) - len(vertices))
+		vc.vertices = vertices
+
+	for c in corners.values():
+		c.index = remap[c.index]
+
 class Attach:
 	"""Chunk mesh data"""
 
@@ -494,77 +953,17 @@ class Attach:
 		self.polyChunks = polyChunks
 		self.bounds = bounds
 
+		# splitting chunks that exceed the size limits
 		self.vertexChunks = list()
-		# getting the most out of the vertex chunks
 		for v in vertexChunks:
-			if v.vertexSize() * len(v.vertices) < 0xFFFF:
-				self.vertexChunks.append(v)
-			else:
-				vertices = v.vertices
-				offset = v.indexBufferOffset
-
-				while len(vertices) > 0:
-					vCount = min(0xFFFF - offset, math.floor(min(len(vertices)
-								 * v.vertexSize(), 0xFFFF) / v.vertexSize()))
-
-					chunkV = vertices[:vCount]
-					vertices = vertices[vCount:]
-					print("set:", len(chunkV), len(vertices))
-
-					self.vertexChunks.append(
-						VertexChunk(v.chunkType,
-									v.weightType,
-									v.weightContinue,
-									offset,
-									chunkV))
-					offset += vCount
-
-		# optimizing poly chunks (well, only the strips)
+			self.vertexChunks.extend(v.split())
+
 		self.polyChunks = list()
 		for p in polyChunks:
-			if not isinstance(p, PolyChunk_Strip):
-				self.polyChunks.append(p)
+			if isinstance(p, PolyChunk_Strip):
+				self.polyChunks.extend(p.split())
 			else:
-				p: PolyChunk_Strip = p
-
-				if p.getSize() > 0xFFFF or len(p.strips) > 0x3FFF:
-
-					polyCSize = 3 \
-						if p.chunkType == enums.ChunkType.Strip_StripUVN \
-						else 1
-
-					cSize = 1
-					strips = list()
-					revStrips = list()
-
-					for c in range(len(strips)):
-						strip = p.strips[c]
-						stripSize = (len(strip) * polyCSize) + 1
-
-						if cSize + stripSize > 0xFFFF or len(strips) >= 0x3FFF:
-							self.polyChunks.append(
-								PolyChunk_Strip(polyCSize == 3,
-												p.flags,
-												strips,
-												revStrips))
-							strips = list()
-							revStrips = list()
-							cSize = 1
-
-						strips.append(strip)
-						revStrips.append(p.reversedStrips[c])
-
-						cSize += stripSize
-
-					if len(strips) > 0:
-						self.polyChunks.append(
-							PolyChunk_Strip(polyCSize == 3,
-											p.flags,
-											strips,
-											revStrips))
-
-				else:
-					self.polyChunks.append(p)
+				self.polyChunks.append(p)
 
 	@classmethod
 	def getPolygons(cls, mesh: bpy.types.Mesh,
@@ -619,8 +1018,8 @@ class Attach:
 			strips.append(polyStrips)
 			stripRev.append(polyStripsRev)
 
-		# generating polygon chunks
-		polyChunks: List[PolyChunk] = list()
+		# generating the strip chunks of every material
+		groups: List[Tuple[MaterialTemplate, PolyChunk_Strip]] = list()
 
 		for mID, strip in enumerate(zip(strips, stripRev)):
 			l, lrev = strip
@@ -628,144 +1027,61 @@ class Attach:
 				continue
 
 			# getting material
-			stripUVs = writeUVs
 			material = None
 			if len(mesh.materials) == 0:
-				print(" Mesh has no materials")
+				log.warning(" Mesh %s has no materials", mesh.name)
 			else:
 				matName = mesh.materials[mID].name
 				materials = mesh.materials
 				if matName in materials:
 					material = materials[matName]
 				else:
-					print(" Material", matName, "not found")
-
-			stripFlags = enums.StripFlags.null
-
-			if material is None:
-				polyChunks.append(
-					PolyChunk_Material(enums.SA2AlphaInstructions.SA_SRC
-									   | enums.SA2AlphaInstructions.DA_INV_SRC,
-									   ColorARGB(),
-									   ColorARGB(),
-									   ColorARGB(),
-									   255))
-				polyChunks.append(
-					PolyChunk_Texture(0,
-									  enums.TextureIDFlags.null,
-									  True,
-									  enums.TextureFiltering.Bilinear))
+					log.warning(" Material %s not found", matName)
+
+			template = MaterialTemplate.get(material)
+			groups.append((template,
+						   PolyChunk_Strip(writeUVs and template.stripUVs,
+										   template.stripFlags,
+										   l,
+										   lrev)))
+
+		return cls.orderPolyChunks(groups)
+
+	@classmethod
+	def orderPolyChunks(cls,
+						groups: List[Tuple[MaterialTemplate, PolyChunk_Strip]]
+						) -> List[PolyChunk]:
+		"""Orders the strip chunks to reduce state changes and returns them
+		together with the material and texture chunks they need.
+
+		Opaque strips are drawn first, sorted by texture, blend mode and
+		colors. Transparent strips come last and keep their order, as
+		that is the order they get blended in. Material and texture chunks
+		are only written when they differ from the current state"""
+		opaque = list()
+		transparent = list()
+		for g in groups:
+			if enums.StripFlags.USE_ALPHA in g[1].flags:
+				transparent.append(g)
 			else:
-				matProps: SAMaterialSettings = material.saSettings
-
-				# getting texture info
-				textureFlags = enums.TextureIDFlags.null
-
-				if matProps.b_d_025:
-					textureFlags |= enums.TextureIDFlags.D_025
-				if matProps.b_d_050:
-					textureFlags |= enums.TextureIDFlags.D_050
-				if matProps.b_d_100:
-					textureFlags |= enums.TextureIDFlags.D_100
-				if matProps.b_d_200:
-					textureFlags |= enums.TextureIDFlags.D_200
-				if matProps.b_clampV:
-					textureFlags |= enums.TextureIDFlags.CLAMP_V
-				if matProps.b_clampU:
-					textureFlags |= enums.TextureIDFlags.CLAMP_U
-				if matProps.b_mirrorV:
-					textureFlags |= enums.TextureIDFlags.FLIP_V
-				if matProps.b_mirrorU:
-					textureFlags |= enums.TextureIDFlags.FLIP_U
-
-				filtering = enums.TextureFiltering.Point
-
-				if matProps.b_texFilter == 'BILINEAR':
-					filtering = enums.TextureFiltering.Bilinear
-				elif matProps.b_texFilter == 'TRILINEAR':
-					filtering = enums.TextureFiltering.Trilinear
-				elif matProps.b_texFilter == 'BLEND':
-					filtering = enums.TextureFiltering.Blend
-
-				# getting alpha
-				alphaflags = enums.SA2AlphaInstructions.null
-				if matProps.b_useAlpha:
-					from .enums import SA2AlphaInstructions
-
-					src = matProps.b_srcAlpha
-					if src == 'ONE':
-						alphaflags |= SA2AlphaInstructions.SA_ONE
-					elif src == 'OTHER':
-						alphaflags |= SA2AlphaInstructions.SA_OTHER
-					elif src == 'INV_OTHER':
-						alphaflags |= SA2AlphaInstructions.SA_INV_OTHER
-					elif src == 'SRC':
-						alphaflags |= SA2AlphaInstructions.SA_SRC
-					elif src == 'INV_SRC':
-						alphaflags |= SA2AlphaInstructions.SA_INV_SRC
-					elif src == 'DST':
-						alphaflags |= SA2AlphaInstructions.SA_DST
-					elif src == 'INV_DST':
-						alphaflags |= SA2AlphaInstructions.SA_INV_DST
-
-					dst = matProps.b_destAlpha
-					if dst == 'ONE':
-						alphaflags |= SA2AlphaInstructions.DA_ONE
-					elif dst == 'OTHER':
-						alphaflags |= SA2AlphaInstructions.DA_OTHER
-					elif dst == 'INV_OTHER':
-						alphaflags |= SA2AlphaInstructions.DA_INV_OTHER
-					elif dst == 'SRC':
-						alphaflags |= SA2AlphaInstructions.DA_SRC
-					elif dst == 'INV_SRC':
-						alphaflags |= SA2AlphaInstructions.DA_INV_SRC
-					elif dst == 'DST':
-						alphaflags |= SA2AlphaInstructions.DA_DST
-					elif dst == 'INV_DST':
-						alphaflags |= SA2AlphaInstructions.DA_INV_DST
-				else:
-					alphaflags = enums.SA2AlphaInstructions.SA_SRC \
-						| enums.SA2AlphaInstructions.DA_INV_SRC
-
-				saShader = None
-				saImage = None
-				if (material.node_tree != None):
-					saShader = material.node_tree.nodes.get('Group')
-					saImage = material.node_tree.nodes.get('Image Texture')
-				polyChunks.append(
-					PolyChunk_Material(
-						alphaflags,
-						common.GetColor(saShader, 0, matProps.b_Diffuse),
-						common.GetColor(saShader, 1, matProps.b_Specular),
-						common.GetColor(saShader, 2, matProps.b_Ambient),
-						round(matProps.b_Exponent * 255)))
-				polyChunks.append(
-					PolyChunk_Texture(
-						common.FindTexture(saImage, matProps.b_TextureID),
-						textureFlags,
-						matProps.b_use_Anisotropy,
-						filtering))
-
-				# getting strip flags
-				if matProps.b_ignoreLighting:
-					stripFlags |= enums.StripFlags.IGNORE_LIGHT
-				if matProps.b_ignoreSpecular:
-					stripFlags |= enums.StripFlags.INGORE_SPECULAR
-				if matProps.b_ignoreAmbient:
-					stripFlags |= enums.StripFlags.IGNORE_AMBIENT
-				if matProps.b_useAlpha:
-					stripFlags |= enums.StripFlags.USE_ALPHA
-				if matProps.b_doubleSided:
-					stripFlags |= enums.StripFlags.DOUBLE_SIDE
-				if matProps.b_flatShading:
-					stripFlags |= enums.StripFlags.FLAT_SHADING
-				if matProps.b_useEnv:
-					stripFlags |= enums.StripFlags.ENV_MAPPING
-					stripUVs = False
-				if matProps.b_unknown:
-					stripFlags |= enums.StripFlags.Unknown
-
-			polyChunks.append(PolyChunk_Strip(stripUVs, stripFlags, l, lrev))
+				opaque.append(g)
+
+		opaque.sort(key=lambda g: (g[0].texture.texID,
+								   g[0].texture.packed,
+								   g[0].material.alphaInstruction.value,
+								   g[0].material.packed))
+
+		polyChunks: List[PolyChunk] = list()
+		material = None
+		texture = None
+		for template, strip in opaque + transparent:
+			if template.material.packed != material:
+				material = template.material.packed
+				polyChunks.append(template.material)
+			if template.texture.packed != texture:
+				texture = template.texture.packed
+				polyChunks.append(template.texture)
+			polyChunks.append(strip)
 
 		return polyChunks
 
@@ -788,45 +1104,41 @@ class Attach:
 		normals = common.getNormalData(mesh)
 
 		if vertexType == 'VC':
-			verts: List[List[Vertex]] = [[] for v in mesh.vertices]
-
-			# generating the vertices with their colors
-			for l in mesh.loops:
-				vert = mesh.vertices[l.vertex_index]
-				col = ColorARGB(mesh.vertex_colors[0].data[l.index].color)
-
-				# only create the vertex if there isnt
-				# one with the same color already
-				foundV: Vertex = None
-				for v in verts[l.vertex_index]:
-					if v.col == col:
-						foundV = v
-						break
-
-				if foundV is None:
-					foundV = Vertex(
-						l.vertex_index,
-						0,
-						Vector3(export_matrix @ vert.co),
-						Vector3(),
-						col,
-						0)
-					verts[l.vertex_index].append(foundV)
-
-				uv = UV(mesh.uv_layers[0].data[l.index].uv) \
-					if writeUVs else UV()
-				polyVerts.append(PolyVert(foundV, uv))
-
-			# correcting indices
-			i = 0
-			for v in verts:
-				for vt in v:
-					vt.index = i
-					vertices.append(vt)
-					i += 1
-
-			for p in polyVerts:
-				p.index = p.index.index + extraOffset
+			# reading the colors of all loops as packed ARGB values
+			loopCount = len(mesh.loops)
+			colors = numpy.empty(loopCount * 4, dtype=numpy.float32)
+			mesh.vertex_colors[0].data.foreach_get("color", colors)
+			colors = numpy.clip(numpy.round(
+				colors.reshape(-1, 4).astype(numpy.float64) * 255), 0, 255).astype(numpy.int64)
+			argb = (colors[:, 3] << 24) | (colors[:, 0] << 16) \
+				| (colors[:, 1] << 8) | colors[:, 2]
+
+			loopVerts = numpy.empty(loopCount, dtype=numpy.int64)
+			mesh.loops.foreach_get("vertex_index", loopVerts)
+
+			# one chunk vertex per distinct vertex and color, ordered by
+			# vertex index and then by first use
+			keys, firstLoop, loopKeys = numpy.unique(
+				(loopVerts << 32) | argb, return_index=True, return_inverse=True)
+			keyVerts = keys >> 32
+			order = numpy.lexsort((firstLoop, keyVerts))
+			rank = numpy.empty_like(order)
+			rank[order] = numpy.arange(len(order))
+
+			for i, k in enumerate(order.tolist()):
+				vIndex = int(keyVerts[k])
+				vertices.append(Vertex(
+					vIndex,
+					i,
+					Vector3(export_matrix @ mesh.vertices[vIndex].co),
+					Vector3(),
+					ColorARGB.fromARGB(int(keys[k] & 0xFFFFFFFF)),
+					0))
+
+			uvData = mesh.uv_layers[0].data if writeUVs else None
+			for l, index in enumerate((rank[loopKeys.reshape(-1)] + extraOffset).tolist()):
+				uv = UV(uvData[l].uv) if writeUVs else UV()
+				polyVerts.append(PolyVert(index, uv))
 
 		else:  # normals are a lot simpler to generate (luckily)
 			for v in mesh.vertices:
@@ -846,9 +1158,6 @@ class Attach:
 					polyVert = PolyVert(loop.vertex_index + extraOffset, uv)
 					polyVerts.append(polyVert)
 
-		# if DO:
-		# print("degTris: " + degTris)
-
 		# creating the vertex chunk
 		chunkType = enums.ChunkType.Vertex_VertexDiffuse8 \
 			if vertexType == 'VC' else enums.ChunkType.Vertex_VertexNormal
@@ -862,6 +1171,9 @@ class Attach:
 
 		polyChunks = Attach.getPolygons(mesh, writeUVs, polyVerts, materials)
 
+		if sortByFirstUse:
+			sortVerticesByFirstUse(vertexChunks, polyChunks)
+
 		bounds = BoundingBox(mesh.vertices)
 		bounds.adjust(export_matrix)
 
@@ -871,7 +1183,6 @@ class Attach:
 			  fileW: fileHelper.FileWriter,
 			  labels: dict,
 			  meshDict: dict = None):
-		global DO
 
 		if self.name is None:
 			self.name = "attach_" + common.hex4(fileW.tell())
@@ -889,14 +1200,31 @@ class Attach:
 
 		polyChunkPtr = 0
 		if len(self.polyChunks) > 0:
-			# writing polygon chunks
-			polyChunkPtr = fileW.tell()
+			data = fileHelper.ByteWriter()
+			data.setBigEndian(fileW.isBigEndian())
 			for p in self.polyChunks:
-				p.write(fileW)
+				if p.packed is not None:
+					data.w(p.packed)
+				else:
+					p.write(data)
 
 			# writing poly chunk terminator
-			fileW.wUShort(enums.ChunkType.End.value)
-			labels[polyChunkPtr] = "cnk_" + self.name + "_poly"
+			data.wUShort(enums.ChunkType.End.value)
+			data = data.getBytes()
+
+			# identical poly chunk lists (e.g. of instanced props) only
+			# get written once and are shared by all attaches using them.
+			# common prefixes are not shared, as that would need
+			# CachePolygonList/DrawPolygonList chunks
+			polyChunkPtr = polyChunkLists.get(data)
+			if polyChunkPtr is not None:
+				log.debug(" Reusing poly chunks of %s for %s",
+						  labels.get(polyChunkPtr, hex(polyChunkPtr)), self.name)
+			else:
+				polyChunkPtr = fileW.tell()
+				fileW.w(data)
+				polyChunkLists[data] = polyChunkPtr
+				labels[polyChunkPtr] = "cnk_" + self.name + "_poly"
 
 		attachPtr = fileW.tell()
 		if meshDict is not None:
@@ -907,23 +1235,88 @@ class Attach:
 		fileW.wUInt(polyChunkPtr)
 		self.bounds.write(fileW)
 
-		if DO:
-			print("  Chunk mesh:", self.name)
-			print("    Vertex chunks:", len(self.vertexChunks))
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug("  Chunk mesh: %s", self.name)
+			log.debug("    Vertex chunks: %i", len(self.vertexChunks))
 			for v in self.vertexChunks:
-				print("     vertices:", len(v.vertices))
-			print("    Vertex chunk ptr:", vertexChunkPtr)
-			print("    Poly chunks:", len(self.polyChunks))
-			print("    Poly chunk ptr:", polyChunkPtr, "\n")
+				log.debug("     vertices: %i", len(v.vertices))
+			log.debug("    Vertex chunk ptr: %i\n"
+					  "    Poly chunks: %i\n"
+					  "    Poly chunk ptr: %i\n",
+					  vertexChunkPtr, len(self.polyChunks), polyChunkPtr)
 
 		return attachPtr
 
+	@classmethod
+	def readVertexChunks(cls,
+						 fileR: fileHelper.FileReader,
+						 address: int) -> List[VertexChunk]:
+		"""Reads a vertex chunk list, up to its end chunk"""
+		vertexChunks: List[VertexChunk] = list()
+		tmpAddr = address
+		chunkType = enums.ChunkType(fileR.rByte(tmpAddr))
+		while chunkType != enums.ChunkType.End:
+			vertexChunk, tmpAddr = VertexChunk.read(fileR, tmpAddr)
+			vertexChunks.append(vertexChunk)
+			chunkType = enums.ChunkType(fileR.rByte(tmpAddr))
+		return vertexChunks
+
+	@classmethod
+	def readPolyChunks(cls,
+					   fileR: fileHelper.FileReader,
+					   address: int) -> List[PolyChunk]:
+		"""Reads a poly chunk list, up to its end chunk"""
+		polygonChunks = list()
+		debug = log.isEnabledFor(logging.DEBUG)
+		tmpAddr = address
+		chunkType = enums.ChunkType(fileR.rByte(tmpAddr))
+		while chunkType != enums.ChunkType.End:
+			chunk = PolyChunk(chunkType)
+
+			tmpAddr += 1
+			if chunkType == enums.ChunkType.Bits_BlendAlpha:
+				chunk = PolyChunk_BlendAlpha(
+					enums.SA2AlphaInstructions.null)
+			elif chunkType == enums.ChunkType.Bits_CachePolygonList:
+				chunk = PolyChunk_CachePolygonList(0)
+			elif chunkType == enums.ChunkType.Bits_DrawPolygonList:
+				chunk = PolyChunk_DrawpolygonList(0)
+			elif chunkType == enums.ChunkType.Bits_MipmapDAdjust:
+				chunk = PolyChunk_MipmapDAdjust(
+					enums.MipMapDistanceAdjust.null)
+			elif chunkType == enums.ChunkType.Bits_SpecularExponent:
+				chunk = PolyChunk_SpecularExponent(0)
+			elif chunkType == enums.ChunkType.Tiny_TextureID:
+				chunk, tmpAddr = PolyChunk_Texture.read(fileR, tmpAddr)
+			elif chunkType.value > 15 and chunkType.value < 32:
+				chunk, tmpAddr = PolyChunk_Material.read(
+					fileR,
+					chunkType,
+					tmpAddr)
+			elif chunkType.value > 63 and chunkType.value < 76:
+				chunk, tmpAddr = PolyChunk_Strip.read(
+					fileR,
+					chunkType,
+					tmpAddr)
+
+			if isinstance(chunk, PolyChunk_Bit):
+				chunk.data = fileR.rByte(tmpAddr)
+				tmpAddr += 1
+
+			if debug:
+				log.debug("%s", chunkType)
+
+			polygonChunks.append(chunk)
+			chunkType = enums.ChunkType(fileR.rByte(tmpAddr))
+		return polygonChunks
+
 	@classmethod
 	def read(cls,
 			 fileR: fileHelper.FileReader,
 			 address: int,
 			 meshID: int,
-			 labels: dict):
+			 labels: dict,
+			 index: fileIndex.FileIndex = None):
 
 		if address in labels:
 			name: str = labels[address]
@@ -932,134 +1325,49 @@ class Attach:
 		else:
 			name = "Attach_" + str(meshID)
 
-		# reading vertex chunks
-		vertexChunks: List[Vertex] = list()
-		tmpAddr = fileR.rUInt(address)
-
-		if tmpAddr > 0:
-			chunkType = enums.ChunkType(fileR.rByte(tmpAddr))
-			while chunkType != enums.ChunkType.End:
-				flags = fileR.rByte(tmpAddr + 1)
-				weightStatus = enums.WeightStatus(flags & 0x3)
-				otherFlags = flags & ~0x3
-				size = fileR.rUShort(tmpAddr+2)
-				indexBufferOffset = fileR.rUShort(tmpAddr + 4)
-				vertexCount = fileR.rUShort(tmpAddr + 6)
-
-				vertices = list()
-
-				tmpAddr += 8
-
-				for i in range(vertexCount):
-					# getting the position (part of every vertex)
-					posX = fileR.rFloat(tmpAddr)
-					posY = fileR.rFloat(tmpAddr + 4)
-					posZ = fileR.rFloat(tmpAddr + 8)
-					pos = Vector3((posX, -posZ, posY))
-					tmpAddr += 12
-
-					col = None
-
-					# getting color
-					if chunkType == enums.ChunkType.Vertex_VertexDiffuse8 \
-						or chunkType == \
-							enums.ChunkType.Vertex_VertexNormalDiffuse8:
-						col = ColorARGB.fromARGB(fileR.rUInt(tmpAddr))
-						tmpAddr += 4
-
-					weight = 0
-					index = i
-					nrm = None
-
-					if chunkType == enums.ChunkType.Vertex_VertexNormal \
-							or chunkType == \
-							enums.ChunkType.Vertex_VertexNormalNinjaFlags \
-							or chunkType == \
-							enums.ChunkType.Vertex_VertexNormalDiffuse8:
-						nrmX = fileR.rFloat(tmpAddr)
-						nrmY = fileR.rFloat(tmpAddr + 4)
-						nrmZ = fileR.rFloat(tmpAddr + 8)
-						nrm = Vector3((nrmX, -nrmZ, nrmY))
-						tmpAddr += 12
-
-						if chunkType == \
-								enums.ChunkType.Vertex_VertexNormalNinjaFlags:
-							ninjaFlags = fileR.rUInt(tmpAddr)
-							weight = ((ninjaFlags >> 16) & 0xFF) / 255.0
-							index = ninjaFlags & 0xFFFF
-							tmpAddr += 4
-
-					vertices.append(
-						Vertex(
-							index,
-							index,
-							pos,
-							nrm,
-							col,
-							weight))
-
-				vertexChunks.append(
-					VertexChunk(
-						chunkType,
-						weightStatus,
-						(otherFlags & 0x80) > 0,
-						indexBufferOffset,
-						vertices))
-
-				chunkType = enums.ChunkType(fileR.rByte(tmpAddr))
-		# reading polygons chunks
-
-		polygonChunks = list()
-		tmpAddr = fileR.rUInt(address + 4)
-		if tmpAddr > 0:
-			chunkType = enums.ChunkType(fileR.rByte(tmpAddr))
-			while chunkType != enums.ChunkType.End:
-				chunk = PolyChunk(chunkType)
-
-				tmpAddr += 1
-				if chunkType == enums.ChunkType.Bits_BlendAlpha:
-					chunk = PolyChunk_BlendAlpha(
-						enums.SA2AlphaInstructions.null)
-				elif chunkType == enums.ChunkType.Bits_CachePolygonList:
-					chunk = PolyChunk_CachePolygonList(0)
-				elif chunkType == enums.ChunkType.Bits_DrawPolygonList:
-					chunk = PolyChunk_DrawpolygonList(0)
-				elif chunkType == enums.ChunkType.Bits_MipmapDAdjust:
-					chunk = PolyChunk_MipmapDAdjust(
-						enums.MipMapDistanceAdjust.null)
-				elif chunkType == enums.ChunkType.Bits_SpecularExponent:
-					chunk = PolyChunk_SpecularExponent(0)
-				elif chunkType == enums.ChunkType.Tiny_TextureID:
-					chunk, tmpAddr = PolyChunk_Texture.read(fileR, tmpAddr)
-				elif chunkType.value > 15 and chunkType.value < 32:
-					chunk, tmpAddr = PolyChunk_Material.read(
-						fileR,
-						chunkType,
-						tmpAddr)
-				elif chunkType.value > 63 and chunkType.value < 76:
-					chunk, tmpAddr = PolyChunk_Strip.read(
-						fileR,
-						chunkType,
-						tmpAddr)
-
-				if isinstance(chunk, PolyChunk_Bit):
-					chunk.data = fileR.rByte(tmpAddr)
-					tmpAddr += 1
-
-				if DO:
-					print(chunkType)
-
-				polygonChunks.append(chunk)
-				chunkType = enums.ChunkType(fileR.rByte(tmpAddr))
+		# the chunk lists can be shared between attaches
+		vertexChunks: List[VertexChunk] = list()
+		vertexAddr = fileR.rUInt(address)
+		if vertexAddr > 0:
+			vertexChunks = fileIndex.decode(
+				index, vertexAddr, "vertex_chunks",
+				lambda: cls.readVertexChunks(fileR, vertexAddr))
+
+		polygonChunks: List[PolyChunk] = list()
+		polyAddr = fileR.rUInt(address + 4)
+		if polyAddr > 0:
+			polygonChunks = fileIndex.decode(
+				index, polyAddr, "poly_chunks",
+				lambda: cls.readPolyChunks(fileR, polyAddr))
 
 		return Attach(name, vertexChunks, polygonChunks, None)
 
 	def debug(self):
-		print("  Chunk mesh:", self.name)
-		print("    Vertex chunks:", len(self.vertexChunks))
-		print("    Poly chunks:", len(self.polyChunks))
+		log.debug("  Chunk mesh: %s\n"
+				  "    Vertex chunks: %i\n"
+				  "    Poly chunks: %i",
+				  self.name, len(self.vertexChunks), len(self.polyChunks))
 
 # stuff for weighted exporting and importing
+def transformVertices(matrix: mathutils.Matrix,
+					  positions: numpy.ndarray,
+					  normals: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""Transforms positions and normals by a matrix (normals get normalized)"""
+	matrix = numpy.array(matrix, dtype=numpy.float64)
+	rotation = matrix[:3, :3]
+	positions = positions @ rotation.T + matrix[:3, 3]
+	normals = normals @ rotation.T
+	lengths = numpy.linalg.norm(normals, axis=1, keepdims=True)
+	normals = numpy.divide(normals, lengths, out=normals, where=lengths > 0)
+	return positions, normals
+
+def createVertices(indices, positions: numpy.ndarray, normals: numpy.ndarray, weights) -> List[Vertex]:
+	"""Creates chunk vertices from vertex arrays"""
+	if isinstance(weights, numpy.ndarray):
+		weights = weights.tolist()
+	return [Vertex(i, i, Vector3(p), Vector3(n), None, w)
+			for i, p, n, w in zip(list(indices), positions.tolist(), normals.tolist(), weights)]
+
 def fromWeightData(boneMap: Dict[str, mathutils.Matrix],
 				   meshData: List[common.ArmatureMesh],
 				   export_matrix: mathutils.Matrix,
@@ -1095,22 +1403,20 @@ def fromWeightData(boneMap: Dict[str, mathutils.Matrix],
 				enums.ChunkType.Vertex_VertexNormalNinjaFlags)
 
 		mesh = m.model.processedMesh
-		normals = common.getNormalData(mesh)
+		vertexCount = len(mesh.vertices)
+		coords = numpy.empty(vertexCount * 3, dtype=numpy.float64)
+		mesh.vertices.foreach_get("co", coords)
+		coords = coords.reshape(-1, 3)
+		normals = numpy.array(common.getNormalData(mesh),
+							  dtype=numpy.float64).reshape(-1, 3)
 
 		# if the only bone is index -1, then
 		# just write the entire mesh to the bone
 		if list(boneData.keys())[0] == -1:
 			status, matrix, vList, _ = boneData[-1]
-			for v in mesh.vertices:
-				vList.append(
-					Vertex(
-						v.index,
-						v.index,
-						Vector3(matrix @ v.co),
-						Vector3(
-							(matrix.to_3x3()
-							 @ normals[v.index]).normalized()),
-						None, 1))
+			positions, vNormals = transformVertices(matrix, coords, normals)
+			vList.extend(createVertices(
+				range(vertexCount), positions, vNormals, [1] * vertexCount))
 			boneData[-1] = (
 				status,
 				matrix,
@@ -1118,49 +1424,44 @@ def fromWeightData(boneMap: Dict[str, mathutils.Matrix],
 				enums.ChunkType.Vertex_VertexNormal)
 
 		else:
-			for v in mesh.vertices:
-				# get all used weights and the average weight, for proper normalizing
-				cWeight: Dict[int, float] = dict()
-				weightsAdded = 0
-				for g in v.groups:
-					if g.group in boneData:
-						weightsAdded += g.weight
-						cWeight[g.group] = g.weight
-
-				# if there are no used weights, then attach it to index -2
-				if len(cWeight) == 0:
-					status, matrix, vList, _ = boneData[-2]
-					vList.append(
-						Vertex(
-							v.index,
-							v.index,
-							Vector3(matrix @ v.co),
-							Vector3(
-								(matrix.to_3x3() @ normals[v.index])
-								.normalized()),
-							None,
-							1
-						)
-					)
+			# the weights of every vertex for every bone in this mesh
+			# (columns in boneData order), and whether a vertex has
+			# any of the bones at all
+			boneColumns = {b: i for i, b in enumerate(boneData.keys())}
+			weights = m.weights.normalized().toDense(list(boneColumns.keys()))
+			weighted = m.weights.weighted()
+
+			# if there are no used weights, then attach it to index -2
+			unweighted = numpy.flatnonzero(~weighted)
+			if len(unweighted) > 0:
+				status, matrix, vList, _ = boneData[-2]
+				positions, vNormals = transformVertices(
+					matrix, coords[unweighted], normals[unweighted])
+				vList.extend(createVertices(
+					unweighted, positions, vNormals, [1] * len(unweighted)))
+
+			for k, column in boneColumns.items():
+				status, matrix, vList, _ = boneData[k]
+				used = weighted.copy()
+				if status != enums.WeightStatus.Start:
+					used &= weights[:, column] > 0
+				used = numpy.flatnonzero(used)
+				if len(used) == 0:
+					continue
+
+				positions, vNormals = transformVertices(
+					matrix, coords[used], normals[used])
+				newVerts = createVertices(
+					used, positions, vNormals, weights[used, column])
+
+				# unweighted vertices might have been added to -2 already,
+				# so the vertices need to be merged in index order
+				if len(vList) > 0 and len(unweighted) > 0 and k == -2:
+					vList.extend(newVerts)
+					vList.sort(key=lambda x: x.origIndex)
 				else:
-					for b in boneData.keys():
-						if b not in cWeight:
-							cWeight[b] = 0
-					for k, weight in cWeight.items():
-						if weightsAdded > 0:
-							weight = weight / weightsAdded
-						status, matrix, vList, _ = boneData[k]
-
-						if status == enums.WeightStatus.Start or weight > 0:
-							vList.append(
-								Vertex(
-									v.index,
-									v.index,
-									Vector3(matrix @ v.co),
-									Vector3((
-										matrix.to_3x3()
-										@ normals[v.index]).normalized()),
-									None, weight))
+					vList.extend(newVerts)
+
 		# getting polygon data
 
 		writeUVs = len(mesh.uv_layers) > 0
@@ -1172,12 +1473,20 @@ def fromWeightData(boneMap: Dict[str, mathutils.Matrix],
 
 		polyChunks = Attach.getPolygons(mesh, writeUVs, polyVerts, materials)
 
-		assignedPolys = False
+		meshVertChunks: Dict[str, VertexChunk] = dict()
 		for b, t in m.weightMap.items():
 			index, status = t
 			_, matrix, vList, chunkType = boneData[index]
-			vChunk = VertexChunk(chunkType, status, False, m.indexBufferOffset, vList)
-			boneVertChunks[b].append(vChunk)
+			meshVertChunks[b] = VertexChunk(
+				chunkType, status, False, m.indexBufferOffset, vList)
+
+		if sortByFirstUse:
+			sortVerticesByFirstUse(list(meshVertChunks.values()), polyChunks)
+
+		assignedPolys = False
+		for b, t in m.weightMap.items():
+			index, status = t
+			boneVertChunks[b].append(meshVertChunks[b])
 
 			if len(m.weightMap) == 1 or status == enums.WeightStatus.End:
 				bonePolyChunks[b].extend(polyChunks)
@@ -1235,30 +1544,6 @@ class BufferedVertex:
 	def add(self, vert: ProcessedVert):
 		self.vertices.append(vert)
 
-	def getWorldPos(self, armatureMatrix):
-		pos = Vector3((0,0,0))
-		if armatureMatrix is None:
-			for v in self.vertices:
-				pos += (v.model.matrix_world @ v.position) * v.weight
-		else:
-			for v in self.vertices:
-				pos += ((armatureMatrix.inverted() @ v.model.matrix_world) @ v.position) * v.weight
-		return (pos.x, pos.y, pos.z)
-
-	def getWorldNrm(self, armatureMatrix):
-		nrm = Vector3((0,0,0))
-		if armatureMatrix is None:
-			for v in self.vertices:
-				if v.normal is not None:
-					nrm += (v.model.matrix_world.to_3x3() @ v.normal) * v.weight
-		else:
-			for v in self.vertices:
-				if v.normal is not None:
-					nrm += ((armatureMatrix.inverted() @ v.model.matrix_world).to_3x3() @ v.normal) * v.weight
-		nrm.normalize()
-
-		return (nrm.x, nrm.y, nrm.z)
-
 	def getLocalPos(self):
 		"""only use if only one item in self.vertices"""
 		pos = self.vertices[0].position
@@ -1280,7 +1565,7 @@ class BufferedVertex:
 
 	def getColor(self):
 		if len(self.vertices) == 0:
-			print("No vertices to fetch color from")
+			log.warning("No vertices to fetch color from")
 			return mathutils.Vector(ColorARGB().toBlenderTuple())
 
 		return mathutils.Vector(self.vertices[-1].color.toBlenderTuple())
@@ -1313,6 +1598,58 @@ class processedAttach:
 				if v.model not in self.affectedBy:
 					self.affectedBy.append(v.model)
 
+	def getBlendedVertices(self,
+						   armatureInverse: mathutils.Matrix,
+						   bindMatrices: Dict[common.Model, numpy.ndarray]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		"""Returns the weighted positions and normals of all vertices,
+		relative to the armature. bindMatrices caches the matrix of every
+		model (the inverted armature matrix times the models world matrix)"""
+
+		models = {m: i for i, m in enumerate(self.affectedBy)}
+		matrices = list()
+		for m in self.affectedBy:
+			matrix = bindMatrices.get(m)
+			if matrix is None:
+				matrix = numpy.array(armatureInverse @ m.matrix_world, dtype=numpy.float64)
+				bindMatrices[m] = matrix
+			matrices.append(matrix)
+
+		# every weighted sub vertex of every vertex
+		vertexIDs = list()
+		modelIDs = list()
+		positions = list()
+		normals = list()
+		weights = list()
+		for i, bv in enumerate(self.vertices.values()):
+			for v in bv.vertices:
+				vertexIDs.append(i)
+				modelIDs.append(models[v.model])
+				positions.append(v.position)
+				normals.append((0, 0, 0) if v.normal is None else v.normal)
+				weights.append(v.weight)
+
+		resultPos = numpy.zeros((len(self.vertices), 3))
+		resultNrm = numpy.zeros((len(self.vertices), 3))
+		if len(vertexIDs) == 0:
+			return resultPos, resultNrm
+
+		vertexIDs = numpy.array(vertexIDs, dtype=numpy.int64)
+		matrices = numpy.array(matrices).reshape(-1, 4, 4)[modelIDs]
+		positions = numpy.array(positions, dtype=numpy.float64).reshape(-1, 3)
+		normals = numpy.array(normals, dtype=numpy.float64).reshape(-1, 3)
+		weights = numpy.array(weights, dtype=numpy.float64)[:, None]
+
+		rotations = matrices[:, :3, :3]
+		positions = numpy.einsum("nij,nj->ni", rotations, positions) + matrices[:, :3, 3]
+		normals = numpy.einsum("nij,nj->ni", rotations, normals)
+
+		numpy.add.at(resultPos, vertexIDs, positions * weights)
+		numpy.add.at(resultNrm, vertexIDs, normals * weights)
+
+		lengths = numpy.linalg.norm(resultNrm, axis=1, keepdims=True)
+		numpy.divide(resultNrm, lengths, out=resultNrm, where=lengths > 0)
+		return resultPos, resultNrm
+
 	def name(self, isArmature: bool) -> str:
 		if isArmature:
 			return "Mesh_" + str(self.attachID).zfill(2)
@@ -1331,16 +1668,22 @@ def OrderChunks(models: List[common.Model], attaches: Dict[int, Attach]) -> Dict
 		if o.meshPtr == 0 or o.meshPtr not in attaches or o.meshPtr in pAttaches:
 			continue
 		attach = attaches[o.meshPtr]
-		if DO:
-			print("  Object:", o.name)
-			print("  Attach:", attach.name, "\n")
-			print("  Vertex Chunks:\n")
+		debug = log.isEnabledFor(logging.DEBUG)
+		if debug:
+			log.debug("  Object: %s\n"
+					  "  Attach: %s\n\n"
+					  "  Vertex Chunks:\n", o.name, attach.name)
 			for v in attach.vertexChunks:
-				print("     Type:", v.chunkType)
-				print("     WeightType:", v.weightType)
-				print("     WeightContinue:", v.weightContinue)
-				print("     Index Offset:", v.indexBufferOffset)
-				print("     VertexCount:", len(v.vertices), "\n")
+				log.debug("     Type: %s\n"
+						  "     WeightType: %s\n"
+						  "     WeightContinue: %s\n"
+						  "     Index Offset: %i\n"
+						  "     VertexCount: %i\n",
+						  v.chunkType,
+						  v.weightType,
+						  v.weightContinue,
+						  v.indexBufferOffset,
+						  len(v.vertices))
 
 		# setting vertex buffers
 		for vtxCnk in attach.vertexChunks:
@@ -1385,20 +1728,25 @@ def OrderChunks(models: List[common.Model], attaches: Dict[int, Attach]) -> Dict
 		# only if there are polychunks available
 		# should we generate a processed attach.
 		if len(polyChunks) > 0:
-			if DO:
-				print(" Active Poly Chunks: ", len(polyChunks) ,"\n")
+			if debug:
+				log.debug(" Active Poly Chunks: %i\n", len(polyChunks))
 				for p in polyChunks:
-					print("    Chunktype:", p.chunkType)
+					log.debug("    Chunktype: %s", p.chunkType)
 					c = p.chunkType.value
 					if c > 63 and c < 76:
 						hasUV = c == 65 or c == 66 or c == 68 or c == 69 or c == 71 or c == 72
 						hasNRM = c >= 67 and c <= 69
 						hasCOL = c >= 70 and c <= 72
-						print("     UV:", hasUV, ", NRM:", hasNRM, ", COL:", hasCOL)
-						print("     flags:", p.flags)
-						print("     size:", p.readSize)
-						print("     stripCount:", len(p.strips))
-						print("     userflags:", p.readUserFlags, "\n")
+						log.debug("     UV: %s, NRM: %s, COL: %s\n"
+								  "     flags: %s\n"
+								  "     size: %i\n"
+								  "     stripCount: %i\n"
+								  "     userflags: %i\n",
+								  hasUV, hasNRM, hasCOL,
+								  p.flags,
+								  p.readSize,
+								  len(p.strips),
+								  p.readUserFlags)
 						# getting the vertice that the polygons require
 
 			vertices: Dict[int, BufferedVertex] = dict()
@@ -1433,9 +1781,12 @@ def OrderChunks(models: List[common.Model], attaches: Dict[int, Attach]) -> Dict
 
 	return pAttaches
 
-def ProcessChunkData(models: List[common.Model], attaches: Dict[int, processedAttach], noDoubleVerts: bool, armatureRoot: common.Model):
+def ProcessChunkData(models: List[common.Model],
+					 attaches: Dict[int, processedAttach],
+					 noDoubleVerts: bool,
+					 armatureRoot: common.Model,
+					 materialCache: common.MaterialCache = None):
 
-	import bmesh
 	from .__init__ import SAMaterialSettings
 
 	tmpMat = SAMaterialSettings.getDefaultMatDict()
@@ -1443,12 +1794,13 @@ def ProcessChunkData(models: List[common.Model], attaches: Dict[int, processedAt
 	# the converted meshes
 	meshes: Dict[int, bpy.types.Mesh] = dict()
 
-	# you cant hash a dictionary in a dictionary, so i make a "virtual" dictionary
-	materials: List[bpy.types.Material] = list()
-	matDicts: List[dict] = list()
+	if materialCache is None:
+		materialCache = common.MaterialCache()
 
 	isArmature = armatureRoot != None
-	armatureMatrix = armatureRoot.matrix_world if isArmature else None
+	armatureInverse = armatureRoot.matrix_world.inverted() if isArmature else None
+	# the bind matrices of the models that have weighted vertices
+	bindMatrices: Dict[common.Model, numpy.ndarray] = dict()
 
 	for o in models:
 		if o.meshPtr == 0 or o.meshPtr not in attaches:
@@ -1459,42 +1811,35 @@ def ProcessChunkData(models: List[common.Model], attaches: Dict[int, processedAt
 
 		a = attaches[o.meshPtr]
 		# calculating vertices
-		normals = list()
-		vIDs = dict()
-		vDistinct = list()
 		if isArmature:
 			# removing double vertices kinda causes trouble...
-			for i, e in enumerate(a.vertices.items()):
-				nrm = e[1].getWorldNrm(armatureMatrix)
-				normals.append(nrm)
-				vDistinct.append((e[1].getWorldPos(armatureMatrix), nrm))
-				vIDs[e[0]] = i
+			positions, normals = a.getBlendedVertices(armatureInverse, bindMatrices)
 		else:
-
-			if noDoubleVerts:
-				vertexSets = list()
-				for v in a.vertices.values():
-					vertexSets.append((v.getLocalPos(), v.getLocalNrm()))
-				vDistinct, t = common.getDistinctwID(vertexSets)
-
-				normals = [d[1] for d in vDistinct]
-
-				for i, k in enumerate(a.vertices.keys()):
-					vIDs[k] = t[i]
-			else:
-				for i, e in enumerate(a.vertices.items()):
-					nrm = e[1].getLocalNrm()
-					normals.append(nrm)
-					vDistinct.append((e[1].getLocalPos(), nrm))
-					vIDs[e[0]] = i
-
-
-
-		# getting the polygons
-		polygons: List[List[PolyVert]] = list()
-		matMarkers = dict()
+			positions = [v.getLocalPos() for v in a.vertices.values()]
+			normals = [v.getLocalNrm() for v in a.vertices.values()]
+			positions = numpy.array(positions, dtype=numpy.float64).reshape(-1, 3)
+			normals = numpy.array(normals, dtype=numpy.float64).reshape(-1, 3)
+
+		# the mesh vertex of every vertex buffer entry
+		if not isArmature and noDoubleVerts:
+			distinct, vertexIDs = common.getDistinctRows(
+				numpy.hstack((positions, normals)))
+			positions = distinct[:, :3]
+			normals = distinct[:, 3:]
+		else:
+			vertexIDs = numpy.arange(len(positions))
+
+		bufferIDs = {k: i for i, k in enumerate(a.vertices.keys())}
+
+		# getting the polygons; the vertex buffer entry and uv of every
+		# strip corner, as well as the size, direction and material of
+		# every strip
+		cornerIDs = list()
+		cornerUVs = list()
+		stripSizes = list()
+		stripReverse = list()
+		stripMaterials = list()
 		meshMaterials = list()
-		filteredPolys = 0
 		from .enums import StripFlags as sf
 		for c in a.polyChunks:
 			if c.chunkType.value > 63 and c.chunkType.value < 76:
@@ -1510,41 +1855,19 @@ def ProcessChunkData(models: List[common.Model], attaches: Dict[int, processedAt
 				tmpMat["b_useEnv"] = bool(f & sf.ENV_MAPPING)
 				tmpMat["b_unknown"] = bool(f & sf.Unknown)
 
-				material = None
-
-				for i, key in enumerate(matDicts):
-					if key == tmpMat:
-						material = materials[i]
-						break
-
-				if material is None:
-					material = bpy.data.materials.new(name="material_" + str(len(materials)))
-					material.saSettings.readMatDict(tmpMat)
-
-					materials.append(material)
-					matDicts.append(copy.deepcopy(tmpMat))
+				material = materialCache.get(tmpMat)
 
 				if material not in meshMaterials:
 					meshMaterials.append(material)
 
 				matIndex = meshMaterials.index(material)
 
-				if len(matMarkers) == 0 or matMarkers[lastAdded] != matIndex:
-					lastAdded = len(polygons)
-					matMarkers[lastAdded] = matIndex
-
 				for si, s in enumerate(c.strips):
-					rev = c.reversedStrips[si]
-					for p in range(len(s) - 2):
-						if rev:
-							p = (s[p+1], s[p], s[p+2])
-						else:
-							p = (s[p], s[p+1], s[p+2])
-						rev = not rev
-						if p[0] == p[1] or p[1] == p[2] or p[2] == p[0]:
-							filteredPolys += 1
-							continue
-						polygons.append(p)
+					stripSizes.append(len(s))
+					stripReverse.append(c.reversedStrips[si])
+					stripMaterials.append(matIndex)
+					cornerIDs.extend([bufferIDs[pv.index] for pv in s])
+					cornerUVs.extend([pv.uv.getBlenderUV() for pv in s])
 
 			# if material or blendalpha
 			elif (c.chunkType.value > 15 and c.chunkType.value < 32) \
@@ -1644,54 +1967,31 @@ def ProcessChunkData(models: List[common.Model], attaches: Dict[int, processedAt
 		else:
 			mesh.saSettings.sa2ExportType = 'VC'
 
-		bm = bmesh.new()
-		bm.from_mesh(mesh)
-
-		# adding the vertices
-		for v in vDistinct:
-			bm.verts.new(v[0])
+		# creating the polygons
+		tris = common.stripsToTriangles(stripSizes, stripReverse)
+		triCounts = numpy.maximum(numpy.array(stripSizes, dtype=numpy.int64) - 2, 0)
+		cornerIDs = numpy.array(cornerIDs, dtype=numpy.int64)
+		triCorners = cornerIDs[tris]
 
-		bm.verts.ensure_lookup_table()
-		bm.verts.index_update()
+		uvs = numpy.array(cornerUVs, dtype=numpy.float32).reshape(-1, 2)[tris]
 
-		# adding the polygons
-		uvLayer = bm.loops.layers.uv.new("UV0")
+		colors = None
 		if a.hasColor:
-			colorLayer = bm.loops.layers.color.new("COL0")
-
-		# creating the polygons
-		split_normals = list()
-		doubleFaces = 0
-		matIndex = 0
-		for i, p in enumerate(polygons):
-			verts = []
-			for c in p:
-				verts.append(bm.verts[vIDs[c.index]])
-			try:
-				face = bm.faces.new(verts)
-			except Exception as e:
-				doubleFaces += 1
-				continue
-
-			for li, c in enumerate(p):
-				split_normals.append(normals[vIDs[c.index]])
-				face.loops[li][uvLayer].uv = c.uv.getBlenderUV()
-				if a.hasColor:
-					face.loops[li][colorLayer] = a.vertices[c.index].getColor()
-
-			if i in matMarkers:
-				matIndex = matMarkers[i]
-			face.smooth = True
-			face.material_index = matIndex
-
-		bm.to_mesh(mesh)
-		bm.clear()
-
-		# setting normals
-		mesh.create_normals_split()
-		mesh.normals_split_custom_set(split_normals)
-		mesh.use_auto_smooth = True
-		mesh.auto_smooth_angle = 180
+			colors = numpy.array(
+				[v.getColor() for v in a.vertices.values()],
+				dtype=numpy.float32).reshape(-1, 4)[triCorners]
+
+		doubleFaces = common.buildMesh(
+			mesh,
+			positions,
+			vertexIDs[triCorners],
+			numpy.repeat(numpy.array(stripMaterials, dtype=numpy.int32), triCounts),
+			uvs,
+			colors,
+			normals)
+
+		if doubleFaces > 0:
+			log.debug("Double faces: %i", doubleFaces)
 
 		if isArmature:
 			meshOBJ = bpy.data.objects.new(mesh.name, mesh)
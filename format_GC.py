@@ -3,34 +3,54 @@ import math
 import mathutils
 from typing import List, Dict, Tuple
 import copy
+import struct
+import operator
+import numpy
 
-from . import fileHelper, enums, strippifier, common
+from . import fileHelper, enums, strippifier, common, exportStats, debugLog, fileIndex
 from .common import Vector3, ColorARGB, UV, BoundingBox
 from .prop.properties import SAMaterialSettings
 
-DO = False
-
-def debug(*string):
-	global DO
-	if DO:
-		print(*string)
+log = debugLog.getLogger('GC')
+# whether vertex data should be written in the smallest fitting format
+quantize = False
+# the highest allowed position error when quantizing
+maxPositionError = 0.001
+# whether the vertex data should be sorted by how often it is used
+sortByUse = False
 
 # == Geometry parameters ==
 class Parameter:
+	"""A single geometry parameter.
+
+	Parameters read from a file are shared between all geometries that
+	use them and can't be changed anymore"""
 
 	pType: enums.ParameterType
 	data: int
+	frozen: bool
 
 	def __init__(self, pType: enums.ParameterType):
 		self.pType = pType
 		self.data = 0
 
+	def __setattr__(self, name, value):
+		if self.__dict__.get("frozen", False):
+			raise AttributeError("Parameter " + str(self.pType) + " is shared and can't be changed")
+		super().__setattr__(name, value)
+
 	def write(self, fileW: fileHelper.FileWriter):
 		fileW.wUInt(self.pType.value)
 		fileW.wUInt(self.data)
 
 	@classmethod
 	def read(cls, fileR: fileHelper.FileReader, address: int):
+		"""Returns the (shared) parameter at the address"""
+		key = (fileR.endian, fileR.fileC[address:address + 8])
+		param = readParameters.get(key)
+		if param is not None:
+			return param
+
 		pType = enums.ParameterType(fileR.rUInt(address))
 		data = fileR.rUInt(address+4)
 
@@ -51,15 +71,18 @@ class Parameter:
 		elif pType == enums.ParameterType.TexCoordGen:
 			param = TexCoordGen(enums.TexGenMtx.Identity, enums.TexGenSrc.TexCoord0, enums.TexGenType.Matrix2x4, enums.TexCoordID.TexCoord0)
 		else:
-			print("type not found?")
+			log.warning("Parameter type %s not found?", pType)
 
 		param.data = data
-
-		#print(param.data)
-		#print(param.pType)
+		param.frozen = True
+		readParameters[key] = param
 
 		return param
 
+# parameters that have been read, by endianness and raw bytes.
+# cleared at the start of every read and after processing the attaches
+readParameters: Dict[Tuple[str, bytes], Parameter] = dict()
+
 class VtxAttrFmt(Parameter):
 	"""We dont know what this does but we know that we
 	need one for each vertex data set"""
@@ -87,6 +110,13 @@ class VtxAttrFmt(Parameter):
 		self.data &= ~0xFFFF
 		self.data |= min(0xFFFF, val)
 
+	def setFormat(self,
+				  compCount: enums.ComponentCount,
+				  dataType: enums.DataType,
+				  fracBitCount: int):
+		"""Sets the data format (stored in the unknown value)"""
+		self.unknown = (compCount.value << 12) | (dataType.value << 8) | fracBitCount
+
 	@property
 	def vtxType(self) -> enums.VertexAttribute:
 		return enums.VertexAttribute((self.data >> 16) & 0xFFFF)
@@ -339,9 +369,98 @@ class PolyVert:
 	def __eq__(self, other):
 		return self.posID == other.posID and self.nrmID == other.nrmID and self.vcID == other.vcID and self.uvID == other.uvID
 
+	def __hash__(self):
+		return hash((self.posID, self.nrmID, self.vcID, self.uvID))
+
 	def __str__(self):
 		return "(" + str(self.posID).zfill(3) + ", " + str(self.nrmID).zfill(3) + ", " + str(self.vcID).zfill(3) + ", " + str(self.uvID).zfill(3) + ")"
 
+class IndexFormat:
+	"""Per-corner record layout of the polygon indices, compiled once
+	from the index attribute flags of a geometry"""
+
+	# (presence flag, 16 bit flag) of normal, color and uv index
+	OPTIONAL = ((enums.IndexAttributeFlags.HasNormal,
+				 enums.IndexAttributeFlags.Normal16BitIndex),
+				(enums.IndexAttributeFlags.HasColor,
+				 enums.IndexAttributeFlags.Color16BitIndex),
+				(enums.IndexAttributeFlags.HasUV,
+				 enums.IndexAttributeFlags.UV16BitIndex))
+
+	FIELDS = ("posID", "nrmID", "vcID", "uvID")
+
+	record: struct.Struct
+	fields: Tuple[int]
+
+	def __init__(self, indexAttributes: enums.IndexAttributeFlags):
+		# the position index is always stored
+		fmt = "H" if indexAttributes & enums.IndexAttributeFlags.Position16BitIndex else "B"
+		fields = [0]
+		for i, (has, is16Bit) in enumerate(IndexFormat.OPTIONAL):
+			if indexAttributes & has:
+				fmt += "H" if indexAttributes & is16Bit else "B"
+				fields.append(i + 1)
+
+		self.format = fmt
+		self.record = struct.Struct(">" + fmt)
+		self.fields = tuple(fields)
+
+		# missing indices read the 0 appended to each record
+		slots = [-1] * 4
+		for i, f in enumerate(fields):
+			slots[f] = i
+		self.toIDs = operator.itemgetter(*slots)
+		self.fromVert = operator.attrgetter(
+			*[IndexFormat.FIELDS[f] for f in fields])
+
+	@property
+	def size(self) -> int:
+		return self.record.size
+
+	@classmethod
+	def get(cls, indexAttributes: enums.IndexAttributeFlags) -> 'IndexFormat':
+		"""Returns the (cached) format of the given index attributes"""
+		key = indexAttributes.value
+		result = indexFormats.get(key)
+		if result is None:
+			result = IndexFormat(indexAttributes)
+			indexFormats[key] = result
+		return result
+
+	def unpack(self, data: bytes, offset: int, count: int) -> List[PolyVert]:
+		"""Reads count corners starting at offset"""
+		end = offset + count * self.record.size
+		toIDs = self.toIDs
+		return [PolyVert(*toIDs(r + (0,)))
+				for r in self.record.iter_unpack(data[offset:end])]
+
+	def pack(self, polyVerts: List[PolyVert]) -> bytes:
+		"""Returns the corners as packed bytes"""
+		fromVert = self.fromVert
+		if len(self.fields) == 1:
+			values = [fromVert(p) for p in polyVerts]
+		else:
+			values = [i for p in polyVerts for i in fromVert(p)]
+		return struct.pack(">" + self.format * len(polyVerts), *values)
+
+# compiled index formats, by index attribute flags
+indexFormats: Dict[int, IndexFormat] = dict()
+
+def stripToList(strip: List[PolyVert]) -> List[PolyVert]:
+	"""Converts a strip into triangle list corners with the same facing.
+	Triangle lists are read like strips of 3, so every second triangle
+	gets its first two corners swapped"""
+	result = list()
+	for i in range(len(strip) - 2):
+		a, b, c = strip[i:i+3]
+		if a == b or b == c or a == c:
+			continue
+		if i & 1:
+			result.extend((b, a, c))
+		else:
+			result.extend((a, b, c))
+	return result
+
 class Geometry:
 	"""Holds a single polygon data set"""
 
@@ -368,7 +487,7 @@ class Geometry:
 				self.transparent = p.active
 
 		if self.indexAttributes is None:
-			print("Index attributes not found")
+			log.warning("Index attributes not found")
 
 	def writeParams(self, fileW: fileHelper.FileWriter):
 		"""Writes the parameters of the geometry"""
@@ -381,48 +500,33 @@ class Geometry:
 		self.polygonPtr = fileW.tell()
 		fileW.setBigEndian(True)
 
-		toWrite = list()
+		indexFormat = IndexFormat.get(self.indexAttributes)
+
+		strips = list()
 		triangleList = list()
 
 		for l in self.polygons:
-			if len(l) == 3:
-				triangleList.extend(l)
+			# in the triangle list, every triangle takes 3 corners, but no
+			# primitive header (3 bytes) is needed. that only pays off for
+			# strips with a single triangle, or with two triangles when a
+			# corner takes one byte
+			if (len(l) - 2) * 3 * indexFormat.size <= 3 + len(l) * indexFormat.size:
+				triangleList.extend(stripToList(l))
 			else:
-				toWrite.append(l)
-
-		if len(triangleList) > 0:
-			toWrite.append(triangleList)
+				strips.append(l)
 
-		for l in toWrite:
-			if l is triangleList:
-				fileW.wByte(enums.PrimitiveType.Triangles.value)
-			else:
-				fileW.wByte(enums.PrimitiveType.TriangleStrip.value)
+		for l in strips:
+			fileW.wByte(enums.PrimitiveType.TriangleStrip.value)
 			fileW.wUShort(len(l))
+			fileW.w(indexFormat.pack(l))
 
-			for p in l:
-				if self.indexAttributes & enums.IndexAttributeFlags.Position16BitIndex:
-					fileW.wUShort(p.posID)
-				else:
-					fileW.wByte(p.posID)
-
-				if self.indexAttributes & enums.IndexAttributeFlags.HasNormal:
-					if self.indexAttributes & enums.IndexAttributeFlags.Normal16BitIndex:
-						fileW.wUShort(p.nrmID)
-					else:
-						fileW.wByte(p.nrmID)
-
-				if self.indexAttributes & enums.IndexAttributeFlags.HasColor:
-					if self.indexAttributes & enums.IndexAttributeFlags.Color16BitIndex:
-						fileW.wUShort(p.vcID)
-					else:
-						fileW.wByte(p.vcID)
-
-				if self.indexAttributes & enums.IndexAttributeFlags.HasUV:
-					if self.indexAttributes & enums.IndexAttributeFlags.UV16BitIndex:
-						fileW.wUShort(p.uvID)
-					else:
-						fileW.wByte(p.uvID)
+		# the corner count is 16 bit, so long triangle lists have to be
+		# split (0xFFFF is a multiple of 3)
+		for start in range(0, len(triangleList), 0xFFFF):
+			l = triangleList[start:start + 0xFFFF]
+			fileW.wByte(enums.PrimitiveType.Triangles.value)
+			fileW.wUShort(len(l))
+			fileW.w(indexFormat.pack(l))
 
 		fileW.setBigEndian(False)
 
@@ -436,36 +540,39 @@ class Geometry:
 		fileW.wUInt(self.polygonSize)
 
 	@classmethod
-	def read(cls, fileR: fileHelper.FileReader, address: int, paramDict: dict):
+	def read(cls,
+			 fileR: fileHelper.FileReader,
+			 address: int,
+			 paramDict: dict,
+			 index: fileIndex.FileIndex = None):
 
 		paramPtr = fileR.rUInt(address)
 		paramCount = fileR.rUInt(address + 4)
 		polyPtr = fileR.rUInt(address + 8)
 		polySize = fileR.rUInt(address + 12)
 
-		if DO:
-			print("   Param Count:", paramCount)
-			print("   Poly Size:", polySize, "\n")
+		log.debug("   Param Count: %i\n"
+				  "   Poly Size: %i\n", paramCount, polySize)
 
-		for i in range(paramCount):
-			param = Parameter.read(fileR, paramPtr)
+		params: List[Parameter] = fileIndex.decode(
+			index, paramPtr, "parameters",
+			lambda: [Parameter.read(fileR, paramPtr + i * 8)
+					 for i in range(paramCount)])
+		for param in params:
 			if param.pType == enums.ParameterType.VtxAttrFmt:
 				paramDict[param.vtxType] = param
 			else:
 				paramDict[param.pType] = param
-			paramPtr += 8
 
 		idAttr = enums.IndexAttributeFlags.null
 
-		params = list()
-
-		for p in paramDict.values():
-			params.append(copy.deepcopy(p))
+		params = list(paramDict.values())
 
 		if enums.ParameterType.IndexAttributeFlags in paramDict:
 			idAttr = paramDict[enums.ParameterType.IndexAttributeFlags].indexAttributes
 		else:
-			print("no index attributes found")
+			log.warning("no index attributes found")
+		indexFormat = IndexFormat.get(idAttr)
 
 		#reading polygons
 		tmpAddr = polyPtr
@@ -479,45 +586,10 @@ class Geometry:
 			polyType = enums.PrimitiveType(polyType)
 			vCount = fileR.rUShort(tmpAddr)
 			tmpAddr += 2
-			polys = list()
 			if vCount == 0:
 				break
-			for i in range(vCount):
-				if idAttr & enums.IndexAttributeFlags.Position16BitIndex:
-					pos = fileR.rUShort(tmpAddr)
-					tmpAddr += 2
-				else:
-					pos = fileR.rByte(tmpAddr)
-					tmpAddr += 1
-
-				nrm = 0
-				if idAttr & enums.IndexAttributeFlags.HasNormal:
-					if idAttr & enums.IndexAttributeFlags.Normal16BitIndex:
-						nrm = fileR.rUShort(tmpAddr)
-						tmpAddr += 2
-					else:
-						nrm = fileR.rByte(tmpAddr)
-						tmpAddr += 1
-
-				col = 0
-				if idAttr & enums.IndexAttributeFlags.HasColor:
-					if idAttr & enums.IndexAttributeFlags.Color16BitIndex:
-						col = fileR.rUShort(tmpAddr)
-						tmpAddr += 2
-					else:
-						col = fileR.rByte(tmpAddr)
-						tmpAddr += 1
-
-				uv = 0
-				if idAttr & enums.IndexAttributeFlags.HasUV:
-					if idAttr & enums.IndexAttributeFlags.UV16BitIndex:
-						uv = fileR.rUShort(tmpAddr)
-						tmpAddr += 2
-					else:
-						uv = fileR.rByte(tmpAddr)
-						tmpAddr += 1
-
-				polys.append(PolyVert(pos, nrm, col, uv))
+			polys = indexFormat.unpack(fileR.fileC, tmpAddr, vCount)
+			tmpAddr += vCount * indexFormat.size
 
 			if polyType == enums.PrimitiveType.Triangles and vCount > 3:
 				triCount = math.floor(vCount/3)
@@ -529,8 +601,51 @@ class Geometry:
 
 		return Geometry(params, polygons)
 
+# numpy type of each non color data type
+NUMERIC_TYPES = {
+	enums.DataType.Unsigned8: "B",
+	enums.DataType.Signed8: "b",
+	enums.DataType.Unsigned16: "H",
+	enums.DataType.Signed16: "h",
+	enums.DataType.Float32: "f",
+}
+
+COLOR_TYPES = {
+	enums.DataType.RGB565,
+	enums.DataType.RGB8,
+	enums.DataType.RGBX8,
+	enums.DataType.RGBA4,
+	enums.DataType.RGBA6,
+	enums.DataType.RGBA8,
+}
+
+def reduceColorBits(values: numpy.ndarray, bits: Tuple[int]) -> List[numpy.ndarray]:
+	"""Returns the color channels (rgba bytes) reduced to the given bit
+	counts, or None if any value would change"""
+	result = list()
+	for i, b in enumerate(bits):
+		mask = (1 << b) - 1
+		v = (values[:, i] * mask + 127) // 255
+		if numpy.any((v * 255 + (mask >> 1)) // mask != values[:, i]):
+			return None
+		result.append(v)
+	return result
+
+# index of the polygon corner field (see IndexFormat.FIELDS) of each vertex attribute
+VERTEX_FIELDS = {
+	enums.VertexAttribute.Position: 0,
+	enums.VertexAttribute.Normal: 1,
+	enums.VertexAttribute.Color0: 2,
+	enums.VertexAttribute.Tex0: 3,
+}
+
 class Vertices:
-	"""One vertex data array"""
+	"""One vertex data array
+
+	When exporting, data holds the Vector3, UV and ColorARGB objects to
+	write. When importing, it is a numpy array with one row per vertex:
+	positions and normals as xyz floats, uvs as raw (u, v) values and
+	colors as RGBA bytes"""
 
 	vType: enums.VertexAttribute
 	fracBitCount: int
@@ -556,20 +671,31 @@ class Vertices:
 		return self.compCount.length * self.dataType.length
 
 	def debug(self):
-		print("  Attrib:", self.vType)
-		print("   fracBitCount:", self.fracBitCount)
-		print("   vCount:", len(self.data))
-		print("   Component Count:", self.compCount)
-		print("   Data Type:", self.dataType)
-		print("   Data Pointer:", common.hex4(self.dataPtr))
-		print("   Size:", len(self.data) * self.getCompSize())
-		print(" - - - - \n")
+		log.debug("  Attrib: %s\n"
+				  "   fracBitCount: %i\n"
+				  "   vCount: %i\n"
+				  "   Component Count: %s\n"
+				  "   Data Type: %s\n"
+				  "   Data Pointer: %s\n"
+				  "   Size: %i\n"
+				  " - - - - \n",
+				  self.vType,
+				  self.fracBitCount,
+				  len(self.data),
+				  self.compCount,
+				  self.dataType,
+				  common.hex4(self.dataPtr),
+				  len(self.data) * self.getCompSize())
 
 	def writeData(self, fileW: fileHelper.FileWriter):
 		"""Writes the data and saves the pointer"""
 		self.dataPtr = fileW.tell()
 
-		if self.vType == enums.VertexAttribute.Color0 or self.vType == enums.VertexAttribute.Color1:
+		if isinstance(self.data, numpy.ndarray):
+			# quantized data
+			dtype = self.data.dtype.newbyteorder(fileW.endian)
+			fileW.w(self.data.astype(dtype).tobytes())
+		elif self.vType == enums.VertexAttribute.Color0 or self.vType == enums.VertexAttribute.Color1:
 			for e in self.data:
 				e.writeRGBA(fileW)
 		else:
@@ -587,6 +713,111 @@ class Vertices:
 		fileW.wUInt(self.dataPtr)
 		fileW.wUInt(len(self.data) * self.getCompSize())
 
+	def quantized(self) -> Tuple['Vertices', float]:
+		"""Returns the vertices in the smallest format that is exact enough
+		(or themselves if there is none), together with the highest error"""
+
+		if self.vType == enums.VertexAttribute.Position:
+			values = numpy.array(self.data, dtype=numpy.float64)
+			biggest = numpy.abs(values).max(initial=0)
+			# the most fraction bits at which all values fit into 16 bits
+			fracBitCount = 15
+			while fracBitCount >= 0 and round(biggest * (1 << fracBitCount)) > 0x7FFF:
+				fracBitCount -= 1
+			if fracBitCount < 0:
+				return self, 0.0
+
+			scale = 1 << fracBitCount
+			data = numpy.round(values * scale)
+			error = numpy.abs(data / scale - values).max(initial=0)
+			if error > maxPositionError:
+				return self, 0.0
+			return Vertices(self.vType,
+							fracBitCount,
+							self.compCount,
+							enums.DataType.Signed16,
+							data.astype(numpy.int16)), error
+
+		elif self.vType == enums.VertexAttribute.Normal:
+			# unit length, so 6 fraction bits always fit
+			values = numpy.array(self.data, dtype=numpy.float64)
+			data = numpy.clip(numpy.round(values * 64), -128, 127)
+			error = numpy.abs(data / 64 - values).max(initial=0)
+			return Vertices(self.vType,
+							6,
+							self.compCount,
+							enums.DataType.Signed8,
+							data.astype(numpy.int8)), error
+
+		elif self.vType == enums.VertexAttribute.Color0:
+			values = numpy.array([(c.r, c.g, c.b, c.a) for c in self.data],
+								 dtype=numpy.uint32).reshape(-1, 4)
+
+			if numpy.all(values[:, 3] == 255):
+				c = reduceColorBits(values, (5, 6, 5))
+				if c is not None:
+					return Vertices(self.vType,
+									0,
+									enums.ComponentCount.Color_RGB,
+									enums.DataType.RGB565,
+									((c[0] << 11) | (c[1] << 5) | c[2]).astype(numpy.uint16)), 0.0
+
+			c = reduceColorBits(values, (4, 4, 4, 4))
+			if c is not None:
+				return Vertices(self.vType,
+								0,
+								self.compCount,
+								enums.DataType.RGBA4,
+								((c[0] << 12) | (c[1] << 8) | (c[2] << 4) | c[3]).astype(numpy.uint16)), 0.0
+
+		return self, 0.0
+
+	@classmethod
+	def readColors(cls,
+				   fileR: fileHelper.FileReader,
+				   address: int,
+				   count: int,
+				   dataType: enums.DataType) -> numpy.ndarray:
+		"""Reads packed colors as a (count, 4) RGBA byte array"""
+		if dataType == enums.DataType.RGB8 or dataType == enums.DataType.RGBA6:
+			# 3 byte values
+			b = fileR.rArray("B", address, count * 3).reshape(count, 3).astype(numpy.uint32)
+			if fileR.isBigEndian():
+				v = (b[:, 0] << 16) | (b[:, 1] << 8) | b[:, 2]
+			else:
+				v = (b[:, 2] << 16) | (b[:, 1] << 8) | b[:, 0]
+		elif dataType == enums.DataType.RGB565 or dataType == enums.DataType.RGBA4:
+			v = fileR.rArray("H", address, count).astype(numpy.uint32)
+		else:
+			v = fileR.rArray("I", address, count)
+
+		# (shift, bit count) of red, green, blue and alpha; alpha is opaque
+		# if the format has none
+		if dataType == enums.DataType.RGB565:
+			channels = ((11, 5), (5, 6), (0, 5), None)
+		elif dataType == enums.DataType.RGBA4:
+			channels = ((12, 4), (8, 4), (4, 4), (0, 4))
+		elif dataType == enums.DataType.RGBA6:
+			channels = ((18, 6), (12, 6), (6, 6), (0, 6))
+		elif dataType == enums.DataType.RGB8:
+			channels = ((16, 8), (8, 8), (0, 8), None)
+		elif dataType == enums.DataType.RGBX8:
+			channels = ((24, 8), (16, 8), (8, 8), None)
+		else:
+			channels = ((24, 8), (16, 8), (8, 8), (0, 8))
+
+		result = numpy.full((count, 4), 255, dtype=numpy.uint8)
+		for i, c in enumerate(channels):
+			if c is None:
+				continue
+			shift, bits = c
+			mask = (1 << bits) - 1
+			value = (v >> shift) & mask
+			if bits < 8:
+				value = (value * 255 + (mask >> 1)) // mask
+			result[:, i] = value
+		return result
+
 	@classmethod
 	def read(cls, fileR: fileHelper.FileReader, address: int):
 
@@ -601,60 +832,75 @@ class Vertices:
 		dataPtr = fileR.rUInt(address + 8)
 		dataSize = fileR.rUInt(address + 12)
 
-		data = list()
-		vProps = Vertices(vType, fracBitCount, compCount, dataType, data)
-		compSize = vProps.getCompSize()
-
-		for i in range(vCount):
-			values = []
-
-			for c in range(compCount.length):
-				t = 0
-				if dataType == enums.DataType.Signed8:
-					t = fileR.rSByte(dataPtr)
-				elif dataType == enums.DataType.Unsigned8:
-					t = fileR.rByte(dataPtr)
-				elif dataType == enums.DataType.Signed16:
-					t = fileR.rShort(dataPtr)
-				elif dataType == enums.DataType.Unsigned16:
-					t = fileR.rUShort(dataPtr)
-				elif dataType == enums.DataType.Float32:
-					t = fileR.rFloat(dataPtr)
-				elif dataType == enums.DataType.RGB565:
-					t = fileR.rUShort(dataPtr)
-				elif dataType == enums.DataType.RGBA4:
-					t = fileR.rUShort(dataPtr)
-					t = ((t & 0xF) * 2) | ((((t & 0xF0) >> 4) * 2) << 8) | ((((t & 0xF00) >> 8) * 2) << 16) | ((((t & 0xF000) >> 12) * 2) << 24)
-					t = common.ColorARGB.fromRGBA(t)
-				elif dataType == enums.DataType.RGBA6:
-					t = fileR.rUInt(dataPtr)
-					t = round((t & 0x3F) * 1.5) | (round(((t & 0xFc0) >> 6) * 1.5) << 8) | (round(((t & 0x3F000) >> 12) * 1.5) << 16) | (round(((t & 0xFC0000) >> 18) * 1.5) << 24)
-					t = common.ColorARGB.fromRGBA(t)
-				elif dataType == enums.DataType.RGBX8 or dataType == enums.DataType.RGB8:
-					t = fileR.rUInt(dataPtr) | 0xFF000000
-					t = common.ColorARGB.fromRGBA(t)
-				elif dataType == enums.DataType.RGBA8:
-					t = fileR.rUInt(dataPtr)
-					t = common.ColorARGB.fromRGBA(t)
-
-				values.append(t)
-				dataPtr += dataType.length
-
-			if compCount == enums.ComponentCount.TexCoord_S or compCount == enums.ComponentCount.TexCoord_ST:
-				t = UV()
-				t.x = values[0]
-				if len(values) == 2:
-					t.y = values[1]
-
-			elif compCount == enums.ComponentCount.Position_XY or compCount == enums.ComponentCount.Position_XYZ or compCount == enums.ComponentCount.Normal_XYZ:
-				if len(values) == 2:
-					values.append(0)
-				t = Vector3(values)
-
-			data.append(t)
+		if dataType in COLOR_TYPES:
+			data = Vertices.readColors(fileR, dataPtr, vCount, dataType)
+		else:
+			data = fileR.rArray(NUMERIC_TYPES[dataType],
+								dataPtr,
+								vCount * compCount.length)
+			data = data.reshape(vCount, compCount.length).astype(numpy.float64)
+
+			# integer positions and normals are fixed point numbers;
+			# uvs keep their raw values and get scaled on import
+			if (vType == enums.VertexAttribute.Position
+					or vType == enums.VertexAttribute.Normal) \
+					and dataType != enums.DataType.Float32:
+				data /= 1 << fracBitCount
+
+			if compCount == enums.ComponentCount.Position_XY:
+				data = numpy.hstack((data, numpy.zeros((vCount, 1))))
 
 		return Vertices(vType, fracBitCount, compCount, dataType, data)
 
+def sortVerticesByUse(vertices: List[Vertices],
+					  strips: List[List[List[PolyVert]]]) -> List[List[List[PolyVert]]]:
+	"""Sorts the vertex data arrays by how many polygon corners use each
+	entry (most used first), so that more geometries get away with 8 bit
+	indices. Entries that no corner uses are removed. Returns the strips
+	with the updated indices"""
+
+	corners = [p for m in strips if m is not None for l in m for p in l]
+	if len(corners) == 0:
+		return strips
+
+	remaps = list()
+	for v in vertices:
+		field = IndexFormat.FIELDS[VERTEX_FIELDS[v.vType]]
+		counts = numpy.bincount([getattr(p, field) for p in corners],
+								minlength=len(v.data))
+		# stable, so equally used entries keep their order
+		order = numpy.argsort(-counts, kind="stable")
+		order = order[:numpy.count_nonzero(counts)]
+		remap = numpy.zeros(len(counts), dtype=order.dtype)
+		remap[order] = numpy.arange(len(order))
+		remaps.append((field, remap.tolist()))
+
+		if isinstance(v.data, numpy.ndarray):
+			v.data = v.data[order]
+		else:
+			v.data = [v.data[i] for i in order]
+
+	newVerts: Dict[PolyVert, PolyVert] = dict()
+	result = list()
+	for m in strips:
+		if m is None:
+			result.append(None)
+			continue
+		newStrips = list()
+		for l in m:
+			newStrip = list()
+			for p in l:
+				n = newVerts.get(p)
+				if n is None:
+					n = copy.copy(p)
+					for field, remap in remaps:
+						setattr(n, field, remap[getattr(p, field)])
+					newVerts[p] = n
+				newStrip.append(n)
+			newStrips.append(newStrip)
+		result.append(newStrips)
+	return result
+
 class Attach:
 	"""Gamecube format attach"""
 
@@ -765,6 +1011,33 @@ class Attach:
 					uvIDs[i] = found
 			vertices.append( Vertices(enums.VertexAttribute.Tex0, 4, enums.ComponentCount.TexCoord_ST, enums.DataType.Signed16, uvData))
 
+		if quantize:
+			with exportStats.stage("quantization") as stage:
+				report = list()
+				formats = dict()
+				for i, v in enumerate(vertices):
+					q, error = v.quantized()
+					vertices[i] = q
+					report.append("%s: %s %s (%i frac bits, max error %f)"
+								  % (v.vType.name, q.dataType.name, q.compCount.name,
+									 q.fracBitCount, error))
+					formats[v.vType.name] = {
+						"format": q.dataType.name,
+						"components": q.compCount.name,
+						"fracBits": q.fracBitCount,
+						"maxError": float(error)
+					}
+					if q is v:
+						stage.add("unchanged")
+					else:
+						stage.add("quantized")
+					if v.vType == enums.VertexAttribute.Position and q is v:
+						log.warning("Positions of %s can not be quantized within "
+									"a max error of %f, keeping floats",
+									mesh.name, maxPositionError)
+				stage.detail(mesh.name, formats)
+				log.info("Vertex formats of %s:\n %s", mesh.name, "\n ".join(report))
+
 		# assembling polygons
 
 		# preparing polygon lists
@@ -798,7 +1071,7 @@ class Attach:
 				degTris += 1
 
 		if degTris > 0:
-			debug("degTris:", degTris)
+			log.debug("degTris: %i", degTris)
 
 		#strippifying the poly data
 
@@ -809,10 +1082,7 @@ class Attach:
 				strips.append(None)
 				continue
 
-			distinct = list()
-			IDs = [0] * len(l)
-
-			distinct, IDs = common.getDistinctwID(l)
+			distinct, IDs = common.getDistinctwID(l, hashable=True)
 
 			stripIndices = strippifier.Strippify(IDs, doSwaps=False, concat=False, name = mesh.name)
 
@@ -826,6 +1096,9 @@ class Attach:
 
 			strips.append(polyStrips)
 
+		if sortByUse:
+			strips = sortVerticesByUse(vertices, strips)
+
 		# generating geometry from the polygon strips
 		opaqueGeom = list()
 		transparentGeom = list()
@@ -840,34 +1113,36 @@ class Attach:
 				if matName in materials:
 					mat = materials[matName]
 				else:
-					print(" Material", matName, "not found")
+					log.warning(" Material %s not found", matName)
 
 			# generating parameters
 			parameters = list()
 			# vtx attribute parameters come first
-			parameters.append(VtxAttrFmt(enums.VertexAttribute.Position))
+			for v in vertices:
+				vtxFmt = VtxAttrFmt(v.vType)
+				if isinstance(v.data, numpy.ndarray):
+					vtxFmt.setFormat(v.compCount, v.dataType, v.fracBitCount)
+				parameters.append(vtxFmt)
+
 			idAttribs = enums.IndexAttributeFlags.HasPosition
 			if writeNRM:
-				parameters.append(VtxAttrFmt(enums.VertexAttribute.Normal))
 				idAttribs |= enums.IndexAttributeFlags.HasNormal
 			if writeVC:
-				parameters.append(VtxAttrFmt(enums.VertexAttribute.Color0))
 				idAttribs |= enums.IndexAttributeFlags.HasColor
 			if writeUV:
-				parameters.append(VtxAttrFmt(enums.VertexAttribute.Tex0))
 				idAttribs |= enums.IndexAttributeFlags.HasUV
 
-			# ID attributes
-			for l in s:
-				for p in l:
-					if p.posID > 0xFF:
-						idAttribs |= enums.IndexAttributeFlags.Position16BitIndex
-					if writeNRM and p.nrmID > 0xFF:
-						idAttribs |= enums.IndexAttributeFlags.Normal16BitIndex
-					if writeVC and p.vcID > 0xFF:
-						idAttribs |= enums.IndexAttributeFlags.Color16BitIndex
-					if writeUV and p.uvID > 0xFF:
-						idAttribs |= enums.IndexAttributeFlags.UV16BitIndex
+			# ID attributes; indices are 8 bit unless the geometry
+			# uses an entry beyond the first 256
+			corners = [p for l in s for p in l]
+			if max(p.posID for p in corners) > 0xFF:
+				idAttribs |= enums.IndexAttributeFlags.Position16BitIndex
+			if writeNRM and max(p.nrmID for p in corners) > 0xFF:
+				idAttribs |= enums.IndexAttributeFlags.Normal16BitIndex
+			if writeVC and max(p.vcID for p in corners) > 0xFF:
+				idAttribs |= enums.IndexAttributeFlags.Color16BitIndex
+			if writeUV and max(p.uvID for p in corners) > 0xFF:
+				idAttribs |= enums.IndexAttributeFlags.UV16BitIndex
 
 			parameters.append(IndexAttributes(idAttribs))
 
@@ -1130,7 +1405,12 @@ class Attach:
 		self.bounds.write(fileW)
 
 	@classmethod
-	def read(cls, fileR: fileHelper.FileReader, address: int, meshID: int, labels: dict):
+	def read(cls,
+			 fileR: fileHelper.FileReader,
+			 address: int,
+			 meshID: int,
+			 labels: dict,
+			 index: fileIndex.FileIndex = None):
 
 		if address in labels:
 			name: str = labels[address]
@@ -1139,8 +1419,7 @@ class Attach:
 		else:
 			name = "Attach_" + str(meshID)
 
-		if DO:
-			print("\n === reading gc:", name, "===")
+		log.debug("\n === reading gc: %s ===", name)
 
 		# reading vertex attributes
 		vertPtr = fileR.rUInt(address)
@@ -1148,7 +1427,11 @@ class Attach:
 		vertices = list()
 		attrType = enums.VertexAttribute(fileR.rByte(vertPtr))
 		while attrType != enums.VertexAttribute.Null:
-			vertices.append(Vertices.read(fileR, vertPtr))
+			# vertex data is often shared between attaches
+			entry = vertPtr
+			vertices.append(fileIndex.decode(
+				index, fileR.rUInt(entry + 8), "vertex_data",
+				lambda: Vertices.read(fileR, entry)))
 			vertPtr += 16
 			attrType = enums.VertexAttribute(fileR.rByte(vertPtr))
 
@@ -1164,26 +1447,26 @@ class Attach:
 		params = dict()
 
 		for o in range(oMeshCount):
-			if DO:
-				print(" -- Geometry", o, "--")
-			opaqueGeom.append(Geometry.read(fileR, tmpAddr, params))
+			log.debug(" -- Geometry %i --", o)
+			opaqueGeom.append(Geometry.read(fileR, tmpAddr, params, index))
 			tmpAddr += 16
 
 		tmpAddr = fileR.rUInt(address + 12)
 		for t in range(tMeshCount):
-			transparentGeom.append(Geometry.read(fileR, tmpAddr, params))
+			transparentGeom.append(Geometry.read(fileR, tmpAddr, params, index))
 			tmpAddr += 16
 
 
 		return Attach(name, vertices, opaqueGeom, transparentGeom, None)
 
-def process_GC(models: List[common.Model], attaches: Dict[int, Attach]):
+def process_GC(models: List[common.Model],
+			   attaches: Dict[int, Attach],
+			   materialCache: common.MaterialCache = None):
 
-	import bmesh
 	meshes: Dict[int, bpy.types.Mesh] = dict()
 
-	materials: List[bpy.types.Material] = list()
-	matDicts: List[dict] = list()
+	if materialCache is None:
+		materialCache = common.MaterialCache()
 
 	for o in models:
 		if o.meshPtr == 0 or o.meshPtr not in attaches:
@@ -1194,10 +1477,10 @@ def process_GC(models: List[common.Model], attaches: Dict[int, Attach]):
 
 		attach = attaches[o.meshPtr]
 
-		pos: List[Vector3] = None
-		nrm: List[Vector3] = None
-		col: List[ColorARGB] = None
-		uv: List[UV] = None
+		pos: numpy.ndarray = None
+		nrm: numpy.ndarray = None
+		col: numpy.ndarray = None
+		uv: numpy.ndarray = None
 
 		for v in attach.vertices:
 			if v.vType == enums.VertexAttribute.Position:
@@ -1209,19 +1492,22 @@ def process_GC(models: List[common.Model], attaches: Dict[int, Attach]):
 			elif v.vType == enums.VertexAttribute.Tex0:
 				uv = v.data
 
-		vertPairs: Dict[Tuple[int, int], bmesh.types.BMVert] = dict()
-
-		# going through the polygons and creating the vertpairs
 		geom: List[Geometry] = list()
 		geom.extend(attach.opaqueGeom)
 		geom.extend(attach.transparentGeom)
 
-		for g in geom:
+		# the indices of all polygon corners (position, normal, color, uv),
+		# the size of each strip and the geometry that each corner belongs to
+		corners = list()
+		stripSizes = list()
+		cornerGeom = list()
+		for i, g in enumerate(geom):
 			for p in g.polygons:
-				for pv in p:
-					pair = (pv.posID, pv.nrmID)
-					if pair not in vertPairs.keys():
-						vertPairs[pair] = None
+				stripSizes.append(len(p))
+				cornerGeom.extend([i] * len(p))
+				corners.extend([(pv.posID, pv.nrmID, pv.vcID, pv.uvID) for pv in p])
+		corners = numpy.array(corners, dtype=numpy.int64).reshape(-1, 4)
+		cornerGeom = numpy.array(cornerGeom, dtype=numpy.int64)
 
 		# creating the materials
 
@@ -1345,7 +1631,7 @@ def process_GC(models: List[common.Model], attaches: Dict[int, Attach]):
 						elif p.src == enums.TexGenSrc.Tex7:
 							tmpMat["gc_texGenSourceMtx"] = 'TEX7'
 						else:
-							print("Not valid mtx + src combination:", p.typ, p.src)
+							log.warning("Not valid mtx + src combination: %s %s", p.typ, p.src)
 					elif tmpMat["gc_texGenType"][0] == 'B': #Bump
 						if p.src == enums.TexGenSrc.TexCoord0:
 							tmpMat["gc_texGenSourceBmp"] = 'TEXCOORD0'
@@ -1362,14 +1648,14 @@ def process_GC(models: List[common.Model], attaches: Dict[int, Attach]):
 						elif p.src == enums.TexGenSrc.TexCoord6:
 							tmpMat["gc_texGenSourceBmp"] = 'TEXCOORD6'
 						else:
-							print("Not valid mtx + src combination:", p.typ, p.src)
+							log.warning("Not valid mtx + src combination: %s %s", p.typ, p.src)
 					else: #SRTG
 						if p.src == enums.TexGenSrc.Color0:
 							tmpMat["gc_texGenSourceSRTG"] = 'COLOR0'
 						elif p.src == enums.TexGenSrc.Color0:
 							tmpMat["gc_texGenSourceSRTG"] = 'COLOR1'
 						else:
-							print("Not valid mtx + src combination:", p.typ, p.src)
+							log.warning("Not valid mtx + src combination: %s %s", p.typ, p.src)
 
 					#texCoordID
 					if p.texID == enums.TexCoordID.TexCoord0:
@@ -1404,19 +1690,7 @@ def process_GC(models: List[common.Model], attaches: Dict[int, Attach]):
 					tmpMat["b_mirrorU"] = bool(p.tilemode & enums.TileMode.MirrorU)
 					tmpMat["b_mirrorV"] = bool(p.tilemode & enums.TileMode.MirrorV)
 
-			material = None
-
-			for i, key in enumerate(matDicts):
-				if key == tmpMat:
-					material = materials[i]
-					break
-
-			if material is None:
-				material = bpy.data.materials.new(name="material_" + str(len(materials)))
-				material.saSettings.readMatDict(tmpMat)
-
-				materials.append(material)
-				matDicts.append(copy.deepcopy(tmpMat))
+			material = materialCache.get(tmpMat)
 
 			if material not in meshMaterials:
 				meshMaterials.append(material)
@@ -1429,83 +1703,47 @@ def process_GC(models: List[common.Model], attaches: Dict[int, Attach]):
 		for m in meshMaterials:
 			mesh.materials.append(m)
 
-		bm = bmesh.new()
-		bm.from_mesh(mesh)
+		# every distinct position + normal pair becomes a vertex
+		vertPairs, cornerVerts = common.getDistinctRows(corners[:, :2])
 
-		normals = list()
+		# the strips of gc models start with a flipped triangle
+		tris = common.stripsToTriangles(
+			stripSizes, numpy.ones(len(stripSizes), dtype=bool))
+		triCorners = corners[tris]
 
-		for vn in vertPairs:
-			v = pos[vn[0]]
-			v = bm.verts.new((v.x, -v.z, v.y))
-			vertPairs[vn] = v
-			if nrm is not None:
-				normals.append(nrm[vn[1]])
-
-		bm.verts.ensure_lookup_table()
-		bm.verts.index_update()
-
-		doubleFaces = 0
+		positions = pos[:, (0, 2, 1)] * (1, -1, 1)
+		normals = None
+		if nrm is not None:
+			normals = nrm[:, (0, 2, 1)] * (1, -1, 1)
+			normals = normals[vertPairs[:, 1]]
 
+		uvs = None
 		if uv is not None:
-			uvLayer = bm.loops.layers.uv.new("UV0")
-		if col is not None:
-			colorLayer = bm.loops.layers.color.new("COL0")
+			uvs = uv[triCorners[..., 3]] / 255.0
+			if uvs.shape[-1] == 1:
+				uvs = numpy.concatenate((uvs, numpy.zeros_like(uvs)), axis=-1)
+			uvs[..., 1] = 1 - uvs[..., 1]
 
-		for matIndex, g in enumerate(geom):
-			for p in g.polygons:
-				rev = True
-				for i in range(len(p) - 2):
-
-					polyVerts: List[PolyVert] = list()
-					verts = list()
-					for pv in range(3):
-						pVert = p[i + pv]
-						pVert.uvID
-						polyVerts.append(pVert)
-						verts.append(vertPairs[(pVert.posID, pVert.nrmID)])
-					if rev:
-						verts = [verts[1], verts[0], verts[2]]
-						polyVerts = [polyVerts[1], polyVerts[0], polyVerts[2]]
-					rev = not rev
-					if len(set(verts)) < 3:
-						continue
-
-					try:
-						face = bm.faces.new(verts)
-					except Exception as e:
-						if not str(e).endswith("exists"):
-							print("Invalid triangle:", str(e))
-						else:
-							doubleFaces += 1
-						continue
-
-					for l, pc in zip(face.loops, polyVerts):
-						if uv is not None:
-							l[uvLayer].uv = uv[pc.uvID].getBlenderUV()
-						if col is not None:
-							l[colorLayer] = col[pc.vcID].toBlenderTuple()
-
-					face.smooth = True
-					face.material_index = geomMaterials[matIndex]
-
-		bm.to_mesh(mesh)
-		bm.clear()
-
-		if nrm is not None:
-			normals = [mathutils.Vector((n.x, -n.z, n.y)).normalized() for n in normals]
-
-			mesh.create_normals_split()
-			split_normal = [normals[l.vertex_index] for l in mesh.loops]
-			mesh.normals_split_custom_set(split_normal)
+		colors = None
+		if col is not None:
+			colors = col[triCorners[..., 2]] / 255.0
 
-		mesh.use_auto_smooth = True
-		mesh.auto_smooth_angle = 180
+		doubleFaces = common.buildMesh(
+			mesh,
+			positions[vertPairs[:, 0]],
+			cornerVerts[tris],
+			numpy.array(geomMaterials, dtype=numpy.int32)[cornerGeom[tris[:, 0]]],
+			uvs,
+			colors,
+			normals)
 
-		# dont ask me why, but blender likes to add sharp edges- we dont need those at all in this case
-		for e in mesh.edges:
-			e.use_edge_sharp = False
+		if doubleFaces > 0:
+			log.debug("Double faces: %i", doubleFaces)
 
 		mesh.saSettings.sa2ExportType = 'VC' if col is not None else 'NRM'
 
 		o.meshes.append(mesh)
 		meshes[o.meshPtr] = mesh
+
+	# the meshes are done, so the read parameters are no longer needed
+	readParameters.clear()
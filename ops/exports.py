@@ -7,7 +7,7 @@ from bpy.props import (
 	EnumProperty,
 	StringProperty
 	)
-from .. import common, strippifier
+from .. import common, strippifier, exportStats
 from ..text import paths
 
 def removeFile() -> None:									## Removes the temporarily created export file.
@@ -28,6 +28,10 @@ def exportFile(op, outType, context, **keywords):			## Main definition for expor
 
 	profile_output = keywords["profile_output"]
 	del keywords["profile_output"]
+	stats_output = keywords["stats_output"]
+	del keywords["stats_output"]
+
+	filepath = keywords["filepath"]
 
 	if profile_output:
 		import cProfile
@@ -35,6 +39,9 @@ def exportFile(op, outType, context, **keywords):			## Main definition for expor
 		pr = cProfile.Profile()
 		pr.enable()
 
+	if stats_output:
+		exportStats.begin(filepath, keywords.get("export_format", "") + outType)
+
 	try:
 		if outType == 'MDL':
 			out = file_MDL.write(context, **keywords)
@@ -48,14 +55,19 @@ def exportFile(op, outType, context, **keywords):			## Main definition for expor
 		removeFile()
 		if profile_output:
 			pr.disable()
+		exportStats.end(False)
 		return {'CANCELLED'}
 	except Exception as e:
 		removeFile()
 		if profile_output:
-			pqr.disable()
+			pr.disable()
+		exportStats.end(False)
 		raise e
 
-	filepath = keywords["filepath"]
+	if stats_output:
+		stats = exportStats.current
+		exportStats.end(True)
+		stats.writeJson(filepath + ".stats.json")
 
 	if profile_output:
 		pr.disable()
@@ -113,6 +125,12 @@ class ExportSA1MDL(bpy.types.Operator, ExportHelper):		## Exports an SA1MDL file
 		default = False
 		)
 
+	stats_output: BoolProperty(
+		name = "Stage statistics",
+		description = "Records time, item counts and peak memory of every export stage, shows them in the tools panel and writes them to a .stats.json file next to the output file (Slows down exporting)",
+		default = False
+		)
+
 	def execute(self, context):
 		from .. import file_MDL
 		keywords = self.as_keywords(ignore=( "check_existing", "filter_glob"))
@@ -129,6 +147,7 @@ class ExportSA1MDL(bpy.types.Operator, ExportHelper):		## Exports an SA1MDL file
 		layout.separator()
 		layout.prop(self, "console_debug_output")
 		layout.prop(self, "profile_output")
+		layout.prop(self, "stats_output")
 
 	def invoke(self, context, event):
 		self.filepath = common.getDefaultPath()
@@ -168,6 +187,12 @@ class ExportSA2MDL(bpy.types.Operator, ExportHelper):		## Exports an SA2MDL file
 		default=True,
 		)
 
+	optimize_CHUNK: BoolProperty(
+		name = "Optimize Vertices",
+		description = "Removes vertices that no polygon uses and orders the rest by their first use in the polygon strips",
+		default = False
+		)
+
 	console_debug_output: BoolProperty(
 		name = "Console Output",
 		description = "Shows exporting progress in Console (Slows down Exporting Immensely)",
@@ -180,6 +205,12 @@ class ExportSA2MDL(bpy.types.Operator, ExportHelper):		## Exports an SA2MDL file
 		default = False
 		)
 
+	stats_output: BoolProperty(
+		name = "Stage statistics",
+		description = "Records time, item counts and peak memory of every export stage, shows them in the tools panel and writes them to a .stats.json file next to the output file (Slows down exporting)",
+		default = False
+		)
+
 	def execute(self, context):
 		from .. import file_MDL
 		keywords = self.as_keywords(ignore=( "check_existing", "filter_glob"))
@@ -193,9 +224,11 @@ class ExportSA2MDL(bpy.types.Operator, ExportHelper):		## Exports an SA2MDL file
 		layout.prop(self, "write_Specular")
 		layout.prop(self, "use_selection")
 		layout.prop(self, "apply_modifs")
+		layout.prop(self, "optimize_CHUNK")
 		layout.separator()
 		layout.prop(self, "console_debug_output")
 		layout.prop(self, "profile_output")
+		layout.prop(self, "stats_output")
 
 	def invoke(self, context, event):
 		self.filepath = common.getDefaultPath()
@@ -228,6 +261,18 @@ class ExportSA2BMDL(bpy.types.Operator, ExportHelper):		## Exports an SA2BMDL fi
 		default=True,
 		)
 
+	quantize_GC: BoolProperty(
+		name = "Quantize Vertices",
+		description = "Writes positions, normals and colors in smaller fixed point/packed formats where they stay (nearly) exact",
+		default = False
+		)
+
+	sort_GC: BoolProperty(
+		name = "Sort Vertices by Use",
+		description = "Sorts the vertex data so that the most used entries come first, which lets more geometry use smaller indices",
+		default = False
+		)
+
 	console_debug_output: BoolProperty(
 		name = "Console Output",
 		description = "Shows exporting progress in Console (Slows down Exporting Immensely)",
@@ -240,6 +285,12 @@ class ExportSA2BMDL(bpy.types.Operator, ExportHelper):		## Exports an SA2BMDL fi
 		default = False
 		)
 
+	stats_output: BoolProperty(
+		name = "Stage statistics",
+		description = "Records time, item counts and peak memory of every export stage, shows them in the tools panel and writes them to a .stats.json file next to the output file (Slows down exporting)",
+		default = False
+		)
+
 	def execute(self, context):
 		from .. import file_MDL
 		keywords = self.as_keywords(ignore=( "check_existing", "filter_glob"))
@@ -253,9 +304,12 @@ class ExportSA2BMDL(bpy.types.Operator, ExportHelper):		## Exports an SA2BMDL fi
 
 		layout.prop(self, "use_selection")
 		layout.prop(self, "apply_modifs")
+		layout.prop(self, "quantize_GC")
+		layout.prop(self, "sort_GC")
 		layout.separator()
 		layout.prop(self, "console_debug_output")
 		layout.prop(self, "profile_output")
+		layout.prop(self, "stats_output")
 
 	def invoke(self, context, event):
 		self.filepath = common.getDefaultPath()
@@ -300,6 +354,12 @@ class ExportSA1LVL(bpy.types.Operator, ExportHelper):		## Exports an SA1LVL file
 		default = False
 		)
 
+	stats_output: BoolProperty(
+		name = "Stage statistics",
+		description = "Records time, item counts and peak memory of every export stage, shows them in the tools panel and writes them to a .stats.json file next to the output file (Slows down exporting)",
+		default = False
+		)
+
 	def execute(self, context):
 		from .. import file_LVL
 		keywords = self.as_keywords(ignore=( "check_existing", "filter_glob"))
@@ -316,6 +376,7 @@ class ExportSA1LVL(bpy.types.Operator, ExportHelper):		## Exports an SA1LVL file
 		layout.separator()
 		layout.prop(self, "console_debug_output")
 		layout.prop(self, "profile_output")
+		layout.prop(self, "stats_output")
 
 	def invoke(self, context, event):
 		self.filepath = common.getDefaultPath()
@@ -354,6 +415,12 @@ class ExportSA2LVL(bpy.types.Operator, ExportHelper):		## Exports an SA2LVL file
 		default=True,
 		)
 
+	optimize_CHUNK: BoolProperty(
+		name = "Optimize Vertices",
+		description = "Removes vertices that no polygon uses and orders the rest by their first use in the polygon strips",
+		default = False
+		)
+
 	console_debug_output: BoolProperty(
 		name = "Console Output",
 		description = "Shows exporting progress in Console (Slows down Exporting Immensely)",
@@ -366,6 +433,12 @@ class ExportSA2LVL(bpy.types.Operator, ExportHelper):		## Exports an SA2LVL file
 		default = False
 		)
 
+	stats_output: BoolProperty(
+		name = "Stage statistics",
+		description = "Records time, item counts and peak memory of every export stage, shows them in the tools panel and writes them to a .stats.json file next to the output file (Slows down exporting)",
+		default = False
+		)
+
 	def execute(self, context):
 		from .. import file_LVL
 		keywords = self.as_keywords(ignore=( "check_existing", "filter_glob"))
@@ -379,9 +452,11 @@ class ExportSA2LVL(bpy.types.Operator, ExportHelper):		## Exports an SA2LVL file
 		layout.prop(self, "write_Specular")
 		layout.prop(self, "use_selection")
 		layout.prop(self, "apply_modifs")
+		layout.prop(self, "optimize_CHUNK")
 		layout.separator()
 		layout.prop(self, "console_debug_output")
 		layout.prop(self, "profile_output")
+		layout.prop(self, "stats_output")
 
 	def invoke(self, context, event):
 		self.filepath = common.getDefaultPath()
@@ -414,6 +489,18 @@ class ExportSA2BLVL(bpy.types.Operator, ExportHelper):		## Exports an SA2BLVL fi
 		default=True,
 		)
 
+	quantize_GC: BoolProperty(
+		name = "Quantize Vertices",
+		description = "Writes positions, normals and colors in smaller fixed point/packed formats where they stay (nearly) exact",
+		default = False
+		)
+
+	sort_GC: BoolProperty(
+		name = "Sort Vertices by Use",
+		description = "Sorts the vertex data so that the most used entries come first, which lets more geometry use smaller indices",
+		default = False
+		)
+
 	console_debug_output: BoolProperty(
 		name = "Console Output",
 		description = "Shows exporting progress in Console (Slows down Exporting Immensely)",
@@ -426,6 +513,12 @@ class ExportSA2BLVL(bpy.types.Operator, ExportHelper):		## Exports an SA2BLVL fi
 		default = False
 		)
 
+	stats_output: BoolProperty(
+		name = "Stage statistics",
+		description = "Records time, item counts and peak memory of every export stage, shows them in the tools panel and writes them to a .stats.json file next to the output file (Slows down exporting)",
+		default = False
+		)
+
 	def execute(self, context):
 		from .. import file_LVL
 		keywords = self.as_keywords(ignore=( "check_existing", "filter_glob"))
@@ -440,9 +533,12 @@ class ExportSA2BLVL(bpy.types.Operator, ExportHelper):		## Exports an SA2BLVL fi
 
 		layout.prop(self, "use_selection")
 		layout.prop(self, "apply_modifs")
+		layout.prop(self, "quantize_GC")
+		layout.prop(self, "sort_GC")
 		layout.separator()
 		layout.prop(self, "console_debug_output")
 		layout.prop(self, "profile_output")
+		layout.prop(self, "stats_output")
 
 	def invoke(self, context, event):
 		self.filepath = common.getDefaultPath()
@@ -33,6 +33,12 @@ class ImportMDL(bpy.types.Operator, ImportHelper):			## Imports *MDL files made
 		default = True,
 		)
 
+	reuseMaterials: BoolProperty(
+		name = "Reuse existing materials",
+		description = "Use materials already in the blend file instead of creating identical ones",
+		default = False,
+		)
+
 	console_debug_output: BoolProperty(
 		name = "Console Output",
 		description = "Shows exporting progress in Console (Slows down Exporting Immensely)",
@@ -47,9 +53,14 @@ class ImportMDL(bpy.types.Operator, ImportHelper):			## Imports *MDL files made
 	def execute(self, context):
 		from .. import file_MDL
 
+		# shared by all files, so that identical materials are only created once
+		materialCache = common.MaterialCache()
+		if self.reuseMaterials:
+			materialCache.addExisting()
+
 		path = os.path.dirname(self.filepath)
 		for f in self.files:
-			file_MDL.read(context, path + "\\" + f.name, self.noDoubleVerts, self.console_debug_output)
+			file_MDL.read(context, path + "\\" + f.name, self.noDoubleVerts, self.console_debug_output, materialCache)
 
 		return {'FINISHED'}
 
@@ -81,6 +92,12 @@ class ImportLVL(bpy.types.Operator, ImportHelper):			## Imports *LVL files made
 		default = True,
 		)
 
+	reuseMaterials: BoolProperty(
+		name = "Reuse existing materials",
+		description = "Use materials already in the blend file instead of creating identical ones",
+		default = False,
+		)
+
 	files: CollectionProperty(
 		name='File paths',
 		type=bpy.types.OperatorFileListElement
@@ -99,9 +116,13 @@ class ImportLVL(bpy.types.Operator, ImportHelper):			## Imports *LVL files made
 			context.space_data.clip_start = 1.0
 			context.space_data.clip_end = 10000.0
 
+		materialCache = common.MaterialCache()
+		if self.reuseMaterials:
+			materialCache.addExisting()
+
 		path = os.path.dirname(self.filepath)
 		for f in self.files:
-			file_LVL.read(context, path + "\\" + f.name, self.noDoubleVerts, self.console_debug_output)
+			file_LVL.read(context, path + "\\" + f.name, self.noDoubleVerts, self.console_debug_output, materialCache)
 		return {'FINISHED'}
 
 	def invoke(self, context, event):
@@ -2,7 +2,9 @@ import bpy
 from bpy.props import (
 	BoolProperty
 	)
-from .. import common
+from .. import common, debugLog
+
+log = debugLog.getLogger('STRIP')
 
 class StrippifyTest(bpy.types.Operator):		## Tests strippifying models for export.
 	'''An operator for test-strippifying a model'''
@@ -33,12 +35,10 @@ class StrippifyTest(bpy.types.Operator):		## Tests strippifying models for expor
 		return wm.invoke_props_dialog(self)
 
 	def execute(self, context):
-		import os
-		os.system("cls")
 		obj = context.active_object
 		if obj is None or not isinstance(obj.data, bpy.types.Mesh):
-			print("active object not a mesh")
-			return {'FINISHED'}
+			self.report({'WARNING'}, "Active object is not a mesh")
+			return {'CANCELLED'}
 
 		ob_for_convert = obj.original
 		me = ob_for_convert.to_mesh(preserve_all_data_layers=True)
@@ -60,6 +60,7 @@ class StrippifyTest(bpy.types.Operator):		## Tests strippifying models for expor
 			return {'CANCELLED'}
 
 
+		degenerate = 0
 		empty = bpy.data.objects.new(obj.data.name + "_str", None)
 		context.collection.objects.link(empty)
 		for i, s in enumerate(indexStrips):
@@ -79,7 +80,7 @@ class StrippifyTest(bpy.types.Operator):		## Tests strippifying models for expor
 				else:
 					p = [s[j], s[j+1], s[j+2]]
 				if len(set(p)) < 3:
-					print("something wrong...")
+					degenerate += 1
 				indexList.append(p)
 				rev = not rev
 
@@ -93,4 +94,9 @@ class StrippifyTest(bpy.types.Operator):		## Tests strippifying models for expor
 			context.collection.objects.link(meObj)
 			meObj.parent = empty
 
+		if degenerate > 0:
+			log.warning("%s: %i degenerate triangles in the strips",
+						obj.name, degenerate)
+			self.report({'WARNING'}, str(degenerate) + " degenerate triangles in the strips")
+
 		return {'FINISHED'}
@@ -6,6 +6,9 @@
 from collections import Counter
 from typing import List, Tuple
 from ctypes import *
+from . import debugLog
+
+log = debugLog.getLogger('STRIP')
 
 raiseTopoErrorG = True
 
@@ -128,7 +131,7 @@ class Triangle:
             if v is v1 or v is v2:
                 continue
             return v
-        print("Vertex not in triangle")
+        log.warning("Vertex not in triangle")
         return None
 
     def getSharedEdge(self, otherTri):
@@ -242,7 +245,8 @@ class Mesh:
                 triEdgeCount += 1
 
         if triEdgeCount > 0:
-            print("There are", triEdgeCount, "edges with more than two faces")
+            log.warning("There are %i edges with more than two faces",
+                        triEdgeCount)
 
 class Strippifier:
     # based on the paper written by David Kronmann:
@@ -366,7 +370,7 @@ class Strippifier:
                 # since we are wrapping back around,
                 # we have to set the first tri too
                 firstTri = self.getFirstTri()
-                print("only two triangles")
+                log.debug("only two triangles")
                 continue
 
             elif secNewTri.hasVertex(sharedVerts[0]):
@@ -498,6 +502,20 @@ def Strippify(indexList: List[int],
               raiseTopoError=False,
               name: str = ""):
 
+    from . import exportStats
+    with exportStats.stage("strippification") as stage:
+        output = StrippifyDLL(indexList, doSwaps, concat, raiseTopoError, name)
+        stage.add("triangles", len(indexList) // 3)
+        stage.add("strips", len(output))
+        stage.add("indices", sum(len(s) for s in output))
+    return output
+
+def StrippifyDLL(indexList: List[int],
+                 doSwaps=False,
+                 concat=False,
+                 raiseTopoError=False,
+                 name: str = ""):
+
     from . import common
     dll = common.DLL
 
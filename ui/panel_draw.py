@@ -30,6 +30,9 @@ from ..ops.exports import(
 from ..text.saproject import(
 	ProjectFile
 )
+from ..exportStats import(
+	ExportStats
+)
 
 def propAdv(layout, label, prop1, prop1Name, prop2, prop2Name, autoScale = False, qe = False):	## Advanced Properties draw definition.
 	'''For quick edit properties, to put simply'''
@@ -398,3 +401,18 @@ def drawProjectData(layout: bpy.types.UILayout, file: ProjectFile, projInfo: SAP
 	layout.label(text="Author: " + projInfo.ModAuthor)
 	layout.label(text="Version: " + projInfo.ModVersion)
 
+def drawExportStats(layout: bpy.types.UILayout, stats: ExportStats):		## Draws the stage statistics of the last export.
+	import os
+	box = layout.box()
+	box.label(text="Last Export: " + os.path.basename(stats.filepath))
+	box.label(text="Total: %.1f ms" % (stats.time * 1000))
+
+	for stage in stats.stages.values():
+		col = box.column(align=True)
+		row = col.row()
+		row.label(text=stage.name.capitalize())
+		row.label(text="%.1f ms" % (stage.time * 1000))
+		row.label(text="%.2f MB" % (stage.peakMemory / 1048576))
+		if len(stage.counters) > 0:
+			counters = ", ".join(k + ": " + str(v) for k, v in stage.counters.items())
+			col.label(text="  " + counters)
@@ -1,14 +1,15 @@
 import bpy
 import addon_utils
 #region Addon Imports
-from .. import common
+from .. import common, exportStats
 from .panel_draw import(
 	drawMaterialPanel,
 	drawLandEntryPanel,
 	drawMeshPanel,
 	drawObjPanel,
 	drawScenePanel,
-	drawProjectData
+	drawProjectData,
+	drawExportStats
 )
 from .panel_spaces import(
     SA_UI_Panel
@@ -94,6 +95,8 @@ class SA_ImportExport_Viewport(SA_UI_Panel, bpy.types.Panel):			## Import/Export
 		split = layout.split()
 		split.operator(ExportSA2BMDL.bl_idname, text="Export SA2BMDL")
 		split.operator(ExportSA2BLVL.bl_idname, text="Export SA2BLVL")
+		if exportStats.lastStats is not None:
+			drawExportStats(layout, exportStats.lastStats)
 		layout.separator()
 
 		# Animation Tools